@@ -0,0 +1,106 @@
+"""
+Checks the outbound alert queue against a local fake Bot API server which answers every `--rate-limit-every`-th
+photo request with 429. `--streams` streams raise `--alerts` alerts each, `--interval` seconds apart, and every
+alert is sent to `--chats` chats subscribed to its stream, so bursts of alerts for the same chats are coalesced
+into media groups.
+
+Reported: photos sent, failed and dropped, requests by kind and result, the time until the queue is empty,
+the mean delivery time and the highest request rates seen by one chat and by all chats in any one-second window,
+which should stay within the limits of the queue.
+
+Run from `src/bot` with `src` and `src/bot` in PYTHONPATH, same as the bot:
+    python ../benchmarks/benchmark_alert_queue.py --streams 4 --chats 20 --alerts 5 --rate-limit-every 7
+"""
+import argparse
+import asyncio
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from fake_telegram_api import FakeTelegramApi
+from async_runtime import SyncBot
+from alert_queue import AlertQueue, alert_delivery_seconds, telegram_requests_total
+from monitoring.metrics import photos_sent_total
+
+
+def max_window_rate(times, window=1.0):
+    times = sorted(times)
+    start, result = 0, 0
+    for end in range(len(times)):
+        while times[end] - times[start] >= window:
+            start += 1
+        result = max(result, end - start + 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check rate limiting and retries of the alert queue.")
+    parser.add_argument("--streams", type=int, default=4)
+    parser.add_argument("--chats", type=int, default=20, help="Number of chats subscribed to each stream.")
+    parser.add_argument("--alerts", type=int, default=5, help="Number of alerts of each stream.")
+    parser.add_argument("--interval", type=float, default=0.2, help="Time in seconds between alerts of a stream.")
+    parser.add_argument("--rate-limit-every", type=int, default=7)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--chat-rate", type=float, default=1.0)
+    parser.add_argument("--chat-burst", type=int, default=2)
+    parser.add_argument("--global-rate", type=float, default=25.0)
+    parser.add_argument("--global-burst", type=int, default=25)
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    api = FakeTelegramApi(port=args.port, rate_limit_every=args.rate_limit_every, retry_after=args.retry_after)
+    api.start()
+    asyncio_helper.API_URL = api.api_url
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    bot = SyncBot(AsyncTeleBot("0:fake"))  # The fake server accepts any token
+    bot.loop = loop
+
+    queue = AlertQueue(chat_rate=args.chat_rate, chat_burst=args.chat_burst, global_rate=args.global_rate,
+                       global_burst=args.global_burst)
+    photo = np.random.default_rng(0).integers(0, 256, 64 * 1024, dtype=np.uint8).tobytes()
+    stream_keys = [f"stream-{index}" for index in range(args.streams)]
+    uploaded = []
+
+    start_time = time.monotonic()
+    for alert_index in range(args.alerts):
+        for stream_index, stream_key in enumerate(stream_keys):
+            chat_ids = [1000 * (stream_index + 1) + chat_index for chat_index in range(args.chats)]
+            queue.submit(bot, stream_key, photo, f"Alert {alert_index} of {stream_key}", chat_ids,
+                         on_uploaded=uploaded.append)
+        time.sleep(args.interval)
+    is_empty = queue.flush(timeout=600)
+    elapsed = time.monotonic() - start_time
+
+    requests = api.get_requests("sendPhoto") + api.get_requests("sendMediaGroup")
+    chat_times = defaultdict(list)
+    for request_time, _, chat_id, _ in requests:
+        chat_times[chat_id].append(request_time)
+
+    expected = args.streams * args.chats * args.alerts
+    counts = {result: sum(photos_sent_total.get(stream=stream_key, result=result) for stream_key in stream_keys)
+              for result in ("sent", "failed", "dropped")}
+    print(f"photos: {counts['sent']}/{expected} sent, {counts['failed']} failed, {counts['dropped']} dropped, "
+          f"queue emptied: {is_empty} in {elapsed:.1f} s")
+    print(f"uploads reported: {sum(file_id is not None for file_id in uploaded)}/{args.streams * args.alerts}")
+    for kind in ("photo", "media_group"):
+        print(f"{kind:<12} " + ", ".join(f"{result} {telegram_requests_total.get(kind=kind, result=result)}"
+                                         for result in ("sent", "rate_limited", "failed")))
+    print(f"mean delivery time: {alert_delivery_seconds.summary()['mean'] or 0.0:.2f} s")
+    print(f"max requests in 1 s: {max(map(max_window_rate, chat_times.values()), default=0)} per chat "
+          f"(limit {args.chat_burst + args.chat_rate:g}), {max_window_rate([t for t, *_ in requests])} in total "
+          f"(limit {args.global_burst + args.global_rate:g})")
+
+    queue.close()
+    asyncio.run_coroutine_threadsafe(bot.bot.close_session(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Compares the throughput of the model (frames per second) on CPU for different batch sizes.
+
+Run with `src` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python benchmark_batching.py --frames-dir ../img --num-frames 32
+"""
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from model import detect_animals
+
+
+def load_frames(frames_dir, num_frames, width, height):
+    """
+    Loads frames for the benchmark. If no directory is given, random frames of the specified size are generated.
+
+    Args:
+        frames_dir: A directory with jpg/png images or `None`.
+        num_frames: Number of frames to return.
+        width: Width of generated frames.
+        height: Height of generated frames.
+
+    Returns:
+        frames: A list of BGR images.
+    """
+    frames = []
+    if frames_dir is not None:
+        for file_name in sorted(os.listdir(frames_dir)):
+            if file_name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                frames.append(cv2.imread(os.path.join(frames_dir, file_name)))
+    if not frames:
+        rng = np.random.default_rng(0)
+        frames = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(num_frames)]
+
+    # Repeat the frames if there are fewer of them than requested
+    return [frames[i % len(frames)] for i in range(num_frames)]
+
+
+def measure_fps(frames, batch_size):
+    detect_animals(frames[:batch_size])  # Warm-up
+
+    start = time.perf_counter()
+    for i in range(0, len(frames), batch_size):
+        detect_animals(frames[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+
+    return len(frames) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched DETR inference on CPU.")
+    parser.add_argument("--frames-dir", default=None, help="Directory with saved frames. Random frames are used if omitted.")
+    parser.add_argument("--num-frames", type=int, default=32)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames_dir, args.num_frames, args.width, args.height)
+    print(f"{len(frames)} frames, {torch.get_num_threads()} torch threads")
+    for batch_size in args.batch_sizes:
+        print(f"batch size {batch_size:>2}: {measure_fps(frames, batch_size):.2f} frames/sec")
+
+
+if __name__ == "__main__":
+    main()
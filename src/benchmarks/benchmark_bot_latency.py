@@ -0,0 +1,102 @@
+"""
+Measures how responsive the asynchronous bot stays under concurrent users. The bot is connected to a local fake
+Bot API server; `--now-users` users press the `/now` button at the same time while `--help-users` other users
+send `/help`. Latency is measured from the moment an update becomes available to the bot until the bot sends
+the answer (`sendPhoto` for `/now`, `sendMessage` for `/help`).
+
+Streams are replaced with a synthetic source, so no YouTube access is needed.
+Run from `src/bot` with `src`, `src/bot` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python ../benchmarks/benchmark_bot_latency.py --now-users 8 --help-users 32
+"""
+import argparse
+import asyncio
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+
+import static.settings
+from fake_telegram_api import FakeTelegramApi
+from img_processing.process_stream import FrameGrabber
+
+
+class SyntheticStream:
+    """
+    A stream which returns random frames at 25 fps. Replaces `CamGear` in benchmarks.
+    """
+    def __init__(self, width=1280, height=720):
+        self.frame = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    def read(self):
+        time.sleep(0.04)
+        return self.frame
+
+    def stop(self):
+        pass
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure bot latency under concurrent simulated users.")
+    parser.add_argument("--now-users", type=int, default=8)
+    parser.add_argument("--help-users", type=int, default=32)
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    api = FakeTelegramApi(port=args.port)
+    api.start()
+
+    # The bot reads these values when it is imported
+    static.settings.telegram_api_url = api.api_url
+    static.settings.model_warm_up = False
+    try:
+        import config
+    except ImportError:
+        sys.modules["config"] = types.SimpleNamespace(BOT_TOKEN="0:fake")  # The fake server accepts any token
+    import bot as bot_module
+    import animals
+    from img_processing.process_image import warm_up_detection
+
+    animal_type = bot_module.stream_registry.keys()[0]
+    animals.start_video_stream = lambda source_path: FrameGrabber(SyntheticStream()).start()
+
+    # Run the bot on its own event loop
+    bot_module.create_bot()
+    loop = asyncio.new_event_loop()
+    bot_module.sync_bot.loop = loop
+    threading.Thread(target=loop.run_until_complete, args=(bot_module.bot.polling(non_stop=True),), daemon=True).start()
+
+    # Load the model before measuring
+    warm_up_detection().join()
+
+    now_chats = list(range(1000, 1000 + args.now_users))
+    help_chats = list(range(2000, 2000 + args.help_users))
+    for chat_id in now_chats:
+        bot_module.subscriptions.subscribe(animal_type, chat_id)
+
+    start_time = time.monotonic()
+    for chat_id in now_chats:
+        api.add_callback(chat_id, f"current_{animal_type}")
+    for chat_id in help_chats:
+        api.add_message(chat_id, "/help")
+
+    now_latencies = [api.wait_for_request("sendPhoto", chat_id, start_time) for chat_id in now_chats]
+    help_latencies = [api.wait_for_request("sendMessage", chat_id, start_time) for chat_id in help_chats]
+    now_latencies = [t - start_time for t in now_latencies if t is not None]
+    help_latencies = [t - start_time for t in help_latencies if t is not None]
+
+    for name, latencies, users in (("/now", now_latencies, args.now_users), ("/help", help_latencies, args.help_users)):
+        print(f"{name:<6} answered {len(latencies)}/{users}: p50 {percentile(latencies, 50) * 1000:.0f} ms, "
+              f"p95 {percentile(latencies, 95) * 1000:.0f} ms, max {percentile(latencies, 100) * 1000:.0f} ms")
+
+    loop.call_soon_threadsafe(loop.stop)
+    api.stop()
+
+
+if __name__ == "__main__":
+    main()
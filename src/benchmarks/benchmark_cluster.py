@@ -0,0 +1,131 @@
+"""
+Checks the cluster mode on one host: the coordinator runs in this process, `--workers` detection workers are started
+as separate processes, and `--streams` streams are assigned to them. The streams are local video files: `--video`
+for every stream, or generated videos of a moving rectangle. After `--kill-after` seconds the first worker is killed
+(or frozen with `--freeze`, so it is found by the missing heartbeats), and its streams are moved to the other workers.
+
+Reported: streams of each worker before and after the failure, the number of moved streams (only streams of the killed
+worker should move), the time until every moved stream is analyzed by its new worker, frames taken by each worker
+and detections reported to the coordinator.
+
+Generated videos contain no objects, so detections need a video with objects unexpected for `--animal-type`.
+Run from `src/bot` with `src`, `src/bot` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python ../benchmarks/benchmark_cluster.py --workers 3 --streams 12 --kill-after 30
+    python ../benchmarks/benchmark_cluster.py --workers 3 --streams 12 --freeze --heartbeat-timeout 5 --video ~/zoo.mp4
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import cv2
+import numpy as np
+
+from static.sources import stream_registry
+from cluster import Coordinator, streams_moved_total
+
+
+def write_video(path, duration, fps=10, width=640, height=360, seed=0):
+    rng = np.random.default_rng(seed)
+    background = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for index in range(int(duration * fps)):
+        frame = background.copy()
+        x = (index * 8) % (width - 80)
+        cv2.rectangle(frame, (x, height // 3), (x + 80, height // 3 + 80), (255, 255, 255), thickness=-1)
+        writer.write(frame)
+    writer.release()
+
+
+def wait_for(condition, timeout, interval=0.2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check stream assignment and failover of detection workers.")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--streams", type=int, default=12)
+    parser.add_argument("--duration", type=float, default=90.0, help="Time in seconds the benchmark runs.")
+    parser.add_argument("--kill-after", type=float, default=30.0,
+                        help="Time in seconds after all streams are analyzed until the first worker is killed.")
+    parser.add_argument("--freeze", action="store_true",
+                        help="Stop the first worker with SIGSTOP instead of killing it, so only heartbeats reveal it.")
+    parser.add_argument("--heartbeat-timeout", type=float, default=None,
+                        help="Heartbeat timeout of the coordinator in seconds. The settings are used if omitted.")
+    parser.add_argument("--animal-type", default="bird", help="Streams behave like the stream of this animal type.")
+    parser.add_argument("--video", default=None, help="A video file played by every stream.")
+    args = parser.parse_args()
+
+    video_dir = tempfile.mkdtemp(prefix="cluster-videos-")
+    stream_keys = [f"cluster_{index}" for index in range(args.streams)]
+    for index, stream_key in enumerate(stream_keys):
+        video_path = args.video
+        if video_path is None:
+            video_path = os.path.join(video_dir, f"{stream_key}.mp4")
+            write_video(video_path, args.duration + 60, seed=index)
+        stream_registry.add(stream_key, os.path.abspath(video_path), animal_type=args.animal_type)
+
+    reports = Counter()
+    options = {} if args.heartbeat_timeout is None else {"heartbeat_timeout": args.heartbeat_timeout}
+    coordinator = Coordinator(lambda stream_key, *_: reports.update([stream_key]), port=0, **options).start()
+
+    worker_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot", "worker.py")
+    workers = [subprocess.Popen([sys.executable, worker_path, "--id", f"worker-{index}",
+                                 "--coordinator", f"127.0.0.1:{coordinator.port}"])
+               for index in range(args.workers)]
+    start_time = time.monotonic()
+    try:
+        for stream_key in stream_keys:
+            coordinator.start_stream(stream_key)
+
+        def analyzed_streams():
+            return {stream_key: worker_id for worker_id, status in coordinator.status().items()
+                    for stream_key, frames in status['frames'].items() if frames > 0}
+
+        is_started = wait_for(lambda: len(analyzed_streams()) == len(stream_keys), timeout=300)
+        print(f"all streams analyzed: {is_started} in {time.monotonic() - start_time:.1f} s "
+              f"by {coordinator.worker_count()} worker(s)")
+        before = {worker_id: status['streams'] for worker_id, status in coordinator.status().items()}
+        for worker_id, streams in sorted(before.items()):
+            print(f"  {worker_id}: {len(streams)} stream(s)")
+
+        time.sleep(args.kill_after)
+        lost_streams = set(before.get("worker-0", []))
+        moved_before = streams_moved_total.get()
+        workers[0].send_signal(signal.SIGSTOP if args.freeze else signal.SIGKILL)
+        failure_time = time.monotonic()
+        print(f"worker-0 {'frozen' if args.freeze else 'killed'} with {len(lost_streams)} stream(s)")
+
+        def moved_streams_analyzed():
+            analyzed = analyzed_streams()
+            return all(analyzed.get(stream_key) not in (None, "worker-0") for stream_key in lost_streams)
+
+        is_recovered = wait_for(moved_streams_analyzed, timeout=300)
+        print(f"moved streams analyzed again: {is_recovered} in {time.monotonic() - failure_time:.1f} s, "
+              f"{streams_moved_total.get() - moved_before:g} stream(s) moved")
+        for worker_id, status in sorted(coordinator.status().items()):
+            print(f"  {worker_id}: {len(status['streams'])} stream(s), {sum(status['frames'].values())} frames, "
+                  f"{status['open_streams']} open")
+
+        time.sleep(max(0.0, args.duration - (time.monotonic() - start_time)))
+        print(f"detections reported: {sum(reports.values())} from {len(reports)} stream(s)")
+    finally:
+        coordinator.stop()
+        if args.freeze:
+            workers[0].send_signal(signal.SIGCONT)
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+
+
+if __name__ == "__main__":
+    main()
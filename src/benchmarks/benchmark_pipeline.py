@@ -0,0 +1,309 @@
+"""
+End-to-end benchmark of the detection pipeline: `Animals.acquire_stream` -> daemon processes -> alert queue -> `send_photo`.
+YouTube streams are replaced with local sources at a controlled fps (a looped video file, a jittered image
+or random frames) and the Telegram bot is replaced with an in-process sink which records every sent photo.
+`--streams` streams are opened, each with `--chats` subscribed chats, and the pipeline runs for `--duration` seconds.
+With `--max-open-streams` below `--streams`, streams take turns in fewer decoders.
+
+Reported: analyzed and skipped frames/sec, p50/p95/p99 latency from taking a frame out of the buffer to sending
+the alert, evicted decoders, mean time of each pipeline stage, CPU usage and RSS of the bot process (worker
+processes of the 'process' inference backend are not included). Results are written to JSON; `--baseline` compares them with
+the results of a previous run, e.g. of another commit.
+
+Random frames contain no objects, so alerts need a video or an image with objects unexpected for `--animal-type`.
+Run from `src/bot` with `src`, `src/bot` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python ../benchmarks/benchmark_pipeline.py --streams 4 --chats 10 --image ../img/person.jpg --output result.json
+    python ../benchmarks/benchmark_pipeline.py --streams 4 --chats 10 --video ~/zoo.mp4 --baseline result.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import threading
+import time
+import types
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+
+import cv2
+import numpy as np
+
+import static.settings
+from static.sources import stream_registry
+
+# Time when the frame analyzed by the current daemon thread was put into the buffer
+frame_times = threading.local()
+
+
+class SyntheticSource:
+    """
+    A stream source which returns frames at a fixed fps. Frames are an image or random noise shifted by a few
+    pixels each time, so the motion gate sees movement. Replaces `CamGear` in benchmarks.
+    """
+    def __init__(self, fps=25.0, width=1280, height=720, image_path=None, seed=0):
+        self.rng = np.random.default_rng(seed)
+        if image_path is not None:
+            image = cv2.imread(image_path)
+            if image is None:
+                raise Exception(f"Cannot read image '{image_path}'.")
+            self.frame = cv2.resize(image, (width, height))
+        else:
+            self.frame = self.rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        self.frame_interval = 1 / fps
+        self.next_frame_time = time.monotonic()
+
+    def read(self):
+        time.sleep(max(0.0, self.next_frame_time - time.monotonic()))
+        self.next_frame_time = max(self.next_frame_time + self.frame_interval, time.monotonic())
+        return np.roll(self.frame, self.rng.integers(-8, 9, 2), axis=(0, 1))
+
+    def stop(self):
+        pass
+
+
+class RecordingBot:
+    """
+    Replaces the Telegram bot. Records the time, chat and latency of every sent photo. Photos are sent by
+    the threads of the alert queue, so daemon processes register the frame time of each photo with `register_photo`.
+    """
+    def __init__(self, send_delay=0.0):
+        self.send_delay = send_delay
+        self.sent = []  # Tuples (time, chat id, size of the photo, latency)
+        self.frame_times = {}  # Maps `id` of a photo or its `file_id` to the time its frame was put into the buffer
+        self.lock = threading.Lock()
+
+    def register_photo(self, photo):
+        with self.lock:
+            self.frame_times[id(photo)] = getattr(frame_times, "value", None)
+
+    def send_photo(self, chat_id, photo, caption=None):
+        time.sleep(self.send_delay)  # Simulated network round trip
+        return self._deliver(chat_id, photo)
+
+    def send_media_group(self, chat_id, media):
+        time.sleep(self.send_delay)
+        return [self._deliver(chat_id, item.media) for item in media]
+
+    def send_message(self, chat_id, text, **kwargs):
+        return types.SimpleNamespace(message_id=0)
+
+    def _deliver(self, chat_id, photo):
+        now = time.monotonic()
+        is_uploaded = isinstance(photo, str)
+        with self.lock:
+            frame_time = self.frame_times.get(photo if is_uploaded else id(photo))
+            file_id = photo if is_uploaded else f"file-{len(self.sent)}"
+            self.frame_times[file_id] = frame_time
+            self.sent.append((now, chat_id, 0 if is_uploaded else len(photo),
+                              now - frame_time if frame_time is not None else None))
+        return types.SimpleNamespace(photo=[types.SimpleNamespace(file_id=file_id)])
+
+
+class ResourceMonitor:
+    """
+    Samples RSS of the process in a background thread and measures CPU time used between `start` and `stop`.
+    """
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.rss_samples = []
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.start_cpu_time = time.process_time()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        wall_time = time.monotonic() - self.start_time
+        cpu_time = time.process_time() - self.start_cpu_time
+        self.stop_event.set()
+        self.thread.join()
+        return {
+            "cpu_cores_used": cpu_time / wall_time,
+            "cpu_share": cpu_time / wall_time / (os.cpu_count() or 1),
+            "rss_mean_mb": float(np.mean(self.rss_samples)) if self.rss_samples else None,
+            "rss_peak_mb": float(np.max(self.rss_samples)) if self.rss_samples else None,
+        }
+
+    def _sample(self):
+        while not self.stop_event.wait(self.interval):
+            rss = current_rss_mb()
+            if rss is not None:
+                self.rss_samples.append(rss)
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # Peak RSS in KB on Linux
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def register_streams(num_streams, animal_type):
+    """
+    Adds `num_streams` benchmark streams which behave like the stream of `animal_type` to the stream registry.
+
+    Returns:
+        A list of keys of the added streams.
+    """
+    stream_keys = [f"{animal_type}_{index}" for index in range(num_streams)]
+    for index, stream_key in enumerate(stream_keys):
+        stream_registry.add(stream_key, f"benchmark:{index}", animal_type=animal_type)
+    return stream_keys
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_with_baseline(results, baseline_path):
+    with open(baseline_path) as file:
+        baseline = json.load(file)["results"]
+
+    print(f"Compared with {baseline_path}:")
+    for key in ("analyzed_fps", "latency_p50", "latency_p95", "latency_p99", "cpu_cores_used", "rss_peak_mb"):
+        old, new = baseline.get(key), results.get(key)
+        if old and new is not None:
+            print(f"  {key:<16} {old:10.3f} -> {new:10.3f} ({(new - old) / old * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the whole pipeline with local streams and a fake bot.")
+    parser.add_argument("--streams", type=int, default=2, help="Number of opened streams.")
+    parser.add_argument("--chats", type=int, default=10, help="Number of chats subscribed to each stream.")
+    parser.add_argument("--duration", type=float, default=60.0, help="Measured time in seconds.")
+    parser.add_argument("--animal-type", default="bird", help="Streams behave like the stream of this animal type.")
+    parser.add_argument("--fps", type=float, default=25.0, help="Frame rate of synthetic sources.")
+    parser.add_argument("--video", default=None, help="A video file played in a loop by every stream.")
+    parser.add_argument("--image", default=None, help="An image shown by every synthetic stream.")
+    parser.add_argument("--interval", type=float, default=None,
+                        help="Sampling interval of the daemon processes in seconds. The settings are used if omitted.")
+    parser.add_argument("--alert-every-frame", action="store_true",
+                        help="Disable deduplication of alerts, so every frame with unexpected objects is sent.")
+    parser.add_argument("--max-open-streams", type=int, default=None,
+                        help="Maximum number of open stream decoders. Equal to the number of streams if omitted.")
+    parser.add_argument("--send-delay", type=float, default=0.0, help="Simulated time of one send in seconds.")
+    parser.add_argument("--output", default=None, help="A JSON file for the results.")
+    parser.add_argument("--baseline", default=None, help="A JSON file with results of a previous run.")
+    args = parser.parse_args()
+
+    static.settings.metrics_port = None
+    stream_keys = register_streams(args.streams, args.animal_type)
+
+    import animals
+    import daemon_processes
+    import subscriptions as subscriptions_module
+    from subscriptions import subscriptions
+    from alert_queue import alert_queue
+    from img_processing.process_stream import FrameGrabber, VideoFileSource
+    from img_processing.process_image import warm_up_detection
+    from img_processing.tracker import object_tracker
+    from monitoring.metrics import frames_total, stage_seconds
+    from animals import streams_closed_total
+
+    class TimedFrameGrabber(FrameGrabber):
+        @contextmanager
+        def latest_frame(self, timeout=None):
+            with super().latest_frame(timeout) as (frame, timestamp):
+                frame_times.value = timestamp
+                yield frame, timestamp
+
+    def start_benchmark_stream(source_path):
+        index = int(source_path.split(":")[1])
+        if args.video is not None:
+            source = VideoFileSource(args.video, realtime=True, loop=True)
+        else:
+            source = SyntheticSource(args.fps, image_path=args.image, seed=index)
+        return TimedFrameGrabber(source, buffer_size=static.settings.frame_buffer_size).start()
+
+    def send_photo_to_subscribers(bot, animal_type, photo, caption, on_uploaded=None):
+        bot.register_photo(photo)
+        return subscriptions_module.send_photo_to_subscribers(bot, animal_type, photo, caption, on_uploaded)
+
+    animals.start_video_stream = start_benchmark_stream
+    daemon_processes.send_photo_to_subscribers = send_photo_to_subscribers
+
+    scheduler = daemon_processes.frame_scheduler
+    if args.interval is not None:
+        scheduler.min_interval = scheduler.idle_interval = scheduler.tracked_interval = args.interval
+    if args.alert_every_frame:
+        object_tracker.realert_interval = 0.0
+
+    warm_up_detection().join()  # Load the model before measuring
+
+    sink = RecordingBot(send_delay=args.send_delay)
+    animal_detection = animals.Animals(max_open=args.max_open_streams or args.streams)
+    for stream_index, stream_key in enumerate(stream_keys):
+        for chat_index in range(args.chats):
+            subscriptions.subscribe(stream_key, 1_000_000 * (stream_index + 1) + chat_index)
+
+    monitor = ResourceMonitor()
+    monitor.start()
+    start_time = time.monotonic()
+    for stream_key in stream_keys:
+        daemon_processes.start_daemon_process(stream_key, animal_detection,
+                                              partial(daemon_processes.report_to_subscribers, sink))
+
+    time.sleep(args.duration)
+
+    for stream_key in stream_keys:
+        daemon_processes.terminate_daemon_process(stream_key)
+    alert_queue.flush(timeout=60)  # Photos of the last alerts are still being sent
+    elapsed = time.monotonic() - start_time
+    resources = monitor.stop()
+    for stream_key in stream_keys:
+        animal_detection.close_stream(stream_key)
+
+    analyzed = sum(frames_total.get(stream=stream_key, result='analyzed') for stream_key in stream_keys)
+    skipped = sum(frames_total.get(stream=stream_key, result='skipped') for stream_key in stream_keys)
+    latencies = [latency for _, _, _, latency in sink.sent if latency is not None]
+    stages = ('read', 'preprocess', 'forward', 'postprocess', 'inference', 'draw', 'encode', 'send')
+
+    results = {
+        "elapsed_seconds": elapsed,
+        "analyzed_fps": analyzed / elapsed,
+        "skipped_fps": skipped / elapsed,
+        "photos_sent": len(sink.sent),
+        "photos_per_second": len(sink.sent) / elapsed,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "streams_evicted": streams_closed_total.get(reason='evicted'),
+        "stage_mean_seconds": {stage: stage_seconds.summary(stage=stage)["mean"] for stage in stages},
+        **resources,
+    }
+    report = {
+        "commit": get_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            **vars(args),
+            "inference_backend": static.settings.inference_backend,
+            "model_backend": static.settings.model_backend,
+            "max_batch_size": static.settings.max_batch_size,
+        },
+        "results": results,
+    }
+
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline is not None:
+        compare_with_baseline(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Checks the cv2/NumPy preprocessing against `DetrImageProcessor` and measures both. For each batch, the inputs
+are compared (shapes, `pixel_mask`, maximum and mean absolute difference of `pixel_values`) and detections of the model
+on both inputs are matched. Then preprocessing time per frame and peak allocation per batch are reported.
+
+Peak allocation is measured with `tracemalloc`, which sees NumPy arrays but not the buffers allocated by `torch`
+itself; the reused input buffer of the cv2 path is allocated before measuring.
+
+Run with `src` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python benchmark_preprocessing.py --frames-dir ../img --batch-size 4
+"""
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+import model
+from preprocessing import Preprocessor
+from benchmark_batching import load_frames
+from compare_backends import match_detections
+
+
+def processor_inputs(processor, frames):
+    images = [Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)) for frame in frames]
+    inputs = processor(images=images, return_tensors="pt")
+    return inputs["pixel_values"], inputs["pixel_mask"]
+
+
+def measure(preprocess, batches, repeats):
+    preprocess(batches[0])  # Warm-up, buffers are allocated here
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        for batch in batches:
+            preprocess(batch)
+    seconds_per_frame = (time.perf_counter() - start_time) / (repeats * sum(len(batch) for batch in batches))
+
+    peaks = []
+    for batch in batches:
+        tracemalloc.start()
+        preprocess(batch)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return seconds_per_frame, max(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare cv2/NumPy preprocessing with DetrImageProcessor.")
+    parser.add_argument("--frames-dir", default=None, help="Directory with saved frames. Random frames are used if omitted.")
+    parser.add_argument("--num-frames", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--iou-threshold", type=float, default=0.5)
+    args = parser.parse_args()
+
+    processor, _ = model.load_model()
+    frames = load_frames(args.frames_dir, args.num_frames, 1280, 720)
+    batches = [frames[i:i + args.batch_size] for i in range(0, len(frames), args.batch_size)]
+    preprocessor = Preprocessor()
+
+    # Equivalence of the inputs and of the detections
+    max_difference, mean_differences, masks_equal = 0.0, [], True
+    matched, reference_count, candidate_count = 0, 0, 0
+    for batch in batches:
+        reference_values, reference_mask = processor_inputs(processor, batch)
+        pixel_values, pixel_mask = preprocessor(batch)
+        if pixel_values.shape != reference_values.shape:
+            raise Exception(f"Shapes differ: {tuple(pixel_values.shape)} and {tuple(reference_values.shape)}.")
+        masks_equal &= bool(torch.equal(pixel_mask, reference_mask))
+        difference = (pixel_values - reference_values).abs()
+        max_difference = max(max_difference, float(difference.max()))
+        mean_differences.append(float(difference.mean()))
+
+        target_sizes = [frame.shape[:2] for frame in batch]
+        with torch.no_grad():
+            reference = model.postprocess_outputs(model.backend.forward(reference_values, reference_mask),
+                                                  target_sizes, model.confidence_threshold)
+            candidate = model.postprocess_outputs(model.backend.forward(pixel_values, pixel_mask),
+                                                  target_sizes, model.confidence_threshold)
+        for reference_detections, candidate_detections in zip(reference, candidate):
+            matched += match_detections(reference_detections, candidate_detections, args.iou_threshold)[0]
+            reference_count += len(reference_detections)
+            candidate_count += len(candidate_detections)
+
+    print(f"pixel_mask equal: {masks_equal}")
+    print(f"pixel_values difference: max {max_difference:.4f}, mean {np.mean(mean_differences):.5f}")
+    print(f"detections: {reference_count} with the processor, {candidate_count} with cv2, {matched} matched "
+          f"(recall {matched / reference_count if reference_count else 1.0:.3f}, "
+          f"precision {matched / candidate_count if candidate_count else 1.0:.3f})")
+
+    # Speed and memory
+    for name, preprocess in (("processor", lambda batch: processor_inputs(processor, batch)),
+                             ("cv2", preprocessor)):
+        seconds_per_frame, peak = measure(preprocess, batches, args.repeats)
+        print(f"{name:<10} {seconds_per_frame * 1000:7.2f} ms/frame, peak allocation {peak / 2 ** 20:7.1f} MB per batch")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Compares inference on regions of interest / tiles with full-frame inference: latency per frame, recall of the
+full-frame detections and the number of objects found only with tiles (usually small objects).
+
+Run with `src` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python benchmark_regions.py --frames-dir ../img --tiles 2 2
+    python benchmark_regions.py --frames-dir ../img --stream bird
+"""
+import argparse
+import time
+
+from inference_engine import engine
+from regions import detect_in_regions
+from static.stream_regions import stream_regions
+from benchmark_batching import load_frames
+from compare_backends import match_detections
+
+
+def measure(detect, frames):
+    detect(frames[0])  # Warm-up
+
+    results = []
+    start_time = time.perf_counter()
+    for frame in frames:
+        results.append(detect(frame))
+    return results, (time.perf_counter() - start_time) / len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare region/tiled inference with full-frame inference.")
+    parser.add_argument("--frames-dir", default=None, help="Directory with saved frames. Random frames are used if omitted.")
+    parser.add_argument("--num-frames", type=int, default=16)
+    parser.add_argument("--stream", default=None, help="Use regions configured for this stream in `stream_regions`.")
+    parser.add_argument("--tiles", type=int, nargs=2, default=(2, 2), metavar=("COLUMNS", "ROWS"))
+    parser.add_argument("--tile-overlap", type=float, default=0.1)
+    parser.add_argument("--iou-threshold", type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.stream is not None:
+        regions = stream_regions[args.stream]
+    else:
+        regions = {'roi': [], 'tiles': tuple(args.tiles), 'tile_overlap': args.tile_overlap}
+
+    frames = load_frames(args.frames_dir, args.num_frames, 1920, 1080)
+    full_results, full_latency = measure(engine.detect, frames)
+    region_results, region_latency = measure(lambda frame: detect_in_regions(frame, regions), frames)
+
+    full_count = sum(len(result) for result in full_results)
+    region_count = sum(len(result) for result in region_results)
+    matched = sum(match_detections(full, region, args.iou_threshold)[0]
+                  for full, region in zip(full_results, region_results))
+
+    print(f"regions: {regions}")
+    print(f"full frame: {full_latency * 1000:.1f} ms/frame, {full_count} objects")
+    print(f"regions:    {region_latency * 1000:.1f} ms/frame, {region_count} objects")
+    print(f"recall of full-frame objects: {matched / full_count if full_count else 1.0:.3f}")
+    print(f"objects found only with regions: {region_count - matched}")
+
+
+if __name__ == "__main__":
+    main()
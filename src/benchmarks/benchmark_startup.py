@@ -0,0 +1,43 @@
+"""
+Measures startup costs of the detection pipeline:
+    - time of importing `process_image` (what the bot pays before it starts polling Telegram),
+    - time of loading the model (from the local snapshot if it exists),
+    - latency of the first detection and of the following ones.
+
+Run with `src` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python benchmark_startup.py
+"""
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def measure_import_time(module_name):
+    # A fresh interpreter is used, so nothing is imported yet
+    code = f"import time; start = time.perf_counter(); import {module_name}; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    print(f"import process_image: {measure_import_time('process_image'):.2f} s")
+
+    import model
+    model.load_model()
+    print(f"model loading: {model.startup_timings['load']:.2f} s "
+          f"({'local snapshot' if os.path.isdir(model.local_model_dir) else 'Hugging Face Hub'})")
+
+    frame = np.random.default_rng(0).integers(0, 256, (720, 1280, 3), dtype=np.uint8)
+    model.detect_animal(frame)
+    print(f"first detection: {model.startup_timings['first_inference']:.2f} s")
+
+    start_time = time.perf_counter()
+    model.detect_animal(frame)
+    print(f"next detection: {time.perf_counter() - start_time:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
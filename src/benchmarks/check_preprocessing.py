@@ -0,0 +1,119 @@
+"""
+Checks that the cv2/NumPy preprocessing gives the same inputs as `DetrImageProcessor` for frames of different
+aspect ratios and for a batch of frames of different sizes, which are padded to a common size. Shapes and
+`pixel_mask` should be equal, `pixel_values` should differ by at most `--max-tolerance` in each value and by
+at most `--mean-tolerance` on average. The differences come from the interpolation of cv2 and PIL.
+Only the configuration of the processor is loaded, the model is not needed.
+
+Run with `src` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python check_preprocessing.py
+    python check_preprocessing.py --frames-dir ../img --max-tolerance 0.5
+"""
+import argparse
+import os
+
+import cv2
+import numpy as np
+import torch
+
+import model
+from preprocessing import Preprocessor
+from benchmark_preprocessing import processor_inputs
+
+# Sizes (width, height) of the checked frames: landscape, portrait, square, upscaled, downscaled and so wide
+# that the longer side is limited by `longest_edge`
+frame_sizes = [(1280, 720), (720, 1280), (800, 800), (640, 480), (333, 500), (1920, 1080), (3000, 800)]
+
+# Frames of these sizes are checked together in one batch
+mixed_batch_sizes = [(1280, 720), (720, 1280), (640, 480), (3000, 800)]
+
+
+def load_processor():
+    from transformers import DetrImageProcessor
+    if os.path.isdir(model.local_model_dir):
+        return DetrImageProcessor.from_pretrained(model.local_model_dir, local_files_only=True)
+    return DetrImageProcessor.from_pretrained(model.model_name)
+
+
+def make_frame(width, height, source=None, seed=0):
+    """
+    Returns a BGR frame of the given size: the source frame resized to it or, if there is no source, smooth
+    random noise with a few sharp edges, which is closer to camera frames than noise of independent pixels.
+    """
+    if source is not None:
+        return cv2.resize(source, (width, height), interpolation=cv2.INTER_AREA)
+    random_state = np.random.RandomState(seed)
+    noise = random_state.randint(0, 256, (max(height // 16, 2), max(width // 16, 2), 3)).astype(np.uint8)
+    frame = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(4):
+        x1, y1 = random_state.randint(0, width // 2), random_state.randint(0, height // 2)
+        color = random_state.randint(0, 256, 3).tolist()
+        cv2.rectangle(frame, (x1, y1), (x1 + width // 4, y1 + height // 4), color, -1)
+    return frame
+
+
+def compare(processor, preprocessor, frames):
+    """
+    Returns:
+        A list of problems (empty if the inputs are equal), the maximum and the mean absolute difference
+        of `pixel_values`.
+    """
+    reference_values, reference_mask = processor_inputs(processor, frames)
+    pixel_values, pixel_mask = preprocessor(frames)
+    if pixel_values.shape != reference_values.shape:
+        return [f"shapes differ: {tuple(pixel_values.shape)} and {tuple(reference_values.shape)}"], None, None
+
+    problems = []
+    if not torch.equal(pixel_mask, reference_mask):
+        problems.append(f"pixel_mask differs in {int((pixel_mask != reference_mask).sum())} pixel(s)")
+    difference = (pixel_values - reference_values).abs()
+    return problems, float(difference.max()), float(difference.mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check cv2/NumPy preprocessing against DetrImageProcessor.")
+    parser.add_argument("--frames-dir", default=None,
+                        help="Directory with saved frames. The first one is resized to each size. "
+                             "Synthetic frames are used if omitted.")
+    parser.add_argument("--max-tolerance", type=float, default=0.75)
+    parser.add_argument("--mean-tolerance", type=float, default=0.01)
+    args = parser.parse_args()
+
+    source = None
+    if args.frames_dir is not None:
+        file_names = sorted(name for name in os.listdir(args.frames_dir)
+                            if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+        if not file_names:
+            raise Exception(f"No frames in '{args.frames_dir}'.")
+        source = cv2.imread(os.path.join(args.frames_dir, file_names[0]))
+
+    processor = load_processor()
+    preprocessor = Preprocessor()
+
+    cases = [(f"{width}x{height}", [make_frame(width, height, source, seed)])
+             for seed, (width, height) in enumerate(frame_sizes)]
+    cases.append(("mixed batch", [make_frame(width, height, source, seed)
+                                  for seed, (width, height) in enumerate(mixed_batch_sizes)]))
+
+    failed = []
+    for name, frames in cases:
+        problems, max_difference, mean_difference = compare(processor, preprocessor, frames)
+        if max_difference is not None:
+            if max_difference > args.max_tolerance:
+                problems.append(f"max difference {max_difference:.4f} > {args.max_tolerance}")
+            if mean_difference > args.mean_tolerance:
+                problems.append(f"mean difference {mean_difference:.5f} > {args.mean_tolerance}")
+            print(f"{name:<12} max {max_difference:.4f}, mean {mean_difference:.5f}  "
+                  f"{'; '.join(problems) if problems else 'ok'}")
+        else:
+            print(f"{name:<12} {'; '.join(problems)}")
+        if problems:
+            failed.append(name)
+
+    if failed:
+        raise Exception(f"Preprocessing differs from DetrImageProcessor for: {', '.join(failed)}.")
+    print("Preprocessing matches DetrImageProcessor.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Compares model backends (eager fp32, dynamically quantized int8, ONNX Runtime) by latency and by agreement
+of detected boxes/labels with the eager fp32 baseline on a folder of saved frames.
+
+A detection of a backend matches a baseline detection if both have the same label and their IoU is at least
+`--iou-threshold`. Precision and recall are computed against the baseline detections.
+
+Run with `src` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python compare_backends.py --frames-dir ../img
+"""
+import argparse
+import time
+
+import numpy as np
+
+import model
+from regions import box_iou
+from benchmark_batching import load_frames
+
+
+def match_detections(baseline, candidate, iou_threshold):
+    """
+    Greedily matches detections of the candidate backend to the baseline detections with the same label.
+
+    Returns:
+        matched: Number of matched pairs.
+        ious: A list of IoU values of the matched pairs.
+    """
+    baseline_boxes = baseline.boxes
+    used = np.zeros(len(baseline_boxes), dtype=bool)
+    ious = []
+    for class_id, box in zip(candidate.class_ids, candidate.boxes):
+        same_type = (baseline.class_ids == class_id) & ~used
+        if not same_type.any():
+            continue
+        overlaps = np.where(same_type, box_iou(box, baseline_boxes), 0.0)
+        best = int(np.argmax(overlaps))
+        if overlaps[best] >= iou_threshold:
+            used[best] = True
+            ious.append(float(overlaps[best]))
+    return len(ious), ious
+
+
+def run_backend(detection_backend, frames, batch_size):
+    model.detect_animals(frames[:batch_size], detection_backend)  # Warm-up
+
+    results = []
+    start_time = time.perf_counter()
+    for i in range(0, len(frames), batch_size):
+        results.extend(model.detect_animals(frames[i:i + batch_size], detection_backend))
+    return results, (time.perf_counter() - start_time) / len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare accuracy and latency of model backends.")
+    parser.add_argument("--frames-dir", default=None, help="Directory with saved frames. Random frames are used if omitted.")
+    parser.add_argument("--num-frames", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--iou-threshold", type=float, default=0.5)
+    parser.add_argument("--backends", nargs="+", default=["eager", "quantized", "onnx"])
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames_dir, args.num_frames, 1280, 720)
+    _, fp32_model = model.load_model()
+    baseline, baseline_latency = run_backend(model.EagerBackend(fp32_model), frames, args.batch_size)
+    baseline_count = sum(len(result) for result in baseline)
+
+    print(f"{'backend':<10} {'ms/frame':>9} {'speedup':>8} {'precision':>10} {'recall':>7} {'mean IoU':>9}")
+    for backend_name in args.backends:
+        detection_backend = model.create_backend(backend_name, fp32_model)
+        results, latency = run_backend(detection_backend, frames, args.batch_size)
+
+        matched, ious = 0, []
+        for baseline_result, result in zip(baseline, results):
+            frame_matched, frame_ious = match_detections(baseline_result, result, args.iou_threshold)
+            matched += frame_matched
+            ious.extend(frame_ious)
+        count = sum(len(result) for result in results)
+
+        precision = matched / count if count else 1.0
+        recall = matched / baseline_count if baseline_count else 1.0
+        mean_iou = float(np.mean(ious)) if ious else float("nan")
+        print(f"{backend_name:<10} {latency * 1000:>9.1f} {baseline_latency / latency:>7.2f}x "
+              f"{precision:>10.3f} {recall:>7.3f} {mean_iou:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
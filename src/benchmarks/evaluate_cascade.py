@@ -0,0 +1,119 @@
+"""
+Evaluates the detector cascade against the DETR-only pipeline on recorded frames. For each frame the reference
+decision is whether DETR finds objects unexpected for `--animal-type`. Reported: alert recall of the cascade
+(frames with unexpected objects which the cascade also reports), false alerts, the share of frames where DETR
+was skipped and the mean time per frame of both pipelines.
+
+The pre-detector files (`MobileNetSSD_deploy.prototxt` and `MobileNetSSD_deploy.caffemodel`) should be
+in `src/img_processing/weights`.
+Run with `src` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python evaluate_cascade.py --video ~/recordings/penguins.mp4 --animal-type bird --fps 1
+    python evaluate_cascade.py --frames-dir ../img --animal-type bird --mode crops --suspect-threshold 0.2
+"""
+import argparse
+import time
+
+import cv2
+
+import model
+from cascade import DetectorCascade, SsdDetector
+from regions import detect_in_regions
+from analyze_recordings import sample_frames
+from static.settings import (cascade_min_confidence, cascade_confident_threshold, cascade_suspect_threshold,
+                             cascade_crop_margin, cascade_target_classes)
+from benchmark_batching import load_frames
+
+
+def load_video_frames(path, sample_fps, max_frames):
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise Exception(f"Cannot open video file '{path}'.")
+    video_fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    frames = []
+    for _, _, frame in sample_frames(capture, video_fps, sample_fps):
+        frames.append(frame)
+        if len(frames) >= max_frames:
+            break
+    capture.release()
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the detector cascade with the DETR-only pipeline.")
+    parser.add_argument("--video", default=None, help="A recorded video. Frames are sampled at `--fps`.")
+    parser.add_argument("--fps", type=float, default=1.0)
+    parser.add_argument("--frames-dir", default=None, help="Directory with saved frames, used if no video is given.")
+    parser.add_argument("--num-frames", type=int, default=200)
+    parser.add_argument("--animal-type", default="bird")
+    parser.add_argument("--target-classes", nargs="+", default=None,
+                        help="Expected classes of the pre-detector. Taken from `cascade_target_classes` if omitted.")
+    parser.add_argument("--mode", choices=("frame", "crops"), default="frame")
+    parser.add_argument("--min-confidence", type=float, default=cascade_min_confidence)
+    parser.add_argument("--confident-threshold", type=float, default=cascade_confident_threshold)
+    parser.add_argument("--suspect-threshold", type=float, default=cascade_suspect_threshold)
+    parser.add_argument("--crop-margin", type=float, default=cascade_crop_margin)
+    args = parser.parse_args()
+
+    target_classes = args.target_classes or cascade_target_classes.get(args.animal_type)
+    if not target_classes:
+        raise Exception(f"No target classes of the pre-detector for '{args.animal_type}'.")
+
+    pre_detector = SsdDetector()
+    if not pre_detector.is_available():
+        raise Exception("Pre-detector files are not found.")
+    cascade = DetectorCascade(pre_detector, mode=args.mode, min_confidence=args.min_confidence,
+                              confident_threshold=args.confident_threshold, suspect_threshold=args.suspect_threshold,
+                              crop_margin=args.crop_margin, target_classes={args.animal_type: target_classes})
+
+    if args.video is not None:
+        frames = load_video_frames(args.video, args.fps, args.num_frames)
+    else:
+        frames = load_frames(args.frames_dir, args.num_frames, 1280, 720)
+    unexpected_mask = model.get_unexpected_mask(args.animal_type)
+
+    # Warm-up of both models
+    model.detect_animal(frames[0])
+    pre_detector.detect(frames[0], args.min_confidence)
+
+    reference_alerts, cascade_alerts, missed, false_alerts, skipped = 0, 0, 0, 0, 0
+    detr_time, cascade_time = 0.0, 0.0
+    for frame in frames:
+        start_time = time.perf_counter()
+        reference = model.detect_animal(frame)
+        frame_detr_time = time.perf_counter() - start_time
+        detr_time += frame_detr_time
+
+        # In the 'frame' mode DETR would give the same result, so its time is added instead of running it again.
+        # Crops are analyzed for real
+        def detect(image, crops=None):
+            if crops is not None:
+                return detect_in_regions(image, {'roi': crops, 'tiles': (1, 1)})
+            ran_detr.append(True)
+            return reference
+
+        ran_detr = []
+        skipped_before = cascade.stats(args.animal_type)['skipped']
+        start_time = time.perf_counter()
+        result = cascade.detect(frame, args.animal_type, detect)
+        cascade_time += time.perf_counter() - start_time + (frame_detr_time if ran_detr else 0.0)
+        skipped += cascade.stats(args.animal_type)['skipped'] > skipped_before
+
+        is_reference_alert = bool(unexpected_mask[reference.class_ids].any())
+        is_cascade_alert = bool(unexpected_mask[result.class_ids].any())
+        reference_alerts += is_reference_alert
+        cascade_alerts += is_cascade_alert
+        missed += is_reference_alert and not is_cascade_alert
+        false_alerts += is_cascade_alert and not is_reference_alert
+
+    num_frames = len(frames)
+    print(f"frames: {num_frames}, mode: {args.mode}, target classes: {target_classes}")
+    print(f"alerts: {reference_alerts} with DETR only, {cascade_alerts} with the cascade")
+    print(f"alert recall: {(reference_alerts - missed) / reference_alerts if reference_alerts else 1.0:.3f} "
+          f"({missed} missed), false alerts: {false_alerts}")
+    print(f"DETR skipped for {skipped / num_frames:.1%} of frames")
+    print(f"time per frame: {detr_time / num_frames * 1000:.1f} ms with DETR only, "
+          f"{cascade_time / num_frames * 1000:.1f} ms with the cascade")
+
+
+if __name__ == "__main__":
+    main()
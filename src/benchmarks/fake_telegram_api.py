@@ -0,0 +1,182 @@
+"""
+A local fake Telegram Bot API server for benchmarks. It serves simulated updates through `getUpdates`,
+answers the methods used by the bot and records every request with its time, so latency can be measured
+without Telegram.
+"""
+import asyncio
+import itertools
+import json
+import threading
+import time
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+
+class FakeTelegramApi:
+    """
+    Fake Bot API server running in a background thread.
+
+    Attributes:
+        host (str): Host the server listens on.
+        port (int): Port the server listens on.
+        api_url (str): URL template for `telebot.asyncio_helper.API_URL` / `telebot.apihelper.API_URL`.
+        requests (list): Recorded requests as tuples (time, method, chat_id, params).
+        rate_limit_every (int): If positive, every n-th `sendPhoto`/`sendMediaGroup` request is answered with 429.
+        retry_after (int): Value of `retry_after` in 429 responses.
+
+    Methods:
+        start: Start the server.
+        stop: Stop the server.
+        add_message: Simulate a text message from a user.
+        add_callback: Simulate a press of an inline button.
+        get_requests: Return recorded requests of a method, optionally for one chat.
+        wait_for_request: Wait until a request of a method is recorded for a chat.
+    """
+    def __init__(self, host="127.0.0.1", port=8081, rate_limit_every=0, retry_after=1):
+        self.host = host
+        self.port = port
+        self.api_url = f"http://{host}:{port}/bot{{0}}/{{1}}"
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+
+        self.requests = []
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.photo_requests = itertools.count(1)
+        self.condition = threading.Condition()  # Used for waiting for requests and updates
+
+        self.loop = None
+        self.runner = None
+        self.thread = None
+
+    def start(self):
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def add_message(self, chat_id, text):
+        update_id = next(self.update_ids)
+        self._add_update({"update_id": update_id, "message": self._message(chat_id, text)})
+        return update_id
+
+    def add_callback(self, chat_id, data):
+        update_id = next(self.update_ids)
+        self._add_update({"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "from": self._user(chat_id),
+            "message": self._message(chat_id, "menu"),
+            "chat_instance": str(chat_id),
+            "data": data,
+        }})
+        return update_id
+
+    def get_requests(self, method, chat_id=None):
+        with self.condition:
+            return [request for request in self.requests
+                    if request[1] == method and (chat_id is None or request[2] == chat_id)]
+
+    def wait_for_request(self, method, chat_id, after_time, timeout=60):
+        """
+        Returns:
+            Time of the first request of the method for the chat recorded after `after_time`. `None` on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for request_time, request_method, request_chat_id, _ in self.requests:
+                    if request_method == method and request_chat_id == chat_id and request_time >= after_time:
+                        return request_time
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    return None
+                self.condition.wait(remaining_time)
+
+    def _add_update(self, update):
+        with self.condition:
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    def _run(self, started):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/bot{token}/{method}", self._handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(self.runner.setup())
+        self.loop.run_until_complete(web.TCPSite(self.runner, self.host, self.port).start())
+
+        started.set()
+        self.loop.run_forever()
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.can_read_body and request.method == "POST":
+            for key, value in (await request.post()).items():
+                params[key] = value if isinstance(value, str) else value.file.read()
+        elif request.can_read_body:
+            params.update(parse_qsl(await request.text()))  # `telebot` sends requests without files as GET with a form
+
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        with self.condition:
+            self.requests.append((time.monotonic(), method, chat_id, params))
+            self.condition.notify_all()
+
+        if method == "getUpdates":
+            return self._ok(await self._get_updates(int(params.get("offset", 0)), float(params.get("timeout", 0))))
+        if method == "getMe":
+            return self._ok({"id": 1, "is_bot": True, "first_name": "Fake bot", "username": "fake_bot"})
+        if method in ("deleteMessage", "answerCallbackQuery", "deleteWebhook"):
+            return self._ok(True)
+        if method in ("sendPhoto", "sendMediaGroup") and self.rate_limit_every > 0 \
+                and next(self.photo_requests) % self.rate_limit_every == 0:
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": f"Too Many Requests: retry after {self.retry_after}",
+                                      "parameters": {"retry_after": self.retry_after}}, status=429)
+        if method == "sendPhoto":
+            return self._ok(self._photo_message(chat_id))
+        if method == "sendMediaGroup":
+            return self._ok([self._photo_message(chat_id) for _ in json.loads(params["media"])])
+        return self._ok(self._message(chat_id, params.get("text")))
+
+    async def _get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.condition:
+                updates = [update for update in self.updates if update["update_id"] >= offset]
+            if updates or time.monotonic() >= deadline:
+                return updates
+            await asyncio.sleep(0.01)
+
+    def _message(self, chat_id, text):
+        message = {"message_id": next(self.message_ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}, "from": self._user(chat_id)}
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return message
+
+    def _photo_message(self, chat_id):
+        message = self._message(chat_id, None)
+        message["photo"] = [{"file_id": f"photo-{message['message_id']}", "file_unique_id": str(message["message_id"]),
+                             "width": 1280, "height": 720}]
+        return message
+
+    @staticmethod
+    def _user(chat_id):
+        return {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"}
+
+    @staticmethod
+    def _ok(result):
+        return web.json_response({"ok": True, "result": result})
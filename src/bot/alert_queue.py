@@ -0,0 +1,353 @@
+import random
+import threading
+import time
+from collections import deque
+
+from telebot import types
+
+from static.settings import (alert_queue_max_size, alert_queue_workers, alert_chat_rate, alert_chat_burst,
+                             alert_global_rate, alert_global_burst, alert_max_group_size, alert_max_retries,
+                             alert_retry_delay, alert_max_retry_delay)
+from monitoring.logs import get_logger
+from monitoring.metrics import registry, stage_seconds, photos_sent_total
+from monitoring.profiling import profiler
+
+logger = get_logger(__name__)
+
+alert_delivery_seconds = registry.histogram("animal_detection_alert_delivery_seconds",
+                                            "Time from queueing a photo until it is delivered to a chat.",
+                                            buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+telegram_requests_total = registry.counter("animal_detection_telegram_requests_total",
+                                           "Requests sending photos to Telegram, by kind ('photo' or 'media_group') "
+                                           "and result ('sent', 'rate_limited', 'failed').", ("kind", "result"))
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average with bursts of up to `capacity` requests.
+    Not thread-safe, the owner holds a lock.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """
+        Returns:
+            Time in seconds until a request is allowed. 0 if it is allowed now.
+        """
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class Alert:
+    """
+    A photo of a stream which is sent to several chats. The photo is uploaded once, the other chats get it
+    by the `file_id` returned by Telegram.
+
+    Attributes:
+        bot: An instance of the Telegram bot which sends the photo.
+        stream_key: A key of the stream the photo was taken from.
+        photo: The image encoded into JPEG.
+        caption: A caption of the photo.
+        file_id: Telegram `file_id` of the uploaded photo. `None` until the photo is uploaded.
+        is_uploading (bool): Whether the photo is being uploaded to some chat right now.
+        remaining (int): Number of chats the photo is not delivered to yet (and not given up).
+        on_uploaded: A function called once with `file_id`, or with `None` if the photo was not delivered anywhere.
+        created (float): Time when the photo was queued.
+    """
+    def __init__(self, bot, stream_key, photo, caption, on_uploaded):
+        self.bot = bot
+        self.stream_key = stream_key
+        self.photo = photo
+        self.caption = caption
+        self.file_id = None
+        self.is_uploading = False
+        self.remaining = 0
+        self.on_uploaded = on_uploaded
+        self.is_reported = False
+        self.created = time.monotonic()
+
+
+class ChatQueue:
+    """
+    Photos waiting for one chat.
+
+    Attributes:
+        deliveries (deque): Pairs (alert, number of failed attempts) in the order they should be sent.
+        bucket: An instance of `TokenBucket` limiting the requests to the chat.
+        not_before (float): Time before which nothing is sent to the chat, e.g. after 429.
+        is_sending (bool): Whether a request to the chat is in progress. Requests to a chat are not run in parallel.
+    """
+    def __init__(self, rate, burst):
+        self.deliveries = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.not_before = 0.0
+        self.is_sending = False
+
+
+class AlertQueue:
+    """
+    Bounded queue of photos sent to chats by background threads, so daemon processes never wait for Telegram.
+    Requests are limited by a token bucket of each chat and by a global one. When several photos are waiting
+    for a chat, they are sent together as one media group. Failed requests are retried with exponential backoff,
+    and after 429 the chat is paused for the `retry_after` returned by Telegram.
+
+    Attributes:
+        max_size (int): Maximum number of waiting deliveries. New deliveries are dropped when the queue is full.
+        workers (int): Number of sending threads.
+        chat_rate (float): Requests per second allowed for one chat.
+        chat_burst (int): Maximum burst of requests to one chat.
+        max_group_size (int): Maximum number of photos in one media group (at most 10 in Telegram).
+        max_retries (int): Number of retries of a delivery before it is given up. Retries after 429 are not counted:
+            the photo waits for the `retry_after` of Telegram as many times as needed.
+        retry_delay (float): Delay in seconds before the first retry.
+        max_retry_delay (float): Maximum delay in seconds between retries.
+
+    Methods:
+        submit: Queue a photo for several chats.
+        depth: Return the number of waiting deliveries.
+        flush: Wait until all queued photos are sent or given up.
+        close: Stop the sending threads.
+    """
+    def __init__(self, max_size=10000, workers=4, chat_rate=1.0, chat_burst=2, global_rate=25.0, global_burst=25,
+                 max_group_size=10, max_retries=5, retry_delay=1.0, max_retry_delay=60.0):
+        self.max_size = max_size
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_group_size = max_group_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chats = {}  # Maps chat ID to `ChatQueue`. Served chats are moved to the end, so chats take turns
+        self.size = 0  # Number of waiting deliveries
+        self.in_flight = 0  # Number of deliveries being sent
+        self.condition = threading.Condition()
+        self.threads = []
+        self.is_stopped = False
+
+    def submit(self, bot, stream_key, photo, caption, chat_ids, on_uploaded=None):
+        """
+        Args:
+            bot: An instance of the Telegram bot.
+            stream_key: A key of the stream the photo was taken from.
+            photo: The image encoded into JPEG.
+            caption: A caption of the photo.
+            chat_ids: IDs of the chats the photo is sent to.
+            on_uploaded: A function called with the `file_id` of the photo after the first successful upload,
+                or with `None` if the photo is not delivered to any chat. Usually called in a sending thread.
+
+        Returns:
+            The number of chats the photo is queued for.
+        """
+        chat_ids = list(chat_ids)
+        alert = Alert(bot, stream_key, photo, caption, on_uploaded)
+        queued = 0
+        with self.condition:
+            self._start_workers()
+            for chat_id in chat_ids:
+                if self.size >= self.max_size:
+                    break
+                chat = self.chats.get(chat_id)
+                if chat is None:
+                    chat = self.chats[chat_id] = ChatQueue(self.chat_rate, self.chat_burst)
+                chat.deliveries.append((alert, 0))
+                self.size += 1
+                queued += 1
+            alert.remaining = queued
+            self.condition.notify_all()
+
+        dropped = len(chat_ids) - queued
+        if dropped:
+            photos_sent_total.inc(dropped, stream=stream_key, result='dropped')
+            logger.warning(f"The alert queue is full, the photo is not sent to {dropped} chat(s).",
+                           extra={"stream": stream_key})
+        if queued == 0 and on_uploaded is not None:
+            on_uploaded(None)
+        return queued
+
+    def depth(self):
+        with self.condition:
+            return self.size
+
+    def flush(self, timeout=None):
+        """
+        Returns:
+            `True` if the queue became empty, `False` on timeout.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.size == 0 and self.in_flight == 0, timeout)
+
+    def close(self):
+        with self.condition:
+            self.is_stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _start_workers(self):
+        # The threads are started on the first photo, so importing the module does not start them
+        if self.threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._send_batches, name=f"alert-sender-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _send_batches(self):
+        while True:
+            with self.condition:
+                batch = self._take_batch()
+            if batch is None:
+                return
+            self._send(*batch)
+
+    def _take_batch(self):
+        # Called with `self.condition` held. Waits until some chat may get a request and takes its photos
+        while not self.is_stopped:
+            now = time.monotonic()
+            wait_time = None
+            for chat_id, chat in self.chats.items():
+                if chat.is_sending or not chat.deliveries:
+                    continue
+                head = chat.deliveries[0][0]
+                if head.file_id is None and head.is_uploading:
+                    continue  # Another chat is uploading the photo, this one will get it by `file_id`
+                chat_wait_time = max(chat.not_before - now, chat.bucket.wait_time(now), self.global_bucket.wait_time(now))
+                if chat_wait_time > 0:
+                    wait_time = chat_wait_time if wait_time is None else min(wait_time, chat_wait_time)
+                    continue
+
+                deliveries = []
+                while chat.deliveries and len(deliveries) < self.max_group_size:
+                    alert = chat.deliveries[0][0]
+                    if alert.bot is not head.bot or (alert.file_id is None and alert.is_uploading):
+                        break
+                    deliveries.append(chat.deliveries.popleft())
+                for alert, _ in deliveries:
+                    alert.is_uploading |= alert.file_id is None
+
+                chat.bucket.take(now)
+                self.global_bucket.take(now)
+                chat.is_sending = True
+                self.size -= len(deliveries)
+                self.in_flight += len(deliveries)
+                self.chats[chat_id] = self.chats.pop(chat_id)
+                return chat_id, chat, deliveries
+            self.condition.wait(wait_time)
+        return None
+
+    def _send(self, chat_id, chat, deliveries):
+        bot = deliveries[0][0].bot
+        kind = 'photo' if len(deliveries) == 1 else 'media_group'
+        try:
+            with profiler.attribute([alert.stream_key for alert, _ in deliveries]), stage_seconds.time(stage='send'):
+                if kind == 'photo':
+                    alert = deliveries[0][0]
+                    messages = [bot.send_photo(chat_id, alert.file_id or alert.photo, alert.caption)]
+                else:
+                    messages = bot.send_media_group(chat_id, [types.InputMediaPhoto(alert.file_id or alert.photo,
+                                                                                    caption=alert.caption)
+                                                              for alert, _ in deliveries])
+        except Exception as e:
+            self._retry_or_give_up(chat_id, chat, deliveries, kind, e)
+            return
+        telegram_requests_total.inc(kind=kind, result='sent')
+
+        now = time.monotonic()
+        with self.condition:
+            for (alert, _), message in zip(deliveries, messages):
+                if alert.file_id is None:
+                    alert.file_id = message.photo[-1].file_id  # The largest size of the uploaded photo
+                alert.is_uploading = False
+            self._release(chat, deliveries)
+        for alert, _ in deliveries:
+            photos_sent_total.inc(stream=alert.stream_key, result='sent')
+            alert_delivery_seconds.observe(now - alert.created)
+        self._finish([alert for alert, _ in deliveries])
+
+    def _retry_or_give_up(self, chat_id, chat, deliveries, kind, error):
+        error_code = getattr(error, 'error_code', None)
+        if error_code == 429:
+            parameters = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+            delay = parameters.get('retry_after', self.retry_delay)
+            telegram_requests_total.inc(kind=kind, result='rate_limited')
+        elif error_code is not None and 400 <= error_code < 500:
+            delay = None  # The chat cannot receive messages (e.g. the bot is blocked), retries would not help
+            telegram_requests_total.inc(kind=kind, result='failed')
+        else:
+            attempts = max(attempts for _, attempts in deliveries)
+            delay = min(self.max_retry_delay, self.retry_delay * 2 ** attempts) * random.uniform(0.5, 1.0)
+            telegram_requests_total.inc(kind=kind, result='failed')
+
+        # Under sustained rate limiting the photo is delayed rather than lost
+        counts_attempt = error_code != 429
+        retried, given_up = [], []
+        for alert, attempts in deliveries:
+            if delay is None or (counts_attempt and attempts >= self.max_retries):
+                given_up.append((alert, attempts))
+            else:
+                retried.append((alert, attempts + counts_attempt))
+        with self.condition:
+            for alert, _ in deliveries:
+                alert.is_uploading = False
+            chat.deliveries.extendleft(reversed(retried))  # Retried photos keep their place in the order
+            self.size += len(retried)
+            if retried:
+                chat.not_before = time.monotonic() + delay
+            self._release(chat, deliveries)
+
+        if retried:
+            logger.info(f"Failed to send {len(retried)} photo(s) to chat {chat_id}, retrying in {delay:.1f} s: {error}")
+        if given_up:
+            for alert, _ in given_up:
+                photos_sent_total.inc(stream=alert.stream_key, result='failed')
+            logger.warning(f"Failed to send {len(given_up)} photo(s) to chat {chat_id}: {error}",
+                           extra={"stream": given_up[0][0].stream_key})
+            self._finish([alert for alert, _ in given_up])
+
+    def _release(self, chat, deliveries):
+        # Called with `self.condition` held after a request to the chat is finished
+        chat.is_sending = False
+        self.in_flight -= len(deliveries)
+        self.condition.notify_all()
+
+    def _finish(self, alerts):
+        # Each of the alerts is delivered to one chat or given up for it. `on_uploaded` is called for the alerts
+        # which got their `file_id` or are given up for all chats
+        reported = []
+        with self.condition:
+            for alert in alerts:
+                alert.remaining -= 1
+                if not alert.is_reported and (alert.file_id is not None or alert.remaining <= 0):
+                    alert.is_reported = True
+                    reported.append(alert)
+        for alert in reported:
+            if alert.on_uploaded is None:
+                continue
+            try:
+                alert.on_uploaded(alert.file_id)
+            except Exception as e:
+                logger.error(f"Failed to handle a sent photo: {e}", extra={"stream": alert.stream_key})
+
+
+# The queue shared by all daemon processes
+alert_queue = AlertQueue(max_size=alert_queue_max_size, workers=alert_queue_workers, chat_rate=alert_chat_rate,
+                         chat_burst=alert_chat_burst, global_rate=alert_global_rate, global_burst=alert_global_burst,
+                         max_group_size=alert_max_group_size, max_retries=alert_max_retries,
+                         retry_delay=alert_retry_delay, max_retry_delay=alert_max_retry_delay)
+registry.gauge("animal_detection_alert_queue_depth", "Photos waiting to be sent to chats.", function=alert_queue.depth)
@@ -1,40 +1,166 @@
-from img_processing.process_stream import start_camgear_stream, stop_camgear_stream
-from static.sources import video_sources
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from img_processing.process_stream import start_video_stream, stop_video_stream
+from static.sources import stream_registry
+from static.settings import stream_idle_ttl, max_open_streams
+from monitoring.logs import get_logger
+from monitoring.metrics import registry
+from monitoring.profiling import profiler
+
+logger = get_logger(__name__)
+
+streams_closed_total = registry.counter("animal_detection_streams_closed_total",
+                                        "Stream decoders closed, by reason: 'idle', 'evicted' or 'closed'.", ("reason",))
 
 
 class Animals:
     """
     Responsible for opening/closing YouTube streams and storing opened streams in a dictionary.
+    A stream is opened when its frames are needed for the first time (by the daemon process of a subscribed stream
+    or by `/now`) and is shared by all its users. A stream which is not used for `idle_ttl` seconds is closed, and
+    at most `max_open` streams are open at once: to open one more, the least recently used stream which is not
+    being read right now is closed. So memory and decoding CPU grow with the streams in use, not with the registry.
 
     Attributes:
-        opened_streams (dict): A dictionary that maps animal type to an opened live stream. Keys are the same as in the `video_sources` dictionary. If no stream is opened, value is `None`.
+        opened_streams (OrderedDict): Maps stream key to an opened live stream (`FrameGrabber`),
+            the least recently used stream first.
+        users (dict): Maps stream key to the number of threads reading the stream right now.
+        last_used (dict): Maps stream key to the time when the stream was used last.
+        idle_ttl (float): Time in seconds after which an unused stream is closed.
+        max_open (int): Maximum number of opened streams.
 
     Methods:
-        open_stream: Open a stream by creating a CamGear instance.
-        close_stream: Close a stream by stopping the corresponding CamGear instance.
+        acquire_stream: Return an opened stream, opening it if needed. The stream is not closed until it is released.
+        release_stream: Release a stream returned by `acquire_stream`.
+        releasing: A context manager which releases an acquired stream on exit.
+        use_stream: A context manager which acquires a stream and releases it on exit.
+        close_stream: Close a stream. A stream being read is closed when it is released.
+        close_idle_streams: Close streams which have not been used for `idle_ttl` seconds.
+        open_count: Return the number of opened streams.
     """
-    def __init__(self):
-        self.opened_streams = {animal_type: None for animal_type in video_sources.keys()}
-
-    def open_stream(self, animal_type):
-        # Check that the given animal type is valid
-        if animal_type not in video_sources.keys():
-            raise Exception(f"Animal of type '{animal_type}' is not considered by our bot.")
-
-        # Return if the stream is already opened
-        if self.opened_streams[animal_type] is not None:
-            return
-
-        source_path = video_sources[animal_type]    # Get source path
-        stream = start_camgear_stream(source_path)  # Open stream
-        self.opened_streams[animal_type] = stream   # Update the corresponding field
-
-    def close_stream(self, animal_type):
-        # Check that the given animal type is valid
-        if animal_type not in video_sources.keys():
-            raise Exception(f"Animal of type '{animal_type}' is not considered by our bot.")
-
-        stream = self.opened_streams[animal_type]
-        if stream is not None:                       # Check that the stream is opened
-            stop_camgear_stream(stream)              # Close stream
-            self.opened_streams[animal_type] = None  # Update the corresponding field
+    def __init__(self, idle_ttl=stream_idle_ttl, max_open=max_open_streams):
+        self.idle_ttl = idle_ttl
+        self.max_open = max_open
+        self.opened_streams = OrderedDict()
+        self.users = {}
+        self.last_used = {}
+        self.stale_streams = set()  # Keys of streams which are closed when the last user releases them
+        self.opening_locks = {}  # A stream is opened by one thread, the others wait for it
+        self.lock = threading.Lock()  # Used for updating the dictionaries
+
+    def acquire_stream(self, stream_key):
+        source_path = stream_registry.source(stream_key)
+        if source_path is None:
+            raise Exception(f"Animal of type '{stream_key}' is not considered by our bot.")
+
+        with self._opening_lock(stream_key):
+            with self.lock:
+                stream = self.opened_streams.get(stream_key)
+                if stream is not None:
+                    self._use(stream_key)
+                    return stream
+
+            # Opening takes a while, other streams are used meanwhile
+            stream = start_video_stream(source_path)
+            profiler.set_stream(stream_key, stream.thread)  # Decoding time is attributed to the stream
+            with self.lock:
+                self.opened_streams[stream_key] = stream
+                self._use(stream_key)
+                evicted = self._take_least_recently_used()
+                open_count = len(self.opened_streams)
+
+        logger.info(f"The stream is opened, {open_count} stream(s) are open.", extra={"stream": stream_key})
+        for evicted_key, evicted_stream in evicted:
+            self._stop(evicted_key, evicted_stream, 'evicted')
+        return stream
+
+    def release_stream(self, stream_key):
+        with self.lock:
+            self.users[stream_key] -= 1
+            self.last_used[stream_key] = time.monotonic()
+            stream = None
+            if self.users[stream_key] == 0 and stream_key in self.stale_streams:
+                stream = self._pop(stream_key)
+        if stream is not None:
+            self._stop(stream_key, stream, 'closed')
+
+    @contextmanager
+    def releasing(self, stream_key):
+        try:
+            yield
+        finally:
+            self.release_stream(stream_key)
+
+    @contextmanager
+    def use_stream(self, stream_key):
+        stream = self.acquire_stream(stream_key)
+        with self.releasing(stream_key):
+            yield stream
+
+    def close_stream(self, stream_key):
+        """
+        Returns:
+            `True` if the stream was closed now, `False` if it is not opened or is closed when it is released.
+        """
+        with self.lock:
+            if stream_key not in self.opened_streams:
+                return False
+            if self.users.get(stream_key, 0) > 0:
+                self.stale_streams.add(stream_key)
+                return False
+            stream = self._pop(stream_key)
+        self._stop(stream_key, stream, 'closed')
+        return True
+
+    def close_idle_streams(self):
+        """
+        Returns:
+            A list of keys of the closed streams.
+        """
+        now = time.monotonic()
+        with self.lock:
+            idle_keys = [stream_key for stream_key in self.opened_streams
+                         if self.users.get(stream_key, 0) == 0 and now - self.last_used[stream_key] >= self.idle_ttl]
+            idle_streams = [(stream_key, self._pop(stream_key)) for stream_key in idle_keys]
+        for stream_key, stream in idle_streams:
+            self._stop(stream_key, stream, 'idle')
+        return idle_keys
+
+    def open_count(self):
+        with self.lock:
+            return len(self.opened_streams)
+
+    def _opening_lock(self, stream_key):
+        with self.lock:
+            return self.opening_locks.setdefault(stream_key, threading.Lock())
+
+    def _use(self, stream_key):
+        # Called with `self.lock` held
+        self.opened_streams.move_to_end(stream_key)
+        self.users[stream_key] = self.users.get(stream_key, 0) + 1
+        self.last_used[stream_key] = time.monotonic()
+
+    def _take_least_recently_used(self):
+        # Called with `self.lock` held. Streams being read are not closed, even if there are too many streams
+        evicted = []
+        for stream_key in list(self.opened_streams):
+            if len(self.opened_streams) <= self.max_open:
+                break
+            if self.users.get(stream_key, 0) == 0:
+                evicted.append((stream_key, self._pop(stream_key)))
+        return evicted
+
+    def _pop(self, stream_key):
+        # Called with `self.lock` held
+        self.stale_streams.discard(stream_key)
+        self.last_used.pop(stream_key, None)
+        return self.opened_streams.pop(stream_key)
+
+    @staticmethod
+    def _stop(stream_key, stream, reason):
+        stop_video_stream(stream)
+        streams_closed_total.inc(reason=reason)
+        logger.info(f"The stream is closed ({reason}).", extra={"stream": stream_key})
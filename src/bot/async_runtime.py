@@ -0,0 +1,61 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import asyncio_helper
+
+from static.settings import detection_executor_workers, telegram_connection_limit, telegram_api_url
+
+# Blocking work (opening streams, detection) is done here, so the event loop keeps handling other users
+detection_executor = ThreadPoolExecutor(max_workers=detection_executor_workers, thread_name_prefix="detection")
+
+
+def configure_http_session():
+    """
+    Configures the HTTP session used by the asynchronous bot. All requests to Telegram go through one pooled
+    `aiohttp` session with at most `telegram_connection_limit` connections. If `telegram_api_url` is set,
+    requests go to that server instead of Telegram (e.g. a local fake Bot API in benchmarks).
+    """
+    asyncio_helper.REQUEST_LIMIT = telegram_connection_limit
+    if telegram_api_url is not None:
+        asyncio_helper.API_URL = telegram_api_url
+
+
+async def run_blocking(function, *args):
+    """
+    Runs a blocking function in `detection_executor` and waits for its result without blocking the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(detection_executor, function, *args)
+
+
+class SyncBot:
+    """
+    Synchronous facade of the asynchronous bot for daemon threads. Each call is scheduled on the event loop
+    of the bot, and the calling thread waits for its result.
+
+    Attributes:
+        bot: An instance of `AsyncTeleBot`.
+        loop: The event loop where the bot is running. Set when the bot is started.
+
+    Methods:
+        send_photo: Send a photo and return the sent message.
+        send_media_group: Send several photos as one message and return the sent messages.
+        send_message: Send a text message and return the sent message.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.loop = None
+
+    def send_photo(self, *args, **kwargs):
+        return self._call(self.bot.send_photo(*args, **kwargs))
+
+    def send_media_group(self, *args, **kwargs):
+        return self._call(self.bot.send_media_group(*args, **kwargs))
+
+    def send_message(self, *args, **kwargs):
+        return self._call(self.bot.send_message(*args, **kwargs))
+
+    def _call(self, coroutine):
+        if self.loop is None:
+            coroutine.close()
+            raise Exception("The bot is not started yet.")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
@@ -1,19 +1,38 @@
-import os
+import time
+start_time = time.perf_counter()
+
+import asyncio
 import config
+from datetime import datetime
+from functools import partial
 
-import telebot
+from telebot.async_telebot import AsyncTeleBot
 from telebot import types
 
-from animals import Animals
+from subscriptions import subscriptions
+from static.sources import stream_registry
 from static.word_declensions import get_nominative, get_genitive, get_instrumental, get_emoji
-from img_processing.process_stream import get_current_frame
-from daemon_processes import start_daemon_process, terminate_daemon_process
+from static.settings import (model_warm_up, metrics_host, metrics_port, stream_maintenance_interval, cluster_enabled,
+                             profile_duration, profile_admin_chat_ids, alert_flush_timeout)
+from alert_queue import alert_queue
+from event_store import event_store
+from async_runtime import configure_http_session, run_blocking, SyncBot
+from monitoring.logs import get_logger
+from monitoring.metrics import registry, start_metrics_server
+from monitoring.profiling import profiler, install_signal_handler
+
 
+logger = get_logger(__name__)
 
-animal_detection = Animals()
+# Worker processes of the 'process' inference backend import this module as `__mp_main__`, so nothing is created
+# on import: the values are set by `create_bot`, and modules which load the model are imported inside functions
+bot = None
+sync_bot = None  # Used by daemon processes which run in separate threads
+animal_detection = None  # Opens streams on demand and closes idle ones
 
-bot = telebot.TeleBot(config.BOT_TOKEN)
-available_commands = ['/add', '/remove', '/animals', '/now', '/help']
+# In the cluster mode, streams are analyzed by detection workers, and the bot only sends their results to Telegram
+coordinator = None
+available_commands = ['/add', '/remove', '/animals', '/now', '/history', '/help']
 
 
 def generate_cmds_descr():
@@ -21,67 +40,62 @@ def generate_cmds_descr():
           "🙈 Чтобы перестать следить за животным - введите /remove и выберите животное.\n" +
           "🔍 Чтобы узнать за кем вы следите - введите /animals.\n" +
           "👀 Чтобы подсмотреть за кем-то прямо сейчас /now.\n" +
+          "📜 Чтобы узнать, что неожиданного было сегодня, введите /history.\n" +
           "📖 Чтобы увидеть список комманд, введите /help.\n")
 
 
-@bot.message_handler(commands=['start'])
-def send_welcome(message):
-    sticker = open('sticker.webp', 'rb')
-    bot.send_sticker(message.chat.id, sticker)
-    bot.send_message(message.chat.id,
+async def send_welcome(message):
+    with open('sticker.webp', 'rb') as sticker:
+        await bot.send_sticker(message.chat.id, sticker)
+    await bot.send_message(message.chat.id,
                      ("<b>🐾Добро пожаловать в Animal Detection Bot! 🐾</b> \n \n"
                       "Мы сообщаем интересную информацию о животных в зоопарке.\n \n"
                       f'{generate_cmds_descr()}'
                       ), parse_mode='html')
 
 
-@bot.message_handler(commands=['help'])
-def send_welcome(message):
-    bot.send_message(message.chat.id, generate_cmds_descr())
+async def send_help(message):
+    await bot.send_message(message.chat.id, generate_cmds_descr())
 
 
-@bot.message_handler(commands=['add'])
-def choose_animal(message):
+async def choose_animal_to_add(message):
     markup = types.InlineKeyboardMarkup()
 
-    # Create buttons for animal types which streams are not opened yet
-    for animal_type, opened_stream in animal_detection.opened_streams.items():
-        if opened_stream is None:
+    # Create buttons for animal types which the chat is not subscribed to yet
+    subscribed_animal_types = subscriptions.get_animal_types(message.chat.id)
+    for animal_type in stream_registry.keys():
+        if animal_type not in subscribed_animal_types:
             btn = types.InlineKeyboardButton(get_nominative(animal_type), callback_data=f"add_{animal_type}")
             markup.add(btn)
 
     # Send message to the bot
     if markup.keyboard:
-        bot.send_message(message.chat.id, "Выберите за кем хотите следить:", reply_markup=markup)
+        await bot.send_message(message.chat.id, "Выберите за кем хотите следить:", reply_markup=markup)
     else:
-        bot.send_message(message.chat.id, "Вы уже следите за всеми доступными животными.")
+        await bot.send_message(message.chat.id, "Вы уже следите за всеми доступными животными.")
 
 
-@bot.message_handler(commands=['remove'])
-def choose_animal(message):
+async def choose_animal_to_remove(message):
     markup = types.InlineKeyboardMarkup()
 
-    # Create buttons for animal types which streams are opened
-    for animal_type, opened_stream in animal_detection.opened_streams.items():
-        if opened_stream is not None:
-            btn = types.InlineKeyboardButton(get_nominative(animal_type), callback_data=f"rem_{animal_type}")
-            markup.add(btn)
+    # Create buttons for animal types which the chat is subscribed to
+    for animal_type in subscriptions.get_animal_types(message.chat.id):
+        btn = types.InlineKeyboardButton(get_nominative(animal_type), callback_data=f"rem_{animal_type}")
+        markup.add(btn)
 
     # Send message to the bot
     if markup.keyboard:
-        bot.send_message(message.chat.id, "Выберите за кем не хотите следить:", reply_markup=markup)
+        await bot.send_message(message.chat.id, "Выберите за кем не хотите следить:", reply_markup=markup)
     else:
-        bot.send_message(message.chat.id, "Вы еще не выбрали животных.")
+        await bot.send_message(message.chat.id, "Вы еще не выбрали животных.")
 
 
-@bot.message_handler(commands=['animals'])
-def show_tracked_animals(message):
+async def show_tracked_animals(message):
     tracked_animals = []
 
-    # Add names of animal types which streams are opened
-    for animal_type, opened_stream in animal_detection.opened_streams.items():
-        if opened_stream:
-            tracked_animals.append(f"{get_emoji(animal_type)} {get_instrumental(animal_type)}")
+    # Add names of animal types which the chat is subscribed to
+    for animal_type in subscriptions.get_animal_types(message.chat.id):
+        tracked_animals.append(f"{get_emoji(animal_type)} {get_instrumental(animal_type)}")
 
     # Generate message
     if tracked_animals:
@@ -90,30 +104,69 @@ def show_tracked_animals(message):
         response = "Вы пока не следите ни за одним животным."
 
     # Send message to the bot
-    bot.send_message(message.chat.id, response)
+    await bot.send_message(message.chat.id, response)
 
 
-@bot.message_handler(commands=['now'])
-def choose_animal(message):
+async def choose_animal_to_watch(message):
     markup = types.InlineKeyboardMarkup()
 
-    # Create buttons for animal types which streams are opened
-    for animal_type, opened_stream in animal_detection.opened_streams.items():
-        if opened_stream is not None:
-            btn = types.InlineKeyboardButton(get_nominative(animal_type), callback_data=f"current_{animal_type}")
-            markup.add(btn)
+    # Create buttons for animal types which the chat is subscribed to
+    for animal_type in subscriptions.get_animal_types(message.chat.id):
+        btn = types.InlineKeyboardButton(get_nominative(animal_type), callback_data=f"current_{animal_type}")
+        markup.add(btn)
 
     # Send message to the bot
     if markup.keyboard:
-        bot.send_message(message.chat.id, "Выберите за кем хотите подсмотреть прямо сейчас:", reply_markup=markup)
+        await bot.send_message(message.chat.id, "Выберите за кем хотите подсмотреть прямо сейчас:", reply_markup=markup)
     else:
-        bot.send_message(message.chat.id, "Вы еще не выбрали животных.")
-
-
-@bot.message_handler(func=lambda message: True)
-def handle_unknown_command(message):
+        await bot.send_message(message.chat.id, "Вы еще не выбрали животных.")
+
+
+async def show_history(message):
+    animal_types = subscriptions.get_animal_types(message.chat.id)
+    if not animal_types:
+        await bot.send_message(message.chat.id, "Вы еще не выбрали животных.")
+        return
+
+    # The history is read from the event store, the model is not run again
+    since = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    for animal_type in animal_types:
+        counts = await run_blocking(event_store.class_counts, animal_type, since)
+        if not counts:
+            await bot.send_message(message.chat.id,
+                                   f"{get_emoji(animal_type)} Сегодня у {get_genitive(animal_type)} ничего неожиданного.")
+            continue
+
+        # Events are stored for every analyzed frame, so the counts are numbers of frames, not of separate objects
+        lines = [f"    {obj_type!r}: на {count} {'кадре' if count % 10 == 1 and count % 100 != 11 else 'кадрах'}, "
+                 f"последний раз в {datetime.fromtimestamp(last_time).strftime('%H:%M')}"
+                 for obj_type, count, last_time in counts]
+        await bot.send_message(message.chat.id,
+                               f"{get_emoji(animal_type)} Сегодня у {get_genitive(animal_type)} обнаружены:\n" + "\n".join(lines))
+
+        # The last sent photo is forwarded by its `file_id`
+        thumbnail = await run_blocking(event_store.latest_thumbnail, animal_type, since)
+        if thumbnail is not None:
+            await bot.send_photo(message.chat.id, thumbnail)
+
+
+async def profile(message):
+    # Not listed in the help: only chats from `profile_admin_chat_ids` may profile the bot
+    arguments = message.text.split()[1:]
+    duration = float(arguments[0]) if arguments and arguments[0].replace('.', '', 1).isdigit() else profile_duration
+    directory = profiler.start(duration)
+    if directory is None:
+        await bot.send_message(message.chat.id, "Профилирование уже идёт.")
+        return
+
+    await bot.send_message(message.chat.id, f"Профилирование запущено на {duration:g} с.")
+    summary = await run_blocking(profiler.wait)
+    await bot.send_message(message.chat.id, f"Результаты сохранены в {directory}\n\n{summary}"[:4096])
+
+
+async def handle_unknown_command(message):
     if message.text not in available_commands:
-        bot.send_message(message.chat.id,
+        await bot.send_message(message.chat.id,
                          (
                              f"Неизвестная комманда '{message.text}'\n\n"
                              "Возможные комманды:\n\n"
@@ -121,42 +174,165 @@ def handle_unknown_command(message):
                          ), parse_mode='html')
 
 
-@bot.callback_query_handler(func=lambda call: True)
-def callback_query(call):
+async def callback_query(call):
     # Delete message with choice
-    bot.delete_message(call.message.chat.id, call.message.message_id)
+    await bot.delete_message(call.message.chat.id, call.message.message_id)
 
-    # Extract animal type from the callback data
-    animal_type = call.data.split("_")[1]
+    # Extract animal type from the callback data. The stream may be removed from the registry after the buttons were sent
+    animal_type = call.data.split("_", 1)[1]
+    if not stream_registry.contains(animal_type):
+        await bot.answer_callback_query(call.id, "Этот стрим больше недоступен.")
+        await bot.send_message(call.message.chat.id, "Этот стрим больше недоступен.")
+        return
 
     if call.data.startswith("add_"):
-        # Send a temporary message to the bot
-        tmp_msg = bot.send_message(call.message.chat.id, "Обрабатываем запрос...")
-        animal_detection.open_stream(animal_type)
-        # Delete the temporary message
-        bot.delete_message(call.message.chat.id, tmp_msg.id)
-        bot.send_message(call.message.chat.id, f"Теперь вы следите за {get_instrumental(animal_type)}!")
-
-        start_daemon_process(animal_type, animal_detection.opened_streams[animal_type], call.message.chat.id, bot)
+        # There is one daemon process for all subscribed chats. It opens the stream on its first frame
+        if subscriptions.subscribe(animal_type, call.message.chat.id):
+            start_detection(animal_type)
+        await bot.send_message(call.message.chat.id, f"Теперь вы следите за {get_instrumental(animal_type)}!")
 
     elif call.data.startswith("rem_"):
-        animal_detection.close_stream(animal_type)
-        bot.send_message(call.message.chat.id, f"Теперь вы не следите за {get_instrumental(animal_type)}!")
-
-        terminate_daemon_process(animal_type)
+        # The daemon process is stopped when the last subscribed chat leaves, the stream is closed when it is idle
+        if subscriptions.unsubscribe(animal_type, call.message.chat.id) and \
+                not subscriptions.get_subscribers(animal_type):
+            stop_detection(animal_type)
+        await bot.send_message(call.message.chat.id, f"Теперь вы не следите за {get_instrumental(animal_type)}!")
 
     elif call.data.startswith("current_"):
-        # Send a temporary message to the bot
-        tmp_msg = bot.send_message(call.message.chat.id, "Обрабатываем запрос...")
-        file_name = get_current_frame(animal_detection.opened_streams[animal_type])
-        with open(file_name, 'rb') as photo:
-            bot.delete_message(call.message.chat.id, tmp_msg.id)  # Delete the temporary message
-            bot.send_message(call.message.chat.id,
-                             f"Вот что происходит у {get_genitive(animal_type)} прямо сейчас!")
-            bot.send_photo(call.message.chat.id, photo)
+        # Send a temporary message to the bot. Other users are served while the stream is opened and the frame is processed
+        tmp_msg = await bot.send_message(call.message.chat.id, "Обрабатываем запрос...")
+        try:
+            photo = await run_blocking(get_current_photo, animal_type)
+        except Exception as e:
+            logger.warning(f"Failed to take the current photo: {e}", extra={"stream": animal_type})
+            await bot.edit_message_text("Не удалось получить кадр, попробуйте позже.", call.message.chat.id, tmp_msg.id)
+            return
+        await bot.delete_message(call.message.chat.id, tmp_msg.id)  # Delete the temporary message
+        await bot.send_message(call.message.chat.id,
+                               f"Вот что происходит у {get_genitive(animal_type)} прямо сейчас!")
+        await bot.send_photo(call.message.chat.id, photo)  # The photo is sent from memory
+
+
+def get_current_photo(animal_type):
+    """
+    Returns the current frame of a stream with highlighted objects. The stream is opened if it is not opened yet.
+    In the cluster mode, the photo is taken by the worker of the stream.
+    """
+    if coordinator is not None:
+        return coordinator.request_photo(animal_type)
+    from img_processing.process_stream import get_current_frame
+    with profiler.attribute([animal_type]), animal_detection.use_stream(animal_type) as opened_stream:
+        return get_current_frame(opened_stream, animal_type)
+
+
+def start_detection(animal_type):
+    """
+    Starts analyzing a stream: in a daemon process of the bot or, in the cluster mode, on one of the workers.
+    """
+    if coordinator is not None:
+        coordinator.start_stream(animal_type)
+    else:
+        from daemon_processes import start_daemon_process, report_to_subscribers
+        start_daemon_process(animal_type, animal_detection, partial(report_to_subscribers, sync_bot))
 
-        if os.path.exists(file_name):
-            os.remove(file_name)  # Remove temporarily created jpg file
+
+def stop_detection(animal_type):
+    if coordinator is not None:
+        coordinator.stop_stream(animal_type)
+    else:
+        from daemon_processes import terminate_daemon_process
+        terminate_daemon_process(animal_type)
 
 
-bot.infinity_polling()
+def update_streams(added, removed, changed):
+    """
+    Applies changes of the stream registry: daemon processes of removed streams are stopped, streams with a changed
+    source are reopened on the next frame, and daemon processes are started again for streams which came back.
+    """
+    for animal_type in removed:
+        stop_detection(animal_type)
+    for animal_type in removed + changed:
+        animal_detection.close_stream(animal_type)
+    for animal_type in added:
+        if subscriptions.get_subscribers(animal_type):
+            start_detection(animal_type)
+    if coordinator is not None:
+        coordinator.rebalance()  # Workers get the changed descriptions
+    logger.info(f"Streams are updated: {len(added)} added, {len(removed)} removed, {len(changed)} changed.")
+
+
+def create_bot():
+    """
+    Creates the bot and the objects it uses, registers the handlers and subscribes the bot to changes of
+    the stream registry. Called once before the bot is started.
+    """
+    global bot, sync_bot, animal_detection, coordinator
+    from animals import Animals
+    from cluster import Coordinator
+    from daemon_processes import report_to_subscribers
+
+    animal_detection = Animals()
+    registry.gauge("animal_detection_open_streams", "Opened stream decoders.", function=animal_detection.open_count)
+
+    configure_http_session()
+    bot = AsyncTeleBot(config.BOT_TOKEN)
+    sync_bot = SyncBot(bot)
+
+    if cluster_enabled:
+        coordinator = Coordinator(partial(report_to_subscribers, sync_bot))
+        registry.gauge("animal_detection_cluster_workers", "Connected detection workers.",
+                       function=coordinator.worker_count)
+
+    # Handlers are checked in the order of registration
+    bot.register_message_handler(send_welcome, commands=['start'])
+    bot.register_message_handler(send_help, commands=['help'])
+    bot.register_message_handler(choose_animal_to_add, commands=['add'])
+    bot.register_message_handler(choose_animal_to_remove, commands=['remove'])
+    bot.register_message_handler(show_tracked_animals, commands=['animals'])
+    bot.register_message_handler(choose_animal_to_watch, commands=['now'])
+    bot.register_message_handler(show_history, commands=['history'])
+    bot.register_message_handler(profile, commands=['profile'],
+                                 func=lambda message: message.chat.id in profile_admin_chat_ids)
+    bot.register_message_handler(handle_unknown_command, func=lambda message: True)
+    bot.register_callback_query_handler(callback_query, func=lambda call: True)
+
+    stream_registry.add_listener(update_streams)
+
+
+async def maintain_streams():
+    """
+    Reloads the stream registry when its file changes and closes streams which have not been used for a while.
+    """
+    while True:
+        await asyncio.sleep(stream_maintenance_interval)
+        try:
+            await run_blocking(stream_registry.reload)
+        except Exception as e:
+            logger.error(f"Failed to reload streams: {e}")
+        await run_blocking(animal_detection.close_idle_streams)
+
+
+async def main():
+    create_bot()
+    sync_bot.loop = asyncio.get_running_loop()
+    maintenance_task = asyncio.create_task(maintain_streams())  # A reference is kept, so the task is not collected
+    if coordinator is not None:
+        coordinator.start()
+    elif model_warm_up:
+        from img_processing.process_image import warm_up_detection
+        warm_up_detection()
+    if start_metrics_server() is not None:
+        logger.info(f"Metrics are served on http://{metrics_host}:{metrics_port}/metrics.")
+    logger.info(f"Bot is started in {time.perf_counter() - start_time:.2f} s.")
+    try:
+        await bot.infinity_polling()
+    finally:
+        # Photos are sent through the event loop, so they are sent before it is closed
+        if not await run_blocking(alert_queue.flush, alert_flush_timeout):
+            logger.warning(f"{alert_queue.depth()} photo(s) are not sent before the shutdown.")
+
+
+# The guard keeps worker processes of the 'process' inference backend from starting the bot, see `create_bot`
+if __name__ == '__main__':
+    install_signal_handler()
+    asyncio.run(main())
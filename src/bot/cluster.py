@@ -0,0 +1,432 @@
+import bisect
+import hashlib
+import hmac
+import ipaddress
+import itertools
+import json
+import socket
+import threading
+import time
+
+from static.sources import stream_registry
+from static.settings import (cluster_host, cluster_port, cluster_hash_replicas, cluster_heartbeat_timeout,
+                             cluster_request_timeout, cluster_token)
+from img_processing.detections import restore_detections
+from monitoring.logs import get_logger
+from monitoring.metrics import registry
+
+logger = get_logger(__name__)
+
+workers_lost_total = registry.counter("animal_detection_cluster_workers_lost_total",
+                                      "Detection workers disconnected, by reason: 'closed', 'timeout' or 'error'.",
+                                      ("reason",))
+streams_moved_total = registry.counter("animal_detection_cluster_streams_moved_total",
+                                       "Streams assigned to another detection worker.")
+
+
+class Connection:
+    """
+    A connection between the coordinator and a detection worker. Messages are JSON objects, one per line.
+    A message with the key 'size' is followed by a binary payload of that many bytes, e.g. a photo encoded into JPEG.
+
+    Attributes:
+        sock: A connected socket.
+
+    Methods:
+        send: Send a message with an optional payload. Can be called from several threads.
+        receive: Return the next message and its payload. `(None, None)` if the connection is closed.
+        close: Close the connection.
+    """
+    def __init__(self, sock, timeout=None):
+        self.sock = sock
+        self.sock.settimeout(timeout)  # Receiving raises `socket.timeout` if nothing comes for `timeout` seconds
+        self.reader = sock.makefile('rb')
+        self.send_lock = threading.Lock()
+
+    def send(self, message, payload=None):
+        if payload is not None:
+            message = dict(message, size=len(payload))
+        data = json.dumps(message).encode('utf-8') + b"\n" + (payload or b"")
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def receive(self):
+        line = self.reader.readline()
+        if not line:
+            return None, None
+        message = json.loads(line)
+
+        payload = None
+        if 'size' in message:
+            payload = self.reader.read(message['size'])
+            if len(payload) < message['size']:
+                return None, None  # The connection was closed in the middle of the payload
+        return message, payload
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # Wakes up the thread which is receiving from the socket
+        except OSError:
+            pass  # Already closed
+        self.reader.close()
+        self.sock.close()
+
+
+class HashRing:
+    """
+    Consistent hashing of stream keys to workers. Each worker is put on a ring at `replicas` pseudo-random points,
+    and a stream belongs to the worker of the first point after the hash of the stream key. So a joining worker takes
+    only streams from its points, and streams of a leaving worker are spread over the others. Not thread-safe.
+
+    Attributes:
+        replicas (int): Number of points of each worker.
+        hashes (list): Sorted positions of all points.
+        nodes (list): The worker of each point.
+
+    Methods:
+        add: Add a worker.
+        remove: Remove a worker.
+        get_node: Return the worker a key belongs to, `None` if there are no workers.
+    """
+    def __init__(self, replicas=cluster_hash_replicas):
+        self.replicas = replicas
+        self.hashes = []
+        self.nodes = []
+
+    def add(self, node):
+        for index in range(self.replicas):
+            position = self._hash(f"{node}#{index}")
+            point = bisect.bisect(self.hashes, position)
+            self.hashes.insert(point, position)
+            self.nodes.insert(point, node)
+
+    def remove(self, node):
+        points = [(position, other) for position, other in zip(self.hashes, self.nodes) if other != node]
+        self.hashes = [position for position, _ in points]
+        self.nodes = [other for _, other in points]
+
+    def get_node(self, key):
+        if not self.hashes:
+            return None
+        return self.nodes[bisect.bisect(self.hashes, self._hash(key)) % len(self.hashes)]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class RemoteWorker:
+    """
+    A detection worker connected to the coordinator.
+
+    Attributes:
+        worker_id (str): A unique name of the worker. A worker which connects again with the same name gets
+            the same streams.
+        connection: An instance of `Connection` to the worker.
+        address: The address the worker connected from.
+        assigned (dict): Maps key of each stream analyzed by the worker to its description sent to the worker.
+        frames (dict): Maps stream key to the number of frames taken from the stream, as of the last heartbeat.
+        open_streams (int): The number of streams opened by the worker, as of the last heartbeat.
+        last_message (float): Monotonic time of the last message from the worker.
+    """
+    def __init__(self, worker_id, connection, address):
+        self.worker_id = worker_id
+        self.connection = connection
+        self.address = address
+        self.assigned = {}
+        self.frames = {}
+        self.open_streams = 0
+        self.last_message = time.monotonic()
+
+
+def is_loopback(host):
+    """
+    Returns whether the host name or address can be reached only from this host.
+    """
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False  # A host name
+
+
+class Coordinator:
+    """
+    Distributes streams between detection workers (`worker.py`) which run the daemon processes in other processes,
+    possibly on other hosts, and passes their results to `report`. The bot process itself only talks to Telegram.
+
+    Workers connect over TCP and register with a name and the shared secret `token`. Each stream with subscribers
+    is assigned to one worker by `HashRing`. A worker which closes the connection or sends nothing (not even
+    a heartbeat) for `heartbeat_timeout` seconds is disconnected, and its streams are moved to the remaining workers.
+    Results of a stream are accepted only from the worker it is assigned to, so a worker which has lost a stream
+    cannot send duplicate alerts.
+
+    Attributes:
+        report: A function called with the stream key, an instance of `Detections`, the photo, the caption
+            and the frame time, same as the `report` of a daemon process.
+        host (str), port (int): The address the coordinator listens on. Port 0 picks a free port.
+        heartbeat_timeout (float): Time in seconds after which a silent worker is disconnected.
+        request_timeout (float): Time in seconds `request_photo` waits for the worker.
+        token (str): The secret workers register with. `None` is allowed only on a loopback address.
+        ring: An instance of `HashRing` with the connected workers.
+        workers (dict): Maps worker name to an instance of `RemoteWorker`.
+        active_streams (set): Keys of streams which should be analyzed.
+
+    Methods:
+        start: Start accepting workers.
+        stop: Stop accepting workers and disconnect them.
+        start_stream: Start analyzing a stream on one of the workers.
+        stop_stream: Stop analyzing a stream.
+        rebalance: Send workers their streams if the assignment or the stream registry has changed.
+        request_photo: Return the current frame of a stream with highlighted objects, taken by a worker.
+        worker_count: Return the number of connected workers.
+        status: Return streams and statistics of each worker.
+    """
+    def __init__(self, report, host=cluster_host, port=cluster_port, replicas=cluster_hash_replicas,
+                 heartbeat_timeout=cluster_heartbeat_timeout, request_timeout=cluster_request_timeout,
+                 token=cluster_token):
+        self.report = report
+        self.host = host
+        self.port = port
+        self.heartbeat_timeout = heartbeat_timeout
+        self.request_timeout = request_timeout
+        self.token = token
+        self.ring = HashRing(replicas)
+        self.workers = {}
+        self.active_streams = set()
+        self.owners = {}  # Maps stream key to the name of the worker it was assigned to last
+        self.waiting_streams = 0  # Active streams which have no worker, as of the last assignment
+        self.requests = {}  # Maps id of a photo request to a dictionary with its result
+        self.request_ids = itertools.count()
+        self.server = None
+        self.lock = threading.Lock()  # Used for updating the workers, the ring, the streams and the requests
+        self.assign_lock = threading.Lock()  # Assignments are sent in the order they are computed
+
+    def start(self):
+        if self.token is None and not is_loopback(self.host):
+            raise Exception(f"Detection workers on {self.host} need a cluster token, "
+                            f"set ANIMAL_DETECTION_CLUSTER_TOKEN.")
+        self.server = socket.create_server((self.host, self.port))
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self._accept_workers, args=(self.server,), daemon=True).start()
+        logger.info(f"Waiting for detection workers on {self.host}:{self.port}.")
+        return self
+
+    def stop(self):
+        server, self.server = self.server, None
+        if server is not None:
+            server.close()
+        with self.lock:
+            workers = list(self.workers.values())
+        for worker in workers:
+            worker.connection.close()
+
+    def start_stream(self, stream_key):
+        with self.lock:
+            self.active_streams.add(stream_key)
+        self.rebalance()
+
+    def stop_stream(self, stream_key):
+        with self.lock:
+            self.active_streams.discard(stream_key)
+        self.rebalance()
+
+    def rebalance(self):
+        """
+        Assigns the active streams to the workers by the ring and sends the new list of streams with their descriptions
+        from the stream registry to each worker whose list has changed. Streams removed from the registry are not assigned.
+        """
+        with self.assign_lock:
+            with self.lock:
+                assignments = {worker_id: {} for worker_id in self.workers}
+                waiting = 0
+                for stream_key in self.active_streams:
+                    description = stream_registry.get(stream_key)
+                    worker_id = self.ring.get_node(stream_key)
+                    if description is None:
+                        continue
+                    if worker_id is None:
+                        waiting += 1
+                        continue
+                    assignments[worker_id][stream_key] = description
+                changed = [(worker, assignments[worker.worker_id]) for worker in self.workers.values()
+                           if worker.assigned != assignments[worker.worker_id]]
+
+            if waiting and not self.waiting_streams:
+                logger.warning("No detection worker is connected, streams wait for workers.")
+            self.waiting_streams = waiting
+
+            for worker, streams in changed:
+                try:
+                    worker.connection.send({'type': 'assign', 'streams': streams})
+                except OSError:
+                    worker.connection.close()  # The worker is removed by its connection thread, which rebalances again
+                    continue
+
+                with self.lock:
+                    worker.assigned = streams
+                    moved = [stream_key for stream_key in streams
+                             if self.owners.get(stream_key, worker.worker_id) != worker.worker_id]
+                    self.owners.update((stream_key, worker.worker_id) for stream_key in streams)
+                    for stream_key in list(self.owners):
+                        if stream_key not in self.active_streams:
+                            del self.owners[stream_key]
+                if moved:
+                    streams_moved_total.inc(len(moved))
+                logger.info(f"Worker '{worker.worker_id}' analyzes {len(streams)} stream(s)"
+                            + (f", {len(moved)} moved from other workers." if moved else "."))
+
+    def request_photo(self, stream_key):
+        """
+        Asks the worker which the stream belongs to for the current frame with highlighted objects.
+        The worker opens the stream if it has not opened it yet.
+
+        Returns:
+            photo: The image encoded into JPEG.
+        """
+        request_id = next(self.request_ids)
+        request = {'event': threading.Event(), 'photo': None, 'error': None}
+        with self.lock:
+            worker = self.workers.get(self.ring.get_node(stream_key))
+            if worker is None:
+                raise Exception("No detection worker is connected.")
+            request['worker_id'] = worker.worker_id
+            self.requests[request_id] = request
+
+        try:
+            worker.connection.send({'type': 'snapshot', 'request_id': request_id, 'stream': stream_key,
+                                    'description': stream_registry.get(stream_key)})
+            if not request['event'].wait(self.request_timeout):
+                raise Exception(f"Worker '{worker.worker_id}' has not sent the photo in {self.request_timeout} s.")
+        finally:
+            with self.lock:
+                self.requests.pop(request_id, None)
+
+        if request['error'] is not None:
+            raise Exception(f"Worker '{worker.worker_id}' failed to take the photo: {request['error']}")
+        return request['photo']
+
+    def worker_count(self):
+        with self.lock:
+            return len(self.workers)
+
+    def status(self):
+        """
+        Returns:
+            A dictionary which maps worker name to a dictionary with its streams, the number of frames taken from
+            each of them, the number of opened streams and the time in seconds since its last message.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return {worker_id: {
+                'streams': sorted(worker.assigned),
+                'frames': dict(worker.frames),
+                'open_streams': worker.open_streams,
+                'silent_for': now - worker.last_message,
+            } for worker_id, worker in self.workers.items()}
+
+    def _accept_workers(self, server):
+        while True:
+            try:
+                sock, address = server.accept()
+            except OSError:
+                return  # The coordinator is stopped
+            connection = Connection(sock, timeout=self.heartbeat_timeout)
+            threading.Thread(target=self._serve_worker, args=(connection, address), daemon=True).start()
+
+    def _serve_worker(self, connection, address):
+        worker = None
+        reason = 'closed'
+        try:
+            message, _ = connection.receive()
+            if message is None:
+                return
+            if message.get('type') != 'register':
+                raise Exception(f"Expected a registration, got '{message.get('type')}'.")
+            if not self._is_authorized(message):
+                connection.send({'type': 'rejected', 'reason': "Wrong cluster token."})
+                raise Exception("Wrong cluster token.")
+            worker = self._register(message['worker_id'], connection, address)
+
+            while True:
+                message, payload = connection.receive()
+                if message is None:
+                    break
+                worker.last_message = time.monotonic()
+                self._handle(worker, message, payload)
+        except socket.timeout:
+            reason = 'timeout'
+        except Exception as e:
+            reason = 'error'
+            logger.warning(f"Connection with a detection worker from {address[0]} failed: {e}")
+        finally:
+            connection.close()
+            if worker is not None:
+                self._unregister(worker, reason)
+
+    def _is_authorized(self, message):
+        if self.token is None:
+            return True
+        token = message.get('token')
+        if not isinstance(token, str):
+            return False
+        return hmac.compare_digest(token.encode(), self.token.encode())  # Takes the same time for any wrong token
+
+    def _register(self, worker_id, connection, address):
+        worker = RemoteWorker(worker_id, connection, address)
+        with self.lock:
+            previous = self.workers.get(worker_id)
+            self.workers[worker_id] = worker
+            if previous is None:
+                self.ring.add(worker_id)
+            worker_count = len(self.workers)
+
+        # A restarted worker replaces its old connection
+        if previous is not None:
+            previous.connection.close()
+        logger.info(f"Worker '{worker_id}' from {address[0]} is connected, {worker_count} worker(s) in total.")
+        self.rebalance()
+        return worker
+
+    def _unregister(self, worker, reason):
+        with self.lock:
+            if self.workers.get(worker.worker_id) is not worker:
+                return  # Replaced by a new connection of the same worker
+            del self.workers[worker.worker_id]
+            self.ring.remove(worker.worker_id)
+            worker_count = len(self.workers)
+            failed = [request for request in self.requests.values() if request['worker_id'] == worker.worker_id]
+
+        for request in failed:
+            request['error'] = "the worker is disconnected"
+            request['event'].set()
+        workers_lost_total.inc(reason=reason)
+        logger.warning(f"Worker '{worker.worker_id}' is disconnected ({reason}), its {len(worker.assigned)} stream(s) "
+                       f"are moved to {worker_count} other worker(s).")
+        if self.server is not None:
+            self.rebalance()
+
+    def _handle(self, worker, message, payload):
+        kind = message['type']
+        if kind == 'heartbeat':
+            worker.frames = message['frames']
+            worker.open_streams = message['open_streams']
+
+        elif kind == 'detection':
+            stream_key = message['stream']
+            if stream_key not in worker.assigned:
+                return  # The stream has been moved to another worker
+            detections = restore_detections(message['scores'], message['class_ids'], message['boxes'])
+            try:
+                self.report(stream_key, detections, payload, message['caption'], message['time'])
+            except Exception as e:
+                logger.error(f"Failed to report detections: {e}", extra={"stream": stream_key})
+
+        elif kind == 'photo':
+            with self.lock:
+                request = self.requests.get(message['request_id'])
+            if request is not None:
+                request['photo'] = payload
+                request['error'] = message.get('error')
+                request['event'].set()
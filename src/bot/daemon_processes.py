@@ -1,55 +1,81 @@
-import os
 import threading
-from datetime import datetime
-
 import time
+from functools import partial
 
-from static.sources import video_sources
-from img_processing.process_image import check_something_unexpected, print_unexpected_objects_info
+from static.sources import stream_registry
+from static.settings import (max_batch_size, scheduler_min_interval, scheduler_idle_interval,
+                             scheduler_tracked_interval, scheduler_max_interval, scheduler_activity_window,
+                             scheduler_motion_saturation, scheduler_cpu_budget, scheduler_max_concurrent)
+from img_processing.process_image import (find_unexpected_objects, render_unexpected_objects,
+                                          log_unexpected_objects, inference_queue_depth, cascade_stats)
+from img_processing.motion_gate import motion_gate
+from img_processing.tracker import object_tracker
 from static.word_declensions import get_genitive
+from monitoring.logs import get_logger
+from monitoring.metrics import frames_total, alerts_total
+from monitoring.profiling import profiler
+from frame_scheduler import FrameScheduler
+from subscriptions import send_photo_to_subscribers
+from event_store import event_store
 
 
 # Maps animal type to a daemon process where each frame of the video stream is checked for something unexpected
-# Keys are the same as in the `video_sources` dictionary.
-# Initially, each value is equal to `None`.
-daemon_processes = {animal_type: None for animal_type in video_sources.keys()}
+# Keys are keys of the stream registry. Streams without a started daemon process have no entry.
+daemon_processes = {}
+
+# Maps animal type to an event which stops the corresponding daemon process when set
+stop_events = {}
+
+# Maps animal type to a terminated daemon process which may still be analyzing its last frame
+stopping_processes = {}
 
-# Used for updating values of `daemon_processes`
+logger = get_logger(__name__)
+
+# Used for updating values of `daemon_processes`, `stop_events` and `stopping_processes`
 lock = threading.Lock()
 
+# Decides when each daemon process takes its next frame
+frame_scheduler = FrameScheduler(min_interval=scheduler_min_interval, idle_interval=scheduler_idle_interval,
+                                 tracked_interval=scheduler_tracked_interval, max_interval=scheduler_max_interval,
+                                 activity_window=scheduler_activity_window,
+                                 motion_saturation=scheduler_motion_saturation, cpu_budget=scheduler_cpu_budget,
+                                 max_concurrent=scheduler_max_concurrent, queue_depth=inference_queue_depth,
+                                 batch_size=max_batch_size)
+
 
-def start_daemon_process(animal_type, opened_stream, chat_id, bot):
+def start_daemon_process(animal_type, streams, report):
     """
     Creates and starts a daemon process. Inside the process, frames from a live stream are taken and processed in order to find unexpected objects.
+    There is one daemon process per stream, its results are passed to `report`: in the bot they are sent to all chats
+    subscribed to the stream (see `report_to_subscribers`), in a detection worker they are sent to the coordinator.
 
     Args:
         animal_type: Type of animal which corresponding daemon process should be started.
-        opened_stream: A stream of type `CamGear` where animals of the specified type can be found.
-        chat_id: ID of the Telegram chat where the resulting image should be sent to.
-        bot: An instance of the Telegram bot.
+        streams: An instance of `Animals` which opens the stream when its frames are needed.
+        report: A function called after each analyzed frame with the animal type, an instance of `Detections` with
+            the unexpected objects, the photo (`None` if no alert is sent), the caption of the photo and the frame time.
     """
     global daemon_processes
     global lock
 
     # Check that the given animal type is valid
-    if animal_type not in daemon_processes.keys():
+    if not stream_registry.contains(animal_type):
         raise Exception(f"Unknown animal type '{animal_type}'. Cannot start a daemon process.")
 
-    # If `opened_stream` is None, it means the user does not monitor the animal of the specified type.
-    if opened_stream is None:
-        return
-
     with lock:
         # Check that the daemon process has not been started yet
-        if daemon_processes[animal_type] is not None:
+        if daemon_processes.get(animal_type) is not None:
             return
 
-        # Create a daemon process
+        # Create a daemon process. It starts after the previous daemon process of the stream has stopped
+        stop_event = threading.Event()
         new_daemon_process = threading.Thread(
             target=find_unexpected_objects_in_daemon,
-            args=(opened_stream, animal_type, chat_id, bot)
+            args=(streams, animal_type, report, stop_event, stopping_processes.pop(animal_type, None)),
+            daemon=True
         )
         daemon_processes[animal_type] = new_daemon_process
+        stop_events[animal_type] = stop_event
 
     # Start the process
     new_daemon_process.start()
@@ -62,68 +88,182 @@ def terminate_daemon_process(animal_type):
     """
     global daemon_processes
 
-    # Check that the given animal type is valid
-    if animal_type not in daemon_processes.keys():
-        raise Exception(f"Unknown animal of type '{animal_type}'. Cannot start a daemon process.")
-
     with lock:
-        # Check that the daemon process is started
-        if daemon_processes[animal_type] is None:
+        # Check that the daemon process is started. The stream may be removed from the registry already
+        if daemon_processes.get(animal_type) is None:
             return
 
-        # Terminate the process
-        daemon_processes[animal_type].terminate()
-        daemon_processes[animal_type] = None
-
-    # Print that the daemon process is successfully terminated
-    print_log_info(animal_type, "The daemon process is terminated.")
+        # Terminate the process. It stops after the frame which is being processed now and then resets the state
+        # of the stream, see `find_unexpected_objects_in_daemon`
+        stop_events.pop(animal_type).set()
+        stopping_processes[animal_type] = daemon_processes.pop(animal_type)
 
 
-def find_unexpected_objects_in_daemon(video_stream, animal_type, chat_id, bot):
+def find_unexpected_objects_in_daemon(streams, animal_type, report, stop_event, previous_process=None):
     """
     Processes the frames, which are extracted from the video stream, and checks if there are objects unexpected for the given stream.
+    The time between frames is chosen by `frame_scheduler`. The state of the stream in `frame_scheduler`,
+    `motion_gate` and `object_tracker` belongs to the daemon process and is reset when it stops.
 
     Args:
-        video_stream: An instance of `CamGear` -- an opened stream source.
+        streams: An instance of `Animals` which opens the stream when its frames are needed.
         animal_type: Type of animals which are expected to be seen on the video.
-        chat_id: ID of the Telegram chat where the resulting image should be sent to.
-        bot: An instance of the Telegram bot.
+        report: A function which gets results of each analyzed frame, see `start_daemon_process`.
+        stop_event: An instance of `threading.Event`. The daemon process stops when it is set.
+        previous_process: A terminated daemon process of the same stream or `None`. The state of the stream is
+            used only after it has stopped.
     """
     if animal_type is None:
         raise Exception("Animal type should not be None.")
 
+    if previous_process is not None:
+        previous_process.join()
+
     # Print that the daemon process is successfully started
-    print_log_info(animal_type, "Daemon process is started.")
+    log_info(animal_type, "Daemon process is started.")
+    profiler.set_stream(animal_type)
+
+    frame_scheduler.register(animal_type)
+    try:
+        process_frames(streams, animal_type, report, stop_event)
+    finally:
+        interval = frame_scheduler.effective_interval(animal_type)
+        if interval is not None:
+            log_info(animal_type, f"Effective sampling interval was {interval:.1f} s.")
+        frame_scheduler.unregister(animal_type)
+        reset_stream_state(animal_type)
+
+        with lock:
+            if stopping_processes.get(animal_type) is threading.current_thread():
+                stopping_processes.pop(animal_type)
+
+
+def reset_stream_state(animal_type):
+    """
+    Logs statistics of a stopped daemon process and resets the state of its stream in `motion_gate` and
+    `object_tracker`.
+    """
+    stats = motion_gate.stats(animal_type)
+    log_info(animal_type, "The daemon process is terminated. "
+                          f"Skipped {stats['frames_skipped']} of {stats['frames_seen']} frames as static.")
+    stats = object_tracker.stats(animal_type)
+    log_info(animal_type, f"Tracked {stats['tracks_created']} unexpected object(s), sent {stats['alerts']} alert(s), "
+                          f"suppressed alerts for {stats['suppressed_frames']} frame(s).")
+    stats = cascade_stats(animal_type)
+    if stats is not None:
+        log_info(animal_type, f"The cascade skipped DETR for {stats['skipped']} of "
+                              f"{stats['skipped'] + stats['frame'] + stats['crops']} frames.")
+    motion_gate.reset(animal_type)
+    object_tracker.reset(animal_type)
 
-    while video_stream is not None:
-        time.sleep(10)
 
-        # Process frame
-        frame = video_stream.read()
-        if frame is None:
+def process_frames(streams, animal_type, report, stop_event):
+    """
+    Takes frames from the video stream when `frame_scheduler` allows it until `stop_event` is set. A stream which
+    cannot be opened or has ended is opened again, with pauses growing after each failure.
+    Unexpected objects are followed across frames by `object_tracker`, so an alert is sent only when a new object
+    appears or an object stays in view for a long time.
+    Arguments are the same as in `find_unexpected_objects_in_daemon`.
+    """
+    failures = 0  # Failures to get a frame in a row
+    while frame_scheduler.wait_for_next_frame(animal_type, stop_event):
+        if failures and stop_event.wait(min(frame_scheduler.max_interval, 2 ** failures)):
             break
+        photo, caption = None, None
 
-        file_name, unexpected_objects = check_something_unexpected(frame, animal_type)
-        print_unexpected_objects_info(animal_type, unexpected_objects)
+        # The stream is opened on the first frame and may be closed between frames if other streams need decoders
+        try:
+            video_stream = streams.acquire_stream(animal_type)
+        except Exception as e:
+            failures += 1
+            logger.warning(f"Failed to open the stream: {e}", extra={"stream": animal_type})
+            continue
 
-        # Send photo to the bot if something unexpected was found
-        if len(unexpected_objects) > 0:
-            photo = open(file_name, 'rb')
-            bot.send_photo(chat_id, photo,
-                           f"Ого, у {get_genitive(animal_type)} "
-                           f"неожиданно обнаружен(ы) объект(ы) типа {', '.join(map(repr, unexpected_objects))}!")
+        # Process the newest frame. It is used in place and stays pinned in the buffer until the analysis is done
+        with streams.releasing(animal_type), video_stream.latest_frame() as (frame, _):
+            if frame is None:
+                # The stream has ended or its decoder was stopped. It is closed on release and opened again
+                streams.close_stream(animal_type)
+                failures += 1
+                logger.warning("No frames in the stream, it is opened again.", extra={"stream": animal_type})
+                continue
+            failures = 0
+            frame_time = time.time()
+
+            # Skip the frame if the scene has not changed since the last analyzed frame
+            should_analyze = motion_gate.should_analyze(animal_type, frame)
+            frame_scheduler.report_activity(animal_type, motion_gate.motion_score(animal_type))
+            frames_total.inc(stream=animal_type, result='analyzed' if should_analyze else 'skipped')
+            if not should_analyze:
+                object_tracker.keep_alive(animal_type)  # Objects of a static scene are still there
+                continue
+
+            # The scene has changed, so a cached result would be stale. It is refreshed for `/now`
+            with frame_scheduler.analysis_slot(animal_type):
+                unexpected = find_unexpected_objects(frame, animal_type, refresh=True)
+            alerts = object_tracker.update(animal_type, unexpected)
+
+            # The image is encoded only if an alert is sent
+            if alerts:
+                alerts_total.inc(stream=animal_type)
+                photo = render_unexpected_objects(frame, unexpected, animal_type)
+                caption = get_alert_caption(animal_type, alerts)
+
+        log_unexpected_objects(animal_type, unexpected.obj_types)
+        frame_scheduler.report_activity(animal_type, motion_gate.motion_score(animal_type),
+                                        detected=any(track.alert_count == 1 for track in alerts),
+                                        tracked=object_tracker.has_tracks(animal_type))
+
+        # A photo is reported if a new unexpected object was found or an object stays for a long time
+        report(animal_type, unexpected, photo, caption, frame_time)
+
+
+def report_to_subscribers(bot, animal_type, unexpected, photo, caption, frame_time):
+    """
+    Stores the unexpected objects in the event store and sends the photo to the subscribed chats.
+    The events are recorded before the photo is queued, so they are kept even if it is not delivered. The `file_id`
+    of the uploaded photo is attached to them as a thumbnail, so the history can be shown without running the model
+    again.
+
+    Args:
+        bot: An instance of the Telegram bot.
+        animal_type: Type of animals which are expected to be seen on the video.
+        unexpected: An instance of `Detections` with the unexpected objects of the frame.
+        photo: The image with highlighted unexpected objects encoded into JPEG. `None` if no alert is sent.
+        caption: A caption of the photo.
+        frame_time: Unix time of the frame.
+    """
+    event_store.record(animal_type, unexpected, timestamp=frame_time)
+    if photo is not None:
+        send_photo_to_subscribers(bot, animal_type, photo, caption,
+                                  on_uploaded=partial(event_store.attach_thumbnail, animal_type, frame_time))
+
+
+def get_alert_caption(animal_type, alerts):
+    """
+    Returns a caption for the photo with the tracks which caused the alert.
+
+    Args:
+        animal_type: Type of animals which are expected to be seen on the video.
+        alerts: A list of tracks of type `Track` returned by `object_tracker.update`.
+    """
+    new_objects = [track.obj_type for track in alerts if track.alert_count == 1]
+    if new_objects:
+        return (f"Ого, у {get_genitive(animal_type)} "
+                f"неожиданно обнаружен(ы) объект(ы) типа {', '.join(map(repr, new_objects))}!")
 
-            os.remove(file_name)  # Remove temporarily created jpg file
+    staying_objects = [track.obj_type for track in alerts]
+    minutes = round((alerts[0].last_seen - min(track.first_seen for track in alerts)) / 60)
+    return (f"У {get_genitive(animal_type)} всё ещё находится объект(ы) типа {', '.join(map(repr, staying_objects))} "
+            f"(уже {minutes} мин.)")
 
 
-def print_log_info(animal_type, message):
+def log_info(animal_type, message):
     """
-    Prints information about the daemon process.
+    Logs information about the daemon process.
 
     Args:
         animal_type: Corresponding animal type of the daemon process.
         message: A string representing the log info.
     """
-    print(f"'{animal_type}' [{datetime.now().strftime('%y-%m-%d:%H:%M:%S')}]:")
-    print(message)
-    print()
+    logger.info(message, extra={"stream": animal_type})
@@ -0,0 +1,216 @@
+import atexit
+import itertools
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from static.settings import event_store_path, event_store_batch_size, event_store_flush_interval
+from monitoring.logs import get_logger
+
+logger = get_logger(__name__)
+
+schema = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    stream TEXT NOT NULL,
+    class TEXT NOT NULL,
+    score REAL NOT NULL,
+    x1 REAL NOT NULL,
+    y1 REAL NOT NULL,
+    x2 REAL NOT NULL,
+    y2 REAL NOT NULL,
+    thumbnail TEXT
+);
+CREATE INDEX IF NOT EXISTS events_stream_time ON events (stream, time);
+CREATE INDEX IF NOT EXISTS events_class_time ON events (class, time);
+"""
+
+insert_event_sql = ("INSERT INTO events (time, stream, class, score, x1, y1, x2, y2, thumbnail) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+attach_thumbnail_sql = "UPDATE events SET thumbnail = ? WHERE stream = ? AND time = ?"
+
+
+class EventStore:
+    """
+    Append-only store of detected objects in SQLite (WAL mode). Events are put into a queue by the daemon processes
+    and written by a background thread in batches, one transaction per batch, so recording never waits for the disk.
+    A thumbnail may be attached to the events of a frame later, it goes through the same queue.
+    Queries use the indexes on (stream, time) and (class, time).
+
+    Attributes:
+        path (str): Path to the database file. If `None`, events are not stored.
+        batch_size (int): Maximum number of events written in one transaction.
+        flush_interval (float): Maximum time in seconds an event waits in the queue.
+
+    Methods:
+        record: Put the detections of a frame into the queue.
+        attach_thumbnail: Put a thumbnail for the events of a recorded frame into the queue.
+        flush: Wait until all queued events are written.
+        query: Return events of a stream or a class in a time range.
+        class_counts: Return the number of frames and the time of the last event of each class in a time range.
+        latest_thumbnail: Return the thumbnail of the newest event with a thumbnail.
+        close: Write the queued events and stop the writer thread.
+    """
+    def __init__(self, path, batch_size=256, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.events = queue.Queue()
+        self.writer = None
+        self.lock = threading.Lock()  # Used for starting the writer thread
+
+    def record(self, stream_key, detections, thumbnail=None, timestamp=None):
+        """
+        Args:
+            stream_key: A key of the stream the frame was taken from.
+            detections: An instance of `Detections` with the objects to store.
+            thumbnail: A reference to the image of the frame, e.g. a Telegram `file_id` of the sent photo.
+            timestamp: Unix time of the frame. The current time is used if `None`.
+        """
+        if self.path is None or len(detections) == 0:
+            return
+        self._start_writer()
+
+        timestamp = time.time() if timestamp is None else timestamp
+        for obj_type, score, box in zip(detections.obj_types, detections.scores.tolist(), detections.boxes.tolist()):
+            self.events.put((insert_event_sql, (timestamp, stream_key, obj_type, score, *box, thumbnail)))
+
+    def attach_thumbnail(self, stream_key, timestamp, thumbnail):
+        """
+        Args:
+            stream_key: A key of the stream the frame was taken from.
+            timestamp: Unix time of the frame, the same as given to `record`.
+            thumbnail: A reference to the image of the frame. Nothing is changed if it is `None`.
+        """
+        if self.path is None or thumbnail is None:
+            return
+        self._start_writer()
+        self.events.put((attach_thumbnail_sql, (thumbnail, stream_key, timestamp)))
+
+    def flush(self):
+        if self.writer is not None:
+            self.events.join()
+
+    def query(self, stream_key=None, obj_type=None, since=None, until=None, limit=100):
+        """
+        Returns:
+            A list of dictionaries with the events, the newest first.
+        """
+        conditions, params = self._conditions(stream_key, obj_type, since, until)
+        rows = self._read(f"SELECT time, stream, class, score, x1, y1, x2, y2, thumbnail FROM events {conditions} "
+                          "ORDER BY time DESC LIMIT ?", params + [limit])
+        return [{
+            "time": row[0],
+            "stream": row[1],
+            "class": row[2],
+            "score": row[3],
+            "box": row[4:8],
+            "thumbnail": row[8],
+        } for row in rows]
+
+    def class_counts(self, stream_key=None, since=None, until=None):
+        """
+        Returns:
+            A list of tuples (class, number of frames where the class was detected, time of the last event),
+            the most frequent class first. Several objects of a class in one frame are counted once.
+        """
+        conditions, params = self._conditions(stream_key, None, since, until)
+        return self._read(f"SELECT class, COUNT(DISTINCT time), MAX(time) FROM events {conditions} "
+                          "GROUP BY class ORDER BY COUNT(DISTINCT time) DESC", params)
+
+    def latest_thumbnail(self, stream_key=None, since=None, until=None):
+        """
+        Returns:
+            The thumbnail of the newest event which has one. `None` if there is no such event.
+        """
+        conditions, params = self._conditions(stream_key, None, since, until)
+        conditions = f"{conditions} AND thumbnail IS NOT NULL" if conditions else "WHERE thumbnail IS NOT NULL"
+        rows = self._read(f"SELECT thumbnail FROM events {conditions} ORDER BY time DESC LIMIT 1", params)
+        return rows[0][0] if rows else None
+
+    def close(self):
+        with self.lock:
+            if self.writer is None:
+                return
+            self.events.put(None)  # The writer stops after writing the queued events
+            self.writer.join()
+            self.writer = None
+
+    def _start_writer(self):
+        # The writer is started on the first event, so importing the module does not open the database
+        with self.lock:
+            if self.writer is not None:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)  # Make sure the directory exists
+            connection = self._connect()
+            connection.executescript(schema)
+            connection.close()
+            self.writer = threading.Thread(target=self._write_batches, daemon=True)
+            self.writer.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute("PRAGMA journal_mode=WAL")  # Readers do not block the writer and vice versa
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _write_batches(self):
+        connection = self._connect()
+        is_stopped = False
+        while not is_stopped:
+            batch = []
+            event = self.events.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if event is None:
+                    is_stopped = True
+                else:
+                    batch.append(event)
+                if is_stopped or len(batch) >= self.batch_size:
+                    break
+                try:
+                    event = self.events.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            try:
+                # Statements are executed in the order of the queue, so a thumbnail is attached after its events
+                with connection:
+                    for sql, statements in itertools.groupby(batch, key=lambda statement: statement[0]):
+                        connection.executemany(sql, [params for _, params in statements])
+            except sqlite3.Error as e:
+                logger.error(f"Failed to write {len(batch)} event(s) and thumbnail(s): {e}")
+            finally:
+                for _ in range(len(batch) + is_stopped):
+                    self.events.task_done()
+        connection.close()
+
+    def _read(self, sql, params):
+        if self.path is None or not os.path.exists(self.path):
+            return []
+        connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=10)
+        try:
+            return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _conditions(stream_key, obj_type, since, until):
+        conditions, params = [], []
+        for column, operator, value in (("stream", "=", stream_key), ("class", "=", obj_type),
+                                        ("time", ">=", since), ("time", "<", until)):
+            if value is not None:
+                conditions.append(f"{column} {operator} ?")
+                params.append(value)
+        return ("WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+
+# The store shared by all daemon processes
+event_store = EventStore(event_store_path, batch_size=event_store_batch_size, flush_interval=event_store_flush_interval)
+atexit.register(event_store.close)  # Write the queued events on exit
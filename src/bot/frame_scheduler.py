@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class StreamSchedule:
+    """
+    Scheduling state of one stream.
+
+    Attributes:
+        last_frame_time (float): Time when the last frame was taken. `None` if no frame was taken yet.
+        last_detection_time (float): Time when something unexpected was detected last. `None` if nothing was detected.
+        motion_score (float): Share of changed pixels in the last frame.
+        is_tracked (bool): Whether objects which were already reported are still seen in the stream.
+        effective_interval (float): Smoothed time in seconds between two consecutive frames.
+    """
+    def __init__(self):
+        self.last_frame_time = None
+        self.last_detection_time = None
+        self.motion_score = 0.0
+        self.is_tracked = False
+        self.effective_interval = None
+
+
+class FrameScheduler:
+    """
+    Decides when each opened stream gets its next frame. Active streams (recent detections or motion) are sampled
+    more often than idle ones, streams where already reported objects stay in view are sampled less often,
+    and all streams are slowed down when the inference queue grows or the process uses more CPU than its budget.
+    Streams take turns in one shared pool of analysis slots in FIFO order, so a busy stream cannot starve the others.
+
+    Attributes:
+        min_interval (float): Interval in seconds between frames of a fully active stream.
+        idle_interval (float): Interval in seconds between frames of a stream without activity.
+        tracked_interval (float): Minimum interval in seconds between frames of a stream where already reported
+            objects are still seen.
+        max_interval (float): Upper bound of the interval in seconds under load.
+        activity_window (float): Time in seconds during which a stream is considered active after a detection.
+        motion_saturation (float): Motion score at which a stream is considered fully active.
+        cpu_budget (float): Share of all CPU cores the process may use before streams are slowed down.
+        max_concurrent (int): Number of streams which may run the analysis at the same time. `None` means
+            `batch_size`, so frames of the streams can fill a batch of the model.
+        queue_depth: A function returning the number of frames waiting for the model.
+        batch_size (int): Number of frames the model processes at once. Used to normalize the queue depth.
+
+    Methods:
+        register: Start scheduling a stream.
+        unregister: Stop scheduling a stream.
+        wait_for_next_frame: Block until the stream should take its next frame.
+        analysis_slot: A context manager which holds one of the shared analysis slots.
+        report_activity: Update the activity of a stream after a frame is processed.
+        effective_interval: Return the smoothed interval between frames of a stream.
+        intervals: Return the effective intervals of all streams.
+    """
+    def __init__(self, min_interval=2.0, idle_interval=10.0, tracked_interval=6.0, max_interval=60.0,
+                 activity_window=60.0, motion_saturation=0.05, cpu_budget=0.8, max_concurrent=None, queue_depth=None,
+                 batch_size=8):
+        self.min_interval = min_interval
+        self.idle_interval = idle_interval
+        self.tracked_interval = tracked_interval
+        self.max_interval = max_interval
+        self.activity_window = activity_window
+        self.motion_saturation = motion_saturation
+        self.cpu_budget = cpu_budget
+        self.max_concurrent = max_concurrent if max_concurrent is not None else batch_size
+        self.queue_depth = queue_depth
+        self.batch_size = batch_size
+
+        self.streams = {}  # Maps stream key to `StreamSchedule`
+        self.lock = threading.Lock()
+
+        # Analysis slots are given out in the order they were requested
+        self.slot_condition = threading.Condition()
+        self.slot_waiters = deque()
+        self.busy_slots = 0
+
+        # Used for measuring the CPU usage of the process
+        self.cpu_sample = (time.monotonic(), time.process_time())
+        self.cpu_usage = 0.0
+
+    def register(self, stream_key):
+        with self.lock:
+            self.streams.setdefault(stream_key, StreamSchedule())
+
+    def unregister(self, stream_key):
+        with self.lock:
+            self.streams.pop(stream_key, None)
+
+    def wait_for_next_frame(self, stream_key, stop_event):
+        """
+        Blocks until the stream should take its next frame.
+
+        Args:
+            stream_key: A key of the stream.
+            stop_event: A `threading.Event` which interrupts waiting when set.
+
+        Returns:
+            `False` if waiting was interrupted by `stop_event`, otherwise `True`.
+        """
+        with self.lock:
+            schedule = self.streams.setdefault(stream_key, StreamSchedule())
+            interval = self._compute_interval(schedule)
+            last_frame_time = schedule.last_frame_time
+
+        if last_frame_time is not None:
+            if stop_event.wait(max(0.0, last_frame_time + interval - time.monotonic())):
+                return False
+        elif stop_event.is_set():
+            return False
+
+        now = time.monotonic()
+        with self.lock:
+            if schedule.last_frame_time is not None:
+                # Smooth the measured interval to report a stable value
+                interval = now - schedule.last_frame_time
+                if schedule.effective_interval is None:
+                    schedule.effective_interval = interval
+                else:
+                    schedule.effective_interval = 0.8 * schedule.effective_interval + 0.2 * interval
+            schedule.last_frame_time = now
+        return True
+
+    @contextmanager
+    def analysis_slot(self, stream_key):
+        ticket = object()
+        with self.slot_condition:
+            self.slot_waiters.append(ticket)
+            while self.slot_waiters[0] is not ticket or self.busy_slots >= self.max_concurrent:
+                self.slot_condition.wait()
+            self.slot_waiters.popleft()
+            self.busy_slots += 1
+            self.slot_condition.notify_all()  # The next waiter may take a free slot as well
+
+        try:
+            yield
+        finally:
+            with self.slot_condition:
+                self.busy_slots -= 1
+                self.slot_condition.notify_all()
+
+    def report_activity(self, stream_key, motion_score, detected=False, tracked=None):
+        with self.lock:
+            schedule = self.streams.get(stream_key)
+            if schedule is None:
+                return
+            schedule.motion_score = motion_score
+            if tracked is not None:
+                schedule.is_tracked = tracked
+            if detected:
+                schedule.last_detection_time = time.monotonic()
+
+    def effective_interval(self, stream_key):
+        with self.lock:
+            schedule = self.streams.get(stream_key)
+            return schedule.effective_interval if schedule is not None else None
+
+    def intervals(self):
+        with self.lock:
+            return {stream_key: schedule.effective_interval for stream_key, schedule in self.streams.items()}
+
+    def _compute_interval(self, schedule):
+        now = time.monotonic()
+
+        # Activity is 1 right after a detection, otherwise it depends on the amount of motion
+        activity = min(1.0, schedule.motion_score / self.motion_saturation)
+        if schedule.last_detection_time is not None and now - schedule.last_detection_time < self.activity_window:
+            activity = 1.0
+        interval = self.idle_interval - activity * (self.idle_interval - self.min_interval)
+
+        # Objects which were already reported do not need frequent frames
+        if schedule.is_tracked:
+            interval = max(interval, self.tracked_interval)
+
+        # Slow down when frames are waiting for the model
+        if self.queue_depth is not None:
+            interval *= 1 + self.queue_depth() / self.batch_size
+
+        # Slow down when the process uses more CPU than its budget
+        cpu_usage = self._measure_cpu_usage(now)
+        if cpu_usage > self.cpu_budget:
+            interval *= cpu_usage / self.cpu_budget
+
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def _measure_cpu_usage(self, now):
+        last_wall_time, last_cpu_time = self.cpu_sample
+        if now - last_wall_time >= 1.0:
+            cpu_time = time.process_time()
+            self.cpu_usage = (cpu_time - last_cpu_time) / ((now - last_wall_time) * (os.cpu_count() or 1))
+            self.cpu_sample = (now, cpu_time)
+        return self.cpu_usage
@@ -0,0 +1,85 @@
+import threading
+
+from static.sources import stream_registry
+from alert_queue import alert_queue
+
+
+class Subscriptions:
+    """
+    Stores which chats are subscribed to which streams. Each stream has one decode+detect pipeline,
+    and its results are fanned out to all subscribed chats.
+
+    Attributes:
+        subscribers (dict): A dictionary that maps animal type to a set of IDs of subscribed chats. Keys are keys of the stream registry.
+
+    Methods:
+        subscribe: Subscribe a chat to a stream.
+        unsubscribe: Unsubscribe a chat from a stream.
+        get_subscribers: Return IDs of chats subscribed to a stream.
+        get_animal_types: Return animal types a chat is subscribed to.
+    """
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, animal_type, chat_id):
+        """
+        Returns:
+            `True` if the chat was not subscribed to the stream before, otherwise `False`.
+        """
+        self._check_animal_type(animal_type)
+        with self.lock:
+            if chat_id in self.subscribers.get(animal_type, ()):
+                return False
+            self.subscribers.setdefault(animal_type, set()).add(chat_id)
+            return True
+
+    def unsubscribe(self, animal_type, chat_id):
+        """
+        Returns:
+            `True` if the chat was subscribed to the stream, otherwise `False`.
+        """
+        self._check_animal_type(animal_type)
+        with self.lock:
+            if chat_id not in self.subscribers.get(animal_type, ()):
+                return False
+            self.subscribers[animal_type].remove(chat_id)
+            return True
+
+    def get_subscribers(self, animal_type):
+        with self.lock:
+            return list(self.subscribers.get(animal_type, ()))
+
+    def get_animal_types(self, chat_id):
+        # Subscriptions to streams removed from the registry are kept in case the streams come back
+        with self.lock:
+            animal_types = [animal_type for animal_type, chat_ids in self.subscribers.items() if chat_id in chat_ids]
+        return [animal_type for animal_type in animal_types if stream_registry.contains(animal_type)]
+
+    def _check_animal_type(self, animal_type):
+        if not stream_registry.contains(animal_type):
+            raise Exception(f"Animal of type '{animal_type}' is not considered by our bot.")
+
+
+# Subscriptions of all chats
+subscriptions = Subscriptions()
+
+
+def send_photo_to_subscribers(bot, animal_type, photo, caption, on_uploaded=None):
+    """
+    Queues a photo for all chats subscribed to the stream. The photo is sent by `alert_queue` in the background,
+    so the daemon process does not wait for Telegram. It is uploaded only once: other chats receive it by `file_id`
+    returned by Telegram after the first upload.
+
+    Args:
+        bot: An instance of the Telegram bot.
+        animal_type: Type of animal which stream the photo was taken from.
+        photo: The image encoded into JPEG.
+        caption: A caption of the photo.
+        on_uploaded: A function called with Telegram `file_id` of the uploaded photo, or with `None` if the photo
+            is not sent to any chat.
+
+    Returns:
+        The number of chats the photo is queued for.
+    """
+    return alert_queue.submit(bot, animal_type, photo, caption, subscriptions.get_subscribers(animal_type), on_uploaded)
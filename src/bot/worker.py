@@ -0,0 +1,179 @@
+"""
+A detection worker: connects to the bot running with `cluster_enabled`, analyzes the streams assigned to it and sends
+the results back. Several workers can run on one host or on different hosts.
+
+Run from `src/bot` with `src`, `src/bot` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python worker.py --id worker-1 --coordinator 127.0.0.1:9200
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+from functools import partial
+
+from static.sources import stream_registry
+from static.settings import (cluster_host, cluster_port, cluster_heartbeat_interval, cluster_reconnect_delay,
+                             cluster_token, model_warm_up)
+from img_processing.process_stream import get_current_frame
+from img_processing.process_image import warm_up_detection
+from monitoring.logs import get_logger
+from monitoring.metrics import frames_total, start_metrics_server
+from monitoring.profiling import profiler, install_signal_handler
+from animals import Animals
+from cluster import Connection
+from daemon_processes import start_daemon_process, terminate_daemon_process
+
+logger = get_logger(__name__)
+
+
+class Worker:
+    """
+    Runs daemon processes of the streams assigned by the coordinator and sends it the unexpected objects of each frame
+    and the photos of alerts. While the worker is disconnected, it analyzes nothing: its streams are moved to other
+    workers, and it gets streams again when it connects.
+
+    Attributes:
+        worker_id (str): A unique name of the worker.
+        host (str), port (int): The address of the coordinator.
+        streams: An instance of `Animals` which opens the streams.
+        assigned (dict): Maps key of each assigned stream to its description.
+        heartbeat_interval (float): Time in seconds between heartbeats.
+        reconnect_delay (float): Time in seconds to wait before connecting again.
+        token (str): The secret shared with the coordinator.
+
+    Methods:
+        run: Connect to the coordinator and serve it, connecting again after a failure. Never returns.
+    """
+    def __init__(self, worker_id, host=cluster_host, port=cluster_port, streams=None,
+                 heartbeat_interval=cluster_heartbeat_interval, reconnect_delay=cluster_reconnect_delay,
+                 token=cluster_token):
+        self.worker_id = worker_id
+        self.host = host
+        self.port = port
+        self.streams = streams if streams is not None else Animals()
+        self.assigned = {}
+        self.heartbeat_interval = heartbeat_interval
+        self.reconnect_delay = reconnect_delay
+        self.token = token
+
+    def run(self):
+        while True:
+            try:
+                connection = Connection(socket.create_connection((self.host, self.port)))
+            except OSError as e:
+                logger.warning(f"Cannot connect to the coordinator at {self.host}:{self.port}: {e}")
+            else:
+                logger.info(f"Worker '{self.worker_id}' is connected to the coordinator at {self.host}:{self.port}.")
+                try:
+                    self._serve(connection)
+                    logger.warning("The coordinator has closed the connection.")
+                except OSError as e:
+                    logger.warning(f"Lost the connection to the coordinator: {e}")
+                finally:
+                    connection.close()
+                    self._assign(connection, {})  # The coordinator moves the streams to other workers
+            time.sleep(self.reconnect_delay)
+
+    def _serve(self, connection):
+        connection.send({'type': 'register', 'worker_id': self.worker_id, 'token': self.token})
+        stop_event = threading.Event()
+        threading.Thread(target=self._send_heartbeats, args=(connection, stop_event), daemon=True).start()
+        try:
+            while True:
+                message, _ = connection.receive()
+                if message is None:
+                    return
+                if message['type'] == 'rejected':
+                    # Connecting again would not help
+                    raise Exception(f"The coordinator has rejected the worker: {message['reason']}")
+                if message['type'] == 'assign':
+                    self._assign(connection, message['streams'])
+                elif message['type'] == 'snapshot':
+                    # Frames of other streams are analyzed meanwhile
+                    threading.Thread(target=self._send_photo, args=(connection, message), daemon=True).start()
+        finally:
+            stop_event.set()
+
+    def _assign(self, connection, streams):
+        for stream_key in self.assigned.keys() - streams.keys():
+            terminate_daemon_process(stream_key)
+            self.streams.close_stream(stream_key)  # The decoder is not needed here anymore
+
+        for stream_key, description in streams.items():
+            self._update_description(stream_key, description)
+            if stream_key not in self.assigned:
+                start_daemon_process(stream_key, self.streams, partial(self._report, connection))
+
+        if streams or self.assigned:
+            logger.info(f"Analyzing {len(streams)} stream(s): {', '.join(sorted(streams)) or '-'}.")
+        self.assigned = streams
+
+    def _update_description(self, stream_key, description):
+        # Streams are described by the coordinator, the local registry file is not needed
+        if description is None or stream_registry.get(stream_key) == description:
+            return
+        description = dict(description)
+        stream_registry.add(stream_key, description.pop('url'), **description)
+        self.streams.close_stream(stream_key)  # The stream is opened again with the new source
+
+    def _report(self, connection, stream_key, unexpected, photo, caption, frame_time):
+        if photo is None and len(unexpected) == 0:
+            return  # Nothing to store or to send
+
+        message = {'type': 'detection', 'stream': stream_key, 'time': frame_time, 'caption': caption,
+                   'scores': unexpected.scores.tolist(), 'class_ids': unexpected.class_ids.tolist(),
+                   'boxes': unexpected.boxes.tolist()}
+        try:
+            connection.send(message, photo)
+        except OSError:
+            logger.debug("The coordinator is disconnected, the results are dropped.", extra={"stream": stream_key})
+
+    def _send_photo(self, connection, message):
+        stream_key = message['stream']
+        response = {'type': 'photo', 'request_id': message['request_id']}
+        photo = None
+        try:
+            self._update_description(stream_key, message['description'])
+            with profiler.attribute([stream_key]), self.streams.use_stream(stream_key) as opened_stream:
+                photo = get_current_frame(opened_stream, stream_key)
+        except Exception as e:
+            response['error'] = str(e)
+
+        try:
+            connection.send(response, photo)
+        except OSError:
+            pass  # The coordinator has given up on the request
+
+    def _send_heartbeats(self, connection, stop_event):
+        while not stop_event.wait(self.heartbeat_interval):
+            frames = {stream_key: frames_total.get(stream=stream_key, result='analyzed') +
+                      frames_total.get(stream=stream_key, result='skipped') for stream_key in list(self.assigned)}
+            try:
+                connection.send({'type': 'heartbeat', 'open_streams': self.streams.open_count(), 'frames': frames})
+            except OSError:
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze streams assigned by the bot.")
+    parser.add_argument("--id", default=f"{socket.gethostname()}-{os.getpid()}",
+                        help="A unique name of the worker. A worker restarted with the same name gets the same streams.")
+    parser.add_argument("--coordinator", default=f"{cluster_host}:{cluster_port}",
+                        help="The address of the bot as host:port.")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve metrics of the worker on this port. Disabled if omitted.")
+    args = parser.parse_args()
+
+    host, port = args.coordinator.rsplit(":", 1)
+    install_signal_handler()  # Workers run the model, so they are profiled with `kill -USR1` as well
+    if model_warm_up:
+        warm_up_detection()
+    if start_metrics_server(port=args.metrics_port) is not None:
+        logger.info(f"Metrics are served on port {args.metrics_port}.")
+    Worker(args.id, host, int(port)).run()
+
+
+# The guard keeps worker processes of the 'process' inference backend from starting the worker
+if __name__ == '__main__':
+    main()
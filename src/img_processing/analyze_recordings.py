@@ -0,0 +1,232 @@
+"""
+Offline analysis of recorded video files. Runs the same unexpected-object check as the daemon processes
+over local files, writes detections of every sampled frame into a JSONL file and saves clips of the events
+where something unexpected was detected.
+
+Run with `src` and `src/img_processing` in PYTHONPATH, same as the bot:
+    python analyze_recordings.py ~/recordings/penguins --animal-type bird --fps 1 --workers 2 --output ../analysis
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from itertools import islice
+
+import cv2
+import numpy as np
+import torch
+
+from model import detect_animals, get_unexpected_mask
+from static.settings import max_batch_size
+
+video_extensions = ('.mp4', '.avi', '.mkv', '.mov', '.webm', '.ts')
+
+
+def find_video_files(paths):
+    """
+    Returns (path, output name) pairs of video files. Directories are searched recursively.
+    The output name is the path relative to the given directory without the extension, so files with the same name
+    in different subdirectories get different results. Names which are still repeated get a hash of the full path.
+    """
+    video_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, _, file_names in os.walk(path):
+                video_files.extend((os.path.join(dir_path, file_name),
+                                    os.path.relpath(os.path.join(dir_path, file_name), path))
+                                   for file_name in sorted(file_names) if file_name.lower().endswith(video_extensions))
+        elif os.path.isfile(path):
+            video_files.append((path, os.path.basename(path)))
+        else:
+            raise Exception(f"No such file or directory '{path}'.")
+
+    names = [os.path.splitext(name)[0] for _, name in video_files]
+    for index, (video_path, _) in enumerate(video_files):
+        name = names[index]
+        if names.count(name) > 1:
+            name += "_" + hashlib.md5(os.path.abspath(video_path).encode()).hexdigest()[:8]
+        video_files[index] = (video_path, name)
+    return video_files
+
+
+def sample_frames(capture, video_fps, sample_fps):
+    """
+    Yields (frame index, time in seconds, frame) for frames taken at `sample_fps` from an opened video with `video_fps`.
+    Skipped frames are only grabbed from the file, not decoded.
+    """
+    step = max(1.0, video_fps / sample_fps) if sample_fps > 0 else 1.0
+    next_index = 0.0
+    frame_index = 0
+    while capture.grab():
+        if frame_index >= next_index:
+            next_index += step
+            is_read, frame = capture.retrieve()
+            if not is_read:
+                return
+            yield frame_index, frame_index / video_fps, frame
+        frame_index += 1
+
+
+def batched(items, batch_size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def merge_events(event_times, padding):
+    """
+    Merges times of frames with unexpected objects into (start, end) intervals in seconds.
+    Each time is extended by `padding` seconds in both directions.
+    """
+    events = []
+    for event_time in sorted(event_times):
+        start, end = max(0.0, event_time - padding), event_time + padding
+        if events and start <= events[-1][1]:
+            events[-1][1] = max(events[-1][1], end)
+        else:
+            events.append([start, end])
+    return events
+
+
+def write_clips(video_path, events, video_fps, output_prefix):
+    """
+    Saves each event interval of the video into a separate mp4 file.
+
+    Returns:
+        A list of names of the saved files.
+    """
+    capture = cv2.VideoCapture(video_path)
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    file_names = []
+    for event_index, (start, end) in enumerate(events):
+        file_name = f"{output_prefix}.event{event_index:03d}_{start:.0f}s.mp4"
+        writer = cv2.VideoWriter(file_name, cv2.VideoWriter_fourcc(*'mp4v'), video_fps, (width, height))
+
+        capture.set(cv2.CAP_PROP_POS_MSEC, start * 1000)
+        for _ in range(int(round((end - start) * video_fps))):
+            is_read, frame = capture.read()
+            if not is_read:
+                break
+            writer.write(frame)
+
+        writer.release()
+        file_names.append(file_name)
+
+    capture.release()
+    return file_names
+
+
+def analyze_file(video_path, output_name, animal_type, sample_fps, batch_size, output_dir, clip_padding):
+    """
+    Analyzes one video file. Results are written into `output_dir` under `output_name`.
+
+    Returns:
+        A dictionary with statistics of the analysis.
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise Exception(f"Cannot open video file '{video_path}'.")
+    video_fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    output_prefix = os.path.join(output_dir, output_name)
+    os.makedirs(os.path.dirname(output_prefix), exist_ok=True)  # Subdirectories of the input are kept
+    unexpected_mask = get_unexpected_mask(animal_type)
+
+    start_time = time.perf_counter()
+    sampled_count = 0
+    last_time = 0.0
+    event_times = []
+
+    with open(f"{output_prefix}.detections.jsonl", 'w') as output_file:
+        samples = sample_frames(capture, video_fps, sample_fps)
+        for batch in batched(samples, batch_size):
+            results = detect_animals([frame for _, _, frame in batch])
+
+            for (frame_index, frame_time, _), detections in zip(batch, results):
+                is_unexpected = unexpected_mask[detections.class_ids]
+                if is_unexpected.any():
+                    event_times.append(frame_time)
+                output_file.write(json.dumps({
+                    "frame": frame_index,
+                    "time": round(frame_time, 3),
+                    "classes": detections.obj_types,
+                    "scores": np.round(detections.scores, 3).tolist(),
+                    "boxes": np.round(detections.boxes, 1).tolist(),
+                    "unexpected": is_unexpected.tolist(),
+                }) + "\n")
+
+            sampled_count += len(batch)
+            last_time = batch[-1][1]
+            elapsed = time.perf_counter() - start_time
+            print(f"{os.path.basename(video_path)}: frame {batch[-1][0]}/{total_frames}, "
+                  f"{sampled_count / elapsed:.2f} frames/sec, realtime factor {last_time / elapsed:.2f}")
+
+    capture.release()
+
+    events = merge_events(event_times, clip_padding)
+    clips = write_clips(video_path, events, video_fps, output_prefix) if events else []
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "file": video_path,
+        "sampled_frames": sampled_count,
+        "video_seconds": last_time,
+        "elapsed_seconds": elapsed,
+        "events": len(events),
+        "clips": clips,
+    }
+
+
+def initialize_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def analyze_file_in_worker(arguments):
+    return analyze_file(*arguments)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find unexpected objects in recorded video files.")
+    parser.add_argument("paths", nargs="+", help="Video files or directories with video files.")
+    parser.add_argument("--animal-type", required=True, help="Type of animals expected on the videos, e.g. 'bird'.")
+    parser.add_argument("--fps", type=float, default=1.0, help="Number of frames analyzed per second of video.")
+    parser.add_argument("--batch-size", type=int, default=max_batch_size)
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes analyzing files in parallel.")
+    parser.add_argument("--output", default="../analysis", help="Directory for detections and event clips.")
+    parser.add_argument("--clip-padding", type=float, default=5.0,
+                        help="Seconds of video saved before and after each frame with unexpected objects.")
+    args = parser.parse_args()
+
+    video_files = find_video_files(args.paths)
+    os.makedirs(args.output, exist_ok=True)  # Make sure the directory exists
+    tasks = [(video_path, output_name, args.animal_type, args.fps, args.batch_size, args.output, args.clip_padding)
+             for video_path, output_name in video_files]
+
+    start_time = time.perf_counter()
+    if args.workers > 1:
+        # CPU cores are split evenly between the worker processes
+        num_threads = max(1, (os.cpu_count() or 1) // args.workers)
+        with multiprocessing.get_context("spawn").Pool(args.workers, initialize_worker, (num_threads,)) as pool:
+            summaries = pool.map(analyze_file_in_worker, tasks, chunksize=1)
+    else:
+        summaries = [analyze_file(*task) for task in tasks]
+    elapsed = time.perf_counter() - start_time
+
+    sampled_frames = sum(summary["sampled_frames"] for summary in summaries)
+    video_seconds = sum(summary["video_seconds"] for summary in summaries)
+    for summary in summaries:
+        print(f"{summary['file']}: {summary['events']} event(s), {len(summary['clips'])} clip(s)")
+    print(f"Analyzed {len(summaries)} file(s), {sampled_frames} frames in {elapsed:.1f} s: "
+          f"{sampled_frames / elapsed:.2f} frames/sec, realtime factor {video_seconds / elapsed:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from regions import empty_detections
+from static.sources import stream_registry
+from static.settings import (cascade_enabled, cascade_mode, cascade_min_confidence, cascade_confident_threshold,
+                             cascade_suspect_threshold, cascade_crop_margin, cascade_target_classes)
+from monitoring.logs import get_logger
+from monitoring.metrics import registry, stage_seconds
+
+logger = get_logger(__name__)
+
+weights_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weights')
+
+# MobileNet-SSD trained on PASCAL VOC (Caffe). The files are not downloaded automatically, they should be put
+# into the `weights` directory.
+ssd_prototxt_path = os.path.join(weights_dir, 'MobileNetSSD_deploy.prototxt')
+ssd_model_path = os.path.join(weights_dir, 'MobileNetSSD_deploy.caffemodel')
+ssd_class_names = ('background', 'aeroplane', 'bicycle', 'bird', 'boat', 'bottle', 'bus', 'car', 'cat', 'chair',
+                   'cow', 'diningtable', 'dog', 'horse', 'motorbike', 'person', 'pottedplant', 'sheep', 'sofa',
+                   'train', 'tvmonitor')
+
+cascade_frames_total = registry.counter("animal_detection_cascade_frames_total",
+                                        "Frames screened by the pre-detector, by decision: 'skipped' (DETR is not run), "
+                                        "'frame' (DETR on the whole frame) or 'crops' (DETR on crops).",
+                                        ("stream", "decision"))
+
+
+class SsdDetector:
+    """
+    MobileNet-SSD run with `cv2.dnn` on CPU. Used as the cheap first stage of the cascade.
+
+    Attributes:
+        net: An instance of `cv2.dnn.Net`. `None` until the model is loaded.
+
+    Methods:
+        detect: Return class names, scores and boxes of the objects in a frame.
+    """
+    def __init__(self, prototxt_path=ssd_prototxt_path, model_path=ssd_model_path, input_size=300):
+        self.prototxt_path = prototxt_path
+        self.model_path = model_path
+        self.input_size = input_size
+        self.net = None
+        self.lock = threading.Lock()  # `cv2.dnn.Net` should not be used by several threads at once
+
+    def is_available(self):
+        return os.path.isfile(self.prototxt_path) and os.path.isfile(self.model_path)
+
+    def detect(self, image_bytes, min_confidence):
+        """
+        Args:
+            image_bytes: A BGR image.
+            min_confidence: Detections with a lower score are dropped.
+
+        Returns:
+            class_names: A list of class names.
+            scores: An array of shape (N,).
+            boxes: An array of shape (N, 4) in the format (top_left_x, top_left_y, bottom_right_x, bottom_right_y).
+        """
+        height, width = image_bytes.shape[:2]
+        blob = cv2.dnn.blobFromImage(cv2.resize(image_bytes, (self.input_size, self.input_size)),
+                                     0.007843, (self.input_size, self.input_size), 127.5)
+        with self.lock:
+            if self.net is None:
+                self.net = cv2.dnn.readNetFromCaffe(self.prototxt_path, self.model_path)
+            self.net.setInput(blob)
+            outputs = self.net.forward()[0, 0]  # Rows: (image id, class id, score, x1, y1, x2, y2)
+
+        outputs = outputs[outputs[:, 2] >= min_confidence]
+        boxes = np.clip(outputs[:, 3:7], 0, 1) * np.array([width, height, width, height], dtype=np.float32)
+        class_names = [ssd_class_names[int(class_id)] if int(class_id) < len(ssd_class_names) else 'unknown'
+                       for class_id in outputs[:, 1]]
+        return class_names, outputs[:, 2], boxes
+
+
+class DetectorCascade:
+    """
+    Two-stage detection. A cheap pre-detector screens each frame, and DETR runs only when the pre-detector reports
+    an object which is not the expected animal or an object it is not sure about. Frames where the pre-detector
+    confidently sees only the expected animals, or nothing at all, are considered to have nothing unexpected.
+    Streams without target classes of the pre-detector always use DETR.
+
+    Attributes:
+        pre_detector: An object with a `detect(image, min_confidence)` method, e.g. `SsdDetector`.
+        mode (str): 'frame' to run DETR on the whole frame or 'crops' to run it only around the suspicious objects.
+        min_confidence (float): Detections of the pre-detector with a lower score are ignored.
+        confident_threshold (float): A detection of a target class with at least this score needs no confirmation.
+        suspect_threshold (float): A detection of another class with at least this score is confirmed by DETR.
+        crop_margin (float): Share of the box size added on each side of a crop.
+        target_classes (dict): Maps animal type to a list of classes of the pre-detector which are expected.
+            The animal type of a stream is taken from the stream registry.
+
+    Methods:
+        detect: Detect objects in a frame of a stream, running DETR only if needed.
+        stats: Return the numbers of decisions for a stream.
+    """
+    def __init__(self, pre_detector, mode='frame', min_confidence=0.2, confident_threshold=0.6, suspect_threshold=0.3,
+                 crop_margin=0.2, target_classes=None):
+        if mode not in ('frame', 'crops'):
+            raise Exception(f"Unknown cascade mode '{mode}'.")
+
+        self.pre_detector = pre_detector
+        self.mode = mode
+        self.min_confidence = min_confidence
+        self.confident_threshold = confident_threshold
+        self.suspect_threshold = suspect_threshold
+        self.crop_margin = crop_margin
+        self.target_classes = target_classes or {}
+
+    def detect(self, image_bytes, stream_key, detect):
+        """
+        Args:
+            image_bytes: The image in bytes.
+            stream_key: A key of the stream.
+            detect: A function running DETR on a frame of the stream with its regions of interest, e.g.
+                `detect_animal_cached` bound to the stream. In the 'crops' mode it also gets a list of crops:
+                rectangles in coordinates relative to the frame size, the only parts of the frame to analyze.
+
+        Returns:
+            An instance of `Detections`. It is empty if DETR was not run.
+        """
+        target_classes = self.target_classes.get(stream_registry.animal_type(stream_key))
+        if not target_classes:
+            return detect(image_bytes)
+
+        with stage_seconds.time(stage='predetect'):
+            class_names, scores, boxes = self.pre_detector.detect(image_bytes, self.min_confidence)
+
+        is_target = np.array([class_name in target_classes for class_name in class_names], dtype=bool)
+        is_suspicious = (~is_target & (scores >= self.suspect_threshold)) | \
+                        (is_target & (scores < self.confident_threshold))
+        if not is_suspicious.any():
+            cascade_frames_total.inc(stream=stream_key, decision='skipped')
+            return empty_detections()
+
+        if self.mode == 'frame':
+            cascade_frames_total.inc(stream=stream_key, decision='frame')
+            return detect(image_bytes)
+
+        cascade_frames_total.inc(stream=stream_key, decision='crops')
+        return detect(image_bytes, self._crop_polygons(boxes[is_suspicious], image_bytes.shape))
+
+    def stats(self, stream_key):
+        counts = {decision: int(cascade_frames_total.get(stream=stream_key, decision=decision))
+                  for decision in ('skipped', 'frame', 'crops')}
+        total = sum(counts.values())
+        counts["skipped_share"] = counts['skipped'] / total if total else 0.0
+        return counts
+
+    def _crop_polygons(self, boxes, frame_shape):
+        # Crops are rectangles in coordinates relative to the frame size, as regions of interest in `stream_regions`
+        height, width = frame_shape[:2]
+        margins = (boxes[:, 2:] - boxes[:, :2]) * self.crop_margin
+        top_left = np.clip((boxes[:, :2] - margins) / (width, height), 0, 1)
+        bottom_right = np.clip((boxes[:, 2:] + margins) / (width, height), 0, 1)
+        return [[(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+                for (x1, y1), (x2, y2) in zip(top_left.tolist(), bottom_right.tolist())]
+
+
+def create_cascade():
+    """
+    Creates the cascade selected in the settings.
+
+    Returns:
+        An instance of `DetectorCascade`. `None` if the cascade is disabled or the pre-detector files are missing.
+    """
+    if not cascade_enabled:
+        return None
+    pre_detector = SsdDetector()
+    if not pre_detector.is_available():
+        logger.warning(f"Pre-detector files are not found in '{weights_dir}'. DETR is run on every frame.")
+        return None
+    return DetectorCascade(pre_detector, mode=cascade_mode, min_confidence=cascade_min_confidence,
+                           confident_threshold=cascade_confident_threshold, suspect_threshold=cascade_suspect_threshold,
+                           crop_margin=cascade_crop_margin, target_classes=cascade_target_classes)
+
+
+# The cascade shared by all daemon processes
+cascade = create_cascade()
+
+
+def detect_with_cascade(image_bytes, stream_key, detect):
+    """
+    Detects objects in a frame of a stream with the cascade if it is enabled, otherwise runs `detect` directly.
+    """
+    if cascade is None:
+        return detect(image_bytes)
+    return cascade.detect(image_bytes, stream_key, detect)
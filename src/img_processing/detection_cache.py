@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+
+from inference_engine import detect_animal
+from regions import detect_animal_in_stream
+from static.settings import detection_cache_max_entries, detection_cache_ttl
+
+
+def frame_fingerprint(image_bytes):
+    """
+    Computes a cheap perceptual hash of a frame. The frame is converted to grayscale and downscaled to 9x8 pixels,
+    then each bit of the hash shows whether a pixel is brighter than its right neighbour.
+    Almost identical frames (e.g. consecutive frames of a static camera) get the same fingerprint.
+
+    Args:
+        image_bytes: The image in bytes.
+
+    Returns:
+        fingerprint: A 64-bit integer.
+    """
+    gray = cv2.cvtColor(image_bytes, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+class DetectionCache:
+    """
+    LRU cache of detection results with a time-to-live. Keys contain a stream key and a frame fingerprint,
+    so `/now` requests reuse the result of the daemon for the same stream. The daemon itself refreshes the results
+    of frames where the motion gate has seen a change, since the fingerprint may miss a small new object.
+    While a result is being computed, other callers with the same key wait for it instead of running the model again.
+
+    Attributes:
+        max_entries (int): Maximum number of stored results. The least recently used result is evicted first.
+        ttl (float): Time in seconds after which a result is considered outdated.
+        hits (int): Number of requests answered from the cache.
+        misses (int): Number of requests which required running the model.
+        evictions (int): Number of results removed because the cache was full or the result was outdated.
+
+    Methods:
+        get_or_detect: Return the cached result for a frame or compute it. With `refresh`, always compute it.
+        stats: Return the counters as a dictionary.
+        clear: Remove all stored results.
+    """
+    def __init__(self, max_entries=256, ttl=15.0):
+        if max_entries < 1:
+            raise Exception("Cache size should be positive.")
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.entries = OrderedDict()  # Maps key to a pair (creation time, future with the result)
+        self.lock = threading.Lock()
+
+    def get_or_detect(self, stream_key, image_bytes, detect=detect_animal, variant=None, refresh=False):
+        # Results for different parts of the same frame (`variant`, e.g. crops) are stored separately
+        key = (stream_key, frame_fingerprint(image_bytes), variant)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and refresh:
+                del self.entries[key]  # Callers already waiting for the old result still get it
+                entry = None
+            elif entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.evictions += 1
+                entry = None
+
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                future = entry[1]
+                is_owner = False
+            else:
+                self.misses += 1
+                future = Future()
+                self._insert(key, future)
+                is_owner = True
+
+        if not is_owner:
+            return future.result()  # Wait if the result is still being computed
+
+        try:
+            future.set_result(detect(image_bytes))
+        except Exception as e:
+            future.set_exception(e)
+            with self.lock:
+                if self.entries.get(key, (None, None))[1] is future:
+                    del self.entries[key]  # Do not cache failures
+        return future.result()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self.entries),
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _insert(self, key, future):
+        self.entries[key] = (time.monotonic(), future)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)  # Remove the least recently used result
+            self.evictions += 1
+
+
+# The cache shared by all streams
+detection_cache = DetectionCache(max_entries=detection_cache_max_entries, ttl=detection_cache_ttl)
+
+
+def detect_animal_cached(image_bytes, stream_key, crops=None, refresh=False):
+    """
+    Detects and identifies animals in an image, reusing the result for an almost identical frame of the same stream.
+
+    Args:
+        image_bytes: The image in bytes.
+        stream_key: A key of the stream the frame was taken from. If `None`, the cache is not used.
+        crops: Parts of the frame to analyze instead of the whole frame, see `detect_animal_in_stream`.
+        refresh: If set, a stored result is not reused but replaced. The fingerprint is coarse, so a small object
+            which has just appeared may not change it; frames where the motion gate has seen a change are refreshed.
+
+    Returns:
+        results: An instance of `Detections` with the scores, class ids and boxes predicted by the model.
+    """
+    if stream_key is None:
+        return detect_animal(image_bytes)
+    # Regions of interest configured for the stream are applied before caching
+    variant = None if crops is None else tuple(tuple(round(x, 3) for point in crop for x in point) for crop in crops)
+    return detection_cache.get_or_detect(stream_key, image_bytes,
+                                         lambda image: detect_animal_in_stream(image, stream_key, crops), variant,
+                                         refresh)
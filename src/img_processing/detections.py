@@ -0,0 +1,40 @@
+import numpy as np
+
+
+class Detections:
+    """
+    Objects detected in one image stored as NumPy arrays.
+
+    Attributes:
+        scores: An array of shape (N,) with confidence scores.
+        class_ids: An integer array of shape (N,) with class ids of the model.
+        boxes: An array of shape (N, 4) with boxes in the format (top_left_x, top_left_y, bottom_right_x, bottom_right_y).
+
+    Methods:
+        obj_types: Names of the detected classes.
+        select: Return detections selected by a boolean mask or an array of indices.
+    """
+    def __init__(self, scores, class_ids, boxes):
+        self.scores = scores
+        self.class_ids = class_ids
+        self.boxes = boxes
+
+    def __len__(self):
+        return len(self.scores)
+
+    @property
+    def obj_types(self):
+        from model import get_label_names  # Loads torch, which is not needed until names are looked up
+        return get_label_names()[self.class_ids].tolist()
+
+    def select(self, selection):
+        return Detections(self.scores[selection], self.class_ids[selection], self.boxes[selection])
+
+
+def restore_detections(scores, class_ids, boxes):
+    """
+    Creates `Detections` from lists, e.g. received from a detection worker. Names of the classes are looked up
+    by the model configuration of this process.
+    """
+    return Detections(np.asarray(scores, dtype=np.float32), np.asarray(class_ids, dtype=np.int64),
+                      np.asarray(boxes, dtype=np.float32).reshape(-1, 4))
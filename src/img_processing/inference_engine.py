@@ -0,0 +1,184 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from static.settings import max_batch_size, max_batch_wait_time, inference_backend, inference_processes
+from monitoring.logs import get_logger
+from monitoring.metrics import registry, stage_seconds, batch_size
+from monitoring.profiling import profiler
+
+logger = get_logger(__name__)
+
+
+class InferenceEngine:
+    """
+    Central inference service. Frames submitted from all opened streams and `/now` requests are put into one queue,
+    grouped into micro-batches and processed with one forward pass of the model per batch.
+    Per-image results are routed back to the callers through futures.
+
+    Attributes:
+        detect_batch: A function that takes a list of images and returns a list of detection results.
+        max_batch_size (int): Maximum number of frames in one batch.
+        max_wait_time (float): Maximum time in seconds the first frame of a batch waits for other frames.
+        num_workers (int): Number of threads that run batches concurrently.
+
+    Methods:
+        submit: Put a frame into the queue and return a future with its detection result.
+        detect: Submit a frame and wait for its detection result.
+        queue_depth: Return the number of frames waiting in the queue.
+        warm_up: Run a detection on a blank frame in a background thread, so the model is loaded before real requests.
+        stop: Stop the worker threads.
+    """
+    def __init__(self, detect_batch, max_batch_size=8, max_wait_time=0.05, num_workers=1):
+        if max_batch_size < 1:
+            raise Exception("Maximum batch size should be positive.")
+
+        self.detect_batch = detect_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.num_workers = num_workers
+
+        self.requests = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()  # Used for starting and stopping the worker threads
+
+    def submit(self, image_bytes):
+        future = Future()
+        self._start_workers()
+        # While profiling, time of the batch is attributed to the streams of its frames
+        streams = profiler.current_streams() if profiler.is_active else None
+        self.requests.put((image_bytes, future, streams))
+        return future
+
+    def detect(self, image_bytes):
+        return self.submit(image_bytes).result()
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def warm_up(self):
+        def run_warm_up():
+            start_time = time.perf_counter()
+            self.detect(np.zeros((64, 64, 3), dtype=np.uint8))
+            logger.info(f"Inference engine is warmed up in {time.perf_counter() - start_time:.2f} s.")
+
+        thread = threading.Thread(target=run_warm_up, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        with self.lock:
+            for _ in self.workers:
+                self.requests.put(None)  # Each worker stops after receiving `None`
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+
+    def _start_workers(self):
+        # Workers are started on the first request, so importing the module does not create threads
+        with self.lock:
+            if self.workers:
+                return
+            for _ in range(self.num_workers):
+                worker = threading.Thread(target=self._process_batches, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def _collect_batch(self):
+        """
+        Waits for the first frame and then collects more frames until the batch is full or the waiting time is over.
+
+        Returns:
+            batch: A list of (image, future, streams) tuples. `None` if the worker should stop.
+        """
+        request = self.requests.get()
+        if request is None:
+            return None
+
+        batch = [request]
+        deadline = time.monotonic() + self.max_wait_time
+        while len(batch) < self.max_batch_size:
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining_time)
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)  # Return the stop signal, the current batch is processed first
+                break
+            batch.append(request)
+
+        return batch
+
+    def _process_batches(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+
+            # Skip frames which callers are no longer waiting for
+            batch = [request for request in batch if request[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            batch_size.observe(len(batch))
+            streams = [stream_key for _, _, stream_keys in batch for stream_key in stream_keys or ('other',)]
+            try:
+                # Includes the transfer to worker processes for the 'process' backend
+                with profiler.attribute(streams), stage_seconds.time(stage='inference'):
+                    results = self.detect_batch([image for image, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+
+def create_engine(backend):
+    """
+    Creates an inference engine with the specified backend.
+
+    Args:
+        backend: `'thread'` to run the model in the current process or `'process'` to run it in worker processes.
+
+    Returns:
+        An instance of `InferenceEngine`.
+    """
+    if backend == 'thread':
+        from model import detect_animals
+        return InferenceEngine(detect_animals, max_batch_size=max_batch_size, max_wait_time=max_batch_wait_time)
+
+    if backend == 'process':
+        from process_pool import ProcessPoolBackend
+        process_pool = ProcessPoolBackend(num_workers=inference_processes)
+        # One engine thread per worker process keeps all of them busy
+        return InferenceEngine(process_pool.detect_batch, max_batch_size=max_batch_size,
+                               max_wait_time=max_batch_wait_time, num_workers=inference_processes)
+
+    raise Exception(f"Unknown inference backend '{backend}'.")
+
+
+# The engine shared by all streams
+engine = create_engine(inference_backend)
+registry.gauge("animal_detection_inference_queue_depth", "Frames waiting for the model.", function=engine.queue_depth)
+
+
+def detect_animal(image_bytes):
+    """
+    Detects and identifies animals in an image. The image is processed by the shared inference engine
+    in one batch together with frames from other streams.
+
+    Args:
+        image_bytes: A byte array containing the image to be processed.
+
+    Returns:
+        results: An instance of `Detections` with the scores, class ids and boxes predicted by the model.
+    """
+    return engine.detect(image_bytes)
@@ -1,12 +1,248 @@
-from transformers import DetrImageProcessor, DetrForObjectDetection
+import copy
+import os
+import threading
+import time
+
+import numpy as np
 import torch
-from PIL import Image
 
-processor = DetrImageProcessor.from_pretrained("facebook/detr-resnet-50")
-model = DetrForObjectDetection.from_pretrained("facebook/detr-resnet-50")
+from static.settings import model_backend
+from monitoring.logs import get_logger
+from monitoring.metrics import stage_seconds
+from monitoring.profiling import profiler
+from preprocessing import preprocess
+from detections import Detections
+
+logger = get_logger(__name__)
+
+model_name = "facebook/detr-resnet-50"
+
+# Directory with a local snapshot of the model. If it exists, the model is loaded from it without network access.
+# The snapshot is created with `python model.py --save-snapshot`.
+local_model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weights', 'detr-resnet-50')
+
+# The model exported to ONNX. It is created on the first start of the 'onnx' backend.
+local_onnx_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weights', 'detr-resnet-50.onnx')
 
 confidence_threshold = 0.85
 
+# The processor, the model and the backend running it are loaded on the first detection
+processor = None
+model = None
+backend = None
+model_lock = threading.Lock()
+
+# An array of type `object` which maps class id to the name of the class
+label_names = None
+
+# Maps animal type to a boolean array which shows for each class id whether the class is unexpected for the animal
+unexpected_masks = {}
+
+# Time in seconds spent on loading the model and on the first detection. `None` until measured.
+startup_timings = {"load": None, "first_inference": None}
+
+
+def get_label_names():
+    """
+    Returns an array which maps class id to the name of the class. If the model is not loaded in this process
+    (e.g. detection runs in worker processes), only the configuration of the model is loaded.
+    """
+    global label_names
+
+    if label_names is None:
+        if model is not None:
+            id2label = model.config.id2label
+        else:
+            from transformers import DetrConfig
+            if os.path.isdir(local_model_dir):
+                id2label = DetrConfig.from_pretrained(local_model_dir, local_files_only=True).id2label
+            else:
+                id2label = DetrConfig.from_pretrained(model_name).id2label
+        names = np.empty(max(id2label.keys()) + 1, dtype=object)
+        names[:] = 'N/A'
+        for class_id, name in id2label.items():
+            names[class_id] = name
+        label_names = names
+
+    return label_names
+
+
+def get_unexpected_mask(animal_type):
+    """
+    Returns a boolean array which shows for each class id whether objects of this class are unexpected
+    on a stream with animals of the specified type. The array is computed once per animal type.
+    """
+    mask = unexpected_masks.get(animal_type)
+    if mask is None:
+        mask = get_label_names() != animal_type
+        unexpected_masks[animal_type] = mask
+    return mask
+
+
+class EagerBackend:
+    """
+    Runs the model in fp32 with eager PyTorch.
+
+    Attributes:
+        model: An instance of `DetrForObjectDetection`.
+
+    Methods:
+        forward: Run the model on preprocessed inputs and return outputs with `logits` and `pred_boxes`.
+    """
+    def __init__(self, model):
+        self.model = model
+
+    def forward(self, pixel_values, pixel_mask):
+        with torch.no_grad():
+            return self.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+
+
+class QuantizedBackend(EagerBackend):
+    """
+    Runs a copy of the model where linear layers (most of the transformer) are dynamically quantized to int8.
+    """
+    def __init__(self, model):
+        quantized_model = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {torch.nn.Linear},
+                                                                 dtype=torch.qint8)
+        super().__init__(quantized_model)
+
+
+class OnnxBackend:
+    """
+    Runs the model exported to ONNX with onnxruntime on CPU.
+
+    Attributes:
+        onnx_path: Path to the exported model. If the file does not exist, the model is exported on creation.
+        session: An instance of `onnxruntime.InferenceSession`.
+
+    Methods:
+        forward: Run the model on preprocessed inputs and return outputs with `logits` and `pred_boxes`.
+    """
+    def __init__(self, model, onnx_path=local_onnx_path):
+        import onnxruntime
+
+        self.onnx_path = onnx_path
+        if not os.path.exists(onnx_path):
+            export_to_onnx(model, onnx_path)
+        self.session = onnxruntime.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+
+    def forward(self, pixel_values, pixel_mask):
+        from transformers.models.detr.modeling_detr import DetrObjectDetectionOutput
+
+        logits, pred_boxes = self.session.run(["logits", "pred_boxes"], {
+            "pixel_values": pixel_values.numpy(),
+            "pixel_mask": pixel_mask.numpy(),
+        })
+        return DetrObjectDetectionOutput(logits=torch.from_numpy(logits), pred_boxes=torch.from_numpy(pred_boxes))
+
+
+class DetrOutputsWrapper(torch.nn.Module):
+    """
+    Returns only `logits` and `pred_boxes` of the model as a tuple. Used for the ONNX export.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values, pixel_mask):
+        outputs = self.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+        return outputs.logits, outputs.pred_boxes
+
+
+def export_to_onnx(model, onnx_path=local_onnx_path):
+    """
+    Exports the model to ONNX with dynamic batch size and image size.
+    The model is written into a temporary file which then replaces `onnx_path`, so an interrupted export
+    leaves no broken file, and worker processes exporting at the same time do not write into the same file.
+
+    Args:
+        model: An instance of `DetrForObjectDetection`.
+        onnx_path: Path of the resulting file.
+    """
+    os.makedirs(os.path.dirname(onnx_path), exist_ok=True)  # Make sure the directory exists
+    temporary_path = f"{onnx_path}.{os.getpid()}.tmp"
+    pixel_values = torch.zeros((1, 3, 800, 1066))
+    pixel_mask = torch.ones((1, 800, 1066), dtype=torch.int64)
+    try:
+        torch.onnx.export(DetrOutputsWrapper(model).eval(), (pixel_values, pixel_mask), temporary_path,
+                          input_names=["pixel_values", "pixel_mask"], output_names=["logits", "pred_boxes"],
+                          dynamic_axes={
+                              "pixel_values": {0: "batch", 2: "height", 3: "width"},
+                              "pixel_mask": {0: "batch", 1: "height", 2: "width"},
+                              "logits": {0: "batch"},
+                              "pred_boxes": {0: "batch"},
+                          },
+                          opset_version=17)
+        os.replace(temporary_path, onnx_path)  # Atomic within one directory
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def create_backend(backend_name, model):
+    """
+    Creates a backend which runs the model.
+
+    Args:
+        backend_name: `'eager'`, `'quantized'` or `'onnx'`.
+        model: An instance of `DetrForObjectDetection`.
+
+    Returns:
+        An instance of `EagerBackend`, `QuantizedBackend` or `OnnxBackend`.
+    """
+    if backend_name == 'eager':
+        return EagerBackend(model)
+    if backend_name == 'quantized':
+        return QuantizedBackend(model)
+    if backend_name == 'onnx':
+        return OnnxBackend(model)
+    raise Exception(f"Unknown model backend '{backend_name}'.")
+
+
+def load_model():
+    """
+    Loads the processor and the model if they are not loaded yet. The local snapshot is used if it exists,
+    otherwise the model is downloaded from the Hugging Face Hub. The backend selected by `model_backend` is created
+    for running the model.
+
+    Returns:
+        processor: An instance of `DetrImageProcessor`.
+        model: An instance of `DetrForObjectDetection`.
+    """
+    global processor, model, backend
+
+    with model_lock:
+        if model is None:
+            start_time = time.perf_counter()
+            # `transformers` is imported here because importing it takes noticeable time at startup
+            from transformers import DetrImageProcessor, DetrForObjectDetection
+            if os.path.isdir(local_model_dir):
+                processor = DetrImageProcessor.from_pretrained(local_model_dir, local_files_only=True)
+                loaded_model = DetrForObjectDetection.from_pretrained(local_model_dir, local_files_only=True)
+            else:
+                processor = DetrImageProcessor.from_pretrained(model_name)
+                loaded_model = DetrForObjectDetection.from_pretrained(model_name)
+            loaded_model.eval()
+            backend = create_backend(model_backend, loaded_model)
+            model = loaded_model
+
+            startup_timings["load"] = time.perf_counter() - start_time
+            logger.info(f"Model is loaded in {startup_timings['load']:.2f} s ('{model_backend}' backend).")
+
+    return processor, model
+
+
+def save_snapshot(directory=local_model_dir):
+    """
+    Saves the processor and the model (as safetensors) into a local directory.
+
+    Args:
+        directory: A directory where the snapshot should be saved.
+    """
+    processor, model = load_model()
+    processor.save_pretrained(directory)
+    model.save_pretrained(directory, safe_serialization=True)
+
 
 def detect_animal(image_bytes):
     """
@@ -16,18 +252,80 @@ def detect_animal(image_bytes):
         image_bytes: A byte array containing the image to be processed.
 
     Returns:
-        results: A list of dictionaries, each dictionary containing the scores, labels and boxes for an image
-        in the batch as predicted by the model.
+        results: An instance of `Detections` with the scores, class ids and boxes predicted by the model.
+    """
+    return detect_animals([image_bytes])[0]
+
+
+def detect_animals(images_bytes, detection_backend=None):
+    """
+    Detects and identifies animals in a batch of images with a single forward pass of the model.
+
+    Args:
+        images_bytes: A list of byte arrays containing the images to be processed.
+        detection_backend: A backend which runs the model. If `None`, the backend selected in the settings is used.
+
+    Returns:
+        results: A list of `Detections`, one for each image in the batch.
+    """
+    load_model()
+    detection_backend = detection_backend or backend
+    is_first_inference = startup_timings["first_inference"] is None
+    start_time = time.perf_counter()
+
+    # A few batches are traced with `torch.profiler` while profiling is running
+    with profiler.torch_trace():
+        # Frames are BGR. They are converted to RGB, resized and normalized straight into a reused buffer
+        with stage_seconds.time(stage='preprocess'):
+            pixel_values, pixel_mask = preprocess(images_bytes)
+        with stage_seconds.time(stage='forward'):
+            outputs = detection_backend.forward(pixel_values, pixel_mask)
+
+        with stage_seconds.time(stage='postprocess'):
+            target_sizes = [image_bytes.shape[:2] for image_bytes in images_bytes]
+            batch_results = postprocess_outputs(outputs, target_sizes, confidence_threshold)
+
+    if is_first_inference:
+        startup_timings["first_inference"] = time.perf_counter() - start_time
+        logger.info(f"First detection took {startup_timings['first_inference']:.2f} s.")
+
+    return batch_results
+
+
+def postprocess_outputs(outputs, target_sizes, threshold):
+    """
+    Converts outputs of the model into detections for the whole batch at once. Gives the same result as
+    `DetrImageProcessor.post_process_object_detection`.
+
+    Args:
+        outputs: Outputs of the model with `logits` and `pred_boxes`.
+        target_sizes: A list of (height, width) pairs of the original images.
+        threshold: Minimum confidence score of a detection.
+
+    Returns:
+        A list of `Detections`, one for each image in the batch.
     """
-    image = Image.fromarray(image_bytes)
-    inputs = processor(images=image, return_tensors="pt")
-    outputs = model(**inputs)
+    # The last class means "no object"
+    scores, class_ids = outputs.logits.softmax(-1)[..., :-1].max(-1)
+
+    # Convert boxes from (center_x, center_y, width, height) relative to the image size into absolute corners
+    center_x, center_y, width, height = outputs.pred_boxes.unbind(-1)
+    boxes = torch.stack([center_x - 0.5 * width, center_y - 0.5 * height,
+                         center_x + 0.5 * width, center_y + 0.5 * height], dim=-1)
+    scale = torch.tensor([[w, h, w, h] for h, w in target_sizes], dtype=boxes.dtype)
+    boxes = boxes * scale[:, None, :]
+
+    keep = (scores > threshold).numpy()
+    scores, class_ids, boxes = scores.numpy(), class_ids.numpy(), boxes.numpy()
+    return [Detections(scores[i][keep[i]], class_ids[i][keep[i]], boxes[i][keep[i]]) for i in range(len(target_sizes))]
+
 
-    target_sizes = torch.tensor([image.size[::-1]])
-    results = processor.post_process_object_detection(outputs, target_sizes=target_sizes, threshold=confidence_threshold)[0]
+if __name__ == "__main__":
+    import sys
 
-    # Convert results["labels"] of type `tensor` into results["obj_types"] of type `str`
-    results["obj_types"] = [model.config.id2label[label.item()] for label in results["labels"]]
-    results.pop("labels", None)
+    if sys.argv[1:] != ["--save-snapshot"]:
+        print("Usage: python model.py --save-snapshot")
+        sys.exit(1)
 
-    return results
+    save_snapshot()
+    print(f"The snapshot is saved into '{local_model_dir}'.")
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from static.settings import (motion_resize_width, motion_pixel_threshold, motion_change_threshold,
+                             motion_max_staleness, motion_learning_rate)
+
+
+class StreamMotionState:
+    """
+    Motion state of one stream.
+
+    Attributes:
+        background: A running average of small grayscale frames of type `float32`.
+        last_analysis_time (float): Time of the last frame which was passed to the model. `None` if there was no such frame.
+        motion_score (float): Share of changed pixels in the last frame.
+        frames_seen (int): Number of frames checked by the gate.
+        frames_skipped (int): Number of frames for which the model was not run.
+    """
+    def __init__(self):
+        self.background = None
+        self.last_analysis_time = None
+        self.motion_score = 0.0
+        self.frames_seen = 0
+        self.frames_skipped = 0
+
+
+class MotionGate:
+    """
+    Cheap pre-filter in front of the model. A frame is compared with a running background model of its stream,
+    and the model is run only if enough of the frame has changed or the stream has not been analyzed for too long.
+
+    Attributes:
+        resize_width (int): Width of the grayscale frame which is compared with the background.
+        pixel_threshold (int): Minimum difference of brightness for a pixel to be considered changed.
+        change_threshold (float): Minimum share of changed pixels for a frame to be analyzed.
+        max_staleness (float): Maximum time in seconds between two analyzed frames of a stream.
+        learning_rate (float): Weight of a new frame in the running background model.
+
+    Methods:
+        should_analyze: Update the background model of a stream and decide whether the frame should be analyzed.
+        motion_score: Return the share of changed pixels in the last frame of a stream.
+        stats: Return the numbers of seen and skipped frames of a stream.
+        reset: Forget the state of a stream.
+    """
+    def __init__(self, resize_width=64, pixel_threshold=25, change_threshold=0.01, max_staleness=60.0, learning_rate=0.05):
+        self.resize_width = resize_width
+        self.pixel_threshold = pixel_threshold
+        self.change_threshold = change_threshold
+        self.max_staleness = max_staleness
+        self.learning_rate = learning_rate
+
+        self.streams = {}  # Maps stream key to `StreamMotionState`
+        self.lock = threading.Lock()
+
+    def should_analyze(self, stream_key, image_bytes):
+        small = self._preprocess(image_bytes)
+        now = time.monotonic()
+
+        with self.lock:
+            state = self.streams.setdefault(stream_key, StreamMotionState())
+            state.frames_seen += 1
+
+            if state.background is None or state.background.shape != small.shape:
+                # The first frame of the stream is always analyzed
+                state.background = small.astype(np.float32)
+                state.motion_score = 1.0
+            else:
+                difference = cv2.absdiff(small.astype(np.float32), state.background)
+                state.motion_score = float(np.count_nonzero(difference > self.pixel_threshold)) / difference.size
+                cv2.accumulateWeighted(small, state.background, self.learning_rate)
+
+            is_stale = state.last_analysis_time is None or now - state.last_analysis_time >= self.max_staleness
+            if state.motion_score >= self.change_threshold or is_stale:
+                state.last_analysis_time = now
+                return True
+
+            state.frames_skipped += 1
+            return False
+
+    def motion_score(self, stream_key):
+        with self.lock:
+            state = self.streams.get(stream_key)
+            return state.motion_score if state is not None else 0.0
+
+    def stats(self, stream_key):
+        with self.lock:
+            state = self.streams.get(stream_key)
+            if state is None:
+                return {"frames_seen": 0, "frames_skipped": 0, "skipped_share": 0.0}
+            return {
+                "frames_seen": state.frames_seen,
+                "frames_skipped": state.frames_skipped,
+                "skipped_share": state.frames_skipped / state.frames_seen if state.frames_seen else 0.0,
+            }
+
+    def reset(self, stream_key):
+        with self.lock:
+            self.streams.pop(stream_key, None)
+
+    def _preprocess(self, image_bytes):
+        height, width = image_bytes.shape[:2]
+        resize_height = max(1, round(height * self.resize_width / width))
+
+        small = cv2.resize(image_bytes, (self.resize_width, resize_height), interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)  # Suppress compression noise
+
+
+# The gate shared by all daemon processes
+motion_gate = MotionGate(resize_width=motion_resize_width, pixel_threshold=motion_pixel_threshold,
+                         change_threshold=motion_change_threshold, max_staleness=motion_max_staleness,
+                         learning_rate=motion_learning_rate)
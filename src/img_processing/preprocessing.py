@@ -0,0 +1,135 @@
+import threading
+
+import cv2
+import numpy as np
+import torch
+
+# Parameters of `DetrImageProcessor` of the model
+shortest_edge = 800
+longest_edge = 1333
+image_mean = (0.485, 0.456, 0.406)
+image_std = (0.229, 0.224, 0.225)
+
+
+def get_resized_size(height, width, size=shortest_edge, max_size=longest_edge):
+    """
+    Computes the size of the resized image: the shorter side becomes `size` unless the longer side would
+    exceed `max_size`. Gives the same result as `get_size_with_aspect_ratio` of `transformers`.
+
+    Returns:
+        A pair (height, width).
+    """
+    raw_size = None
+    if max_size is not None:
+        min_original_size = float(min(height, width))
+        max_original_size = float(max(height, width))
+        if max_original_size / min_original_size * size > max_size:
+            raw_size = max_size * min_original_size / max_original_size
+            size = int(round(raw_size))
+
+    if (height <= width and height == size) or (width <= height and width == size):
+        return height, width
+    if width < height:
+        return int((raw_size or size) * height / width), size
+    return size, int((raw_size or size) * width / height)
+
+
+class Preprocessor:
+    """
+    Prepares a batch of BGR frames for the model with cv2 and NumPy: converts colours to RGB, resizes with
+    the aspect ratio preserved, normalizes and pads to the largest image of the batch. The result is written straight
+    into preallocated `torch` buffers (pinned if CUDA is available), which grow to the largest batch seen
+    and are reused by later calls. Produces the same inputs as `DetrImageProcessor` up to resize interpolation.
+
+    The returned tensors are views of the buffers, so they are valid only until the next call. One instance
+    should be used by one thread at a time.
+
+    Attributes:
+        size (int): Target length of the shorter side.
+        max_size (int): Maximum length of the longer side.
+        pin_memory (bool): Whether the buffers are in pinned memory for fast transfer to the GPU.
+
+    Methods:
+        __call__: Preprocess a list of frames and return `pixel_values` and `pixel_mask`.
+    """
+    def __init__(self, size=shortest_edge, max_size=longest_edge, mean=image_mean, std=image_std, pin_memory=None):
+        self.size = size
+        self.max_size = max_size
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+
+        # (x / 255 - mean) / std is computed as x * scale - offset
+        self.scale = (1 / (255 * np.asarray(std, dtype=np.float32))).astype(np.float32)
+        self.offset = (np.asarray(mean, dtype=np.float32) / np.asarray(std, dtype=np.float32)).astype(np.float32)
+
+        self.values_buffer = torch.empty(0, dtype=torch.float32)
+        self.mask_buffer = torch.empty(0, dtype=torch.int64)
+        self.resized_buffers = {}  # Maps (height, width) to a uint8 array for the resized frame
+
+    def __call__(self, images_bytes):
+        sizes = [get_resized_size(*image_bytes.shape[:2], self.size, self.max_size) for image_bytes in images_bytes]
+        batch_height = max(height for height, _ in sizes)
+        batch_width = max(width for _, width in sizes)
+        pixel_values, pixel_mask = self._get_buffers(len(images_bytes), batch_height, batch_width)
+
+        values = pixel_values.numpy()
+        mask = pixel_mask.numpy()
+        mask.fill(0)
+        for index, (image_bytes, (height, width)) in enumerate(zip(images_bytes, sizes)):
+            resized = self._resize(image_bytes, height, width)
+            for channel in range(3):
+                # BGR -> RGB: channel `channel` of the model input is channel `2 - channel` of the frame
+                target = values[index, channel, :height, :width]
+                np.multiply(resized[:, :, 2 - channel], self.scale[channel], out=target, casting='unsafe')
+                np.subtract(target, self.offset[channel], out=target)
+
+            # Zero padding on the bottom and on the right
+            values[index, :, height:, :] = 0
+            values[index, :, :height, width:] = 0
+            mask[index, :height, :width] = 1
+
+        return pixel_values, pixel_mask
+
+    def _get_buffers(self, batch_size, height, width):
+        # Contiguous tensors of the needed shape are views of the beginning of the buffers
+        values_size = batch_size * 3 * height * width
+        if self.values_buffer.numel() < values_size:
+            self.values_buffer = torch.empty(values_size, dtype=torch.float32, pin_memory=self.pin_memory)
+        mask_size = batch_size * height * width
+        if self.mask_buffer.numel() < mask_size:
+            self.mask_buffer = torch.empty(mask_size, dtype=torch.int64, pin_memory=self.pin_memory)
+        return (self.values_buffer[:values_size].view(batch_size, 3, height, width),
+                self.mask_buffer[:mask_size].view(batch_size, height, width))
+
+    def _resize(self, image_bytes, height, width):
+        resized = self.resized_buffers.get((height, width))
+        if resized is None:
+            if len(self.resized_buffers) >= 8:
+                self.resized_buffers.clear()  # Streams with many different frame sizes do not keep all buffers
+            resized = self.resized_buffers[(height, width)] = np.empty((height, width, 3), dtype=np.uint8)
+
+        # Area interpolation is close to the antialiased bilinear resize of PIL when downscaling
+        is_downscaled = height < image_bytes.shape[0]
+        cv2.resize(image_bytes, (width, height), dst=resized,
+                   interpolation=cv2.INTER_AREA if is_downscaled else cv2.INTER_LINEAR)
+        return resized
+
+
+# Each thread running the model gets its own preprocessor, since the buffers are reused between calls
+local_preprocessors = threading.local()
+
+
+def preprocess(images_bytes):
+    """
+    Preprocesses a batch of BGR frames for the model with the preprocessor of the current thread.
+
+    Args:
+        images_bytes: A list of BGR images as byte arrays of shape (height, width, 3).
+
+    Returns:
+        pixel_values: A float tensor of shape (batch, 3, height, width). Valid until the next call in this thread.
+        pixel_mask: An integer tensor of shape (batch, height, width). Valid until the next call in this thread.
+    """
+    preprocessor = getattr(local_preprocessors, "preprocessor", None)
+    if preprocessor is None:
+        preprocessor = local_preprocessors.preprocessor = Preprocessor()
+    return preprocessor(images_bytes)
@@ -1,131 +1,230 @@
 import os
 import cv2
+import logging
+import numpy as np
+import uuid
 from datetime import datetime
-from model import detect_animal
+from static.settings import jpeg_quality, jpeg_max_width, archive_dir
+from static.sources import stream_registry
+from monitoring.logs import get_logger
+from monitoring.metrics import stage_seconds
+from model import get_unexpected_mask, Detections
+from detection_cache import detect_animal_cached
+from inference_engine import engine
+from cascade import cascade, detect_with_cascade
 
+logger = get_logger(__name__)
 
-def highlight_all_objects(image_bytes):
+
+def highlight_all_objects(image_bytes, stream_key=None):
     """
-    Highlights objects detected in the image. The resulting image with highlighted objects is created
-    and saved in the `output` directory.
+    Highlights objects detected in the image. The resulting image with highlighted objects is encoded into JPEG
+    in memory and, if `archive_dir` is set, saved there as well.
 
     Args:
         image_bytes: The image in bytes.
+        stream_key: A key of the stream the image was taken from. Used to reuse detection results of the same frame.
 
     Returns:
-        file_name: Name of the jpg file where the result is saved.
+        photo: The resulting image encoded into JPEG.
     """
     # Find objects on the image
-    detected_objects = detect_animal(image_bytes)
-    print_detected_objects_info(detected_objects)
+    detected_objects = detect_animal_cached(image_bytes, stream_key)
+    log_detected_objects(detected_objects)
 
-    # Process detected objects
-    result = image_bytes
-    for score, box in zip(detected_objects["scores"], detected_objects["boxes"]):
-        # Highlight the detected object in the `result` image
-        result = highlight_object(result, box, is_unexpected=False)
+    # Highlight the detected objects in the `result` image
+    result = highlight_objects(image_bytes, detected_objects.boxes, is_unexpected=False)
 
-    # Write result into a jpg file
-    date = datetime.now().strftime('%y-%m-%d:%H:%M:%S')
-    file_name = write_into_jpg_file('../img', result, f'output_{date}')
+    # Encode the result
+    photo = encode_jpeg(result)
+    archive_jpeg(photo, 'output', stream_key)
 
-    return file_name
+    return photo
 
 
-def highlight_object(image_bytes, box, is_unexpected):
+def highlight_objects(image_bytes, boxes, is_unexpected):
     """
-    Highlights the object specified by coordinates.
+    Highlights the objects specified by coordinates.
 
     Args:
         image_bytes: The image in bytes.
-        box: A tuple of two two-dimensional coordinates in the format (top_left_x, top_left_y, bottom_right_x, bottom_right_y).
-        is_unexpected: A boolean flag showing whether the detected object is an unexpected object.
+        boxes: An array of shape (N, 4) with boxes in the format (top_left_x, top_left_y, bottom_right_x, bottom_right_y).
+        is_unexpected: A boolean flag showing whether the detected objects are unexpected objects.
+
+    Returns:
+        result: A copy of the image with highlighted objects. The original image is not changed, since it may be
+        shared with other consumers of the stream.
     """
-    result = image_bytes
-    x1, y1, x2, y2 = [int(coord) for coord in box]
+    with stage_seconds.time(stage='draw'):
+        result = image_bytes.copy()
 
-    # If the detected object is an unexpected object, it is highlighted with red. Otherwise, green is used.
-    color = (0, 255, 0)
-    if is_unexpected:
-        color = (0, 0, 255)
+        # If the detected object is an unexpected object, it is highlighted with red. Otherwise, green is used.
+        color = (0, 255, 0)
+        if is_unexpected:
+            color = (0, 0, 255)
 
-    # Highlight the object
-    cv2.rectangle(result, (x1, y1), (x2, y2), color=color, thickness=2)
+        # Highlight the objects. Coordinates of all boxes are converted at once
+        for x1, y1, x2, y2 in boxes.astype(np.int32).tolist():
+            cv2.rectangle(result, (x1, y1), (x2, y2), color=color, thickness=2)
     return result
 
 
 def check_something_unexpected(image_bytes, animal_type):
     """
-    Checks if the type of the detected object is not as expected. If something unexpected is found, a jpg file
-    with the highlighted object is created and saved in the `unexpected` directory.
+    Checks if the type of the detected object is not as expected. If something unexpected is found, the image
+    with the highlighted objects is encoded into JPEG in memory and, if `archive_dir` is set, saved there as well.
 
     Args:
         image_bytes: The image in bytes.
         animal_type: The expected type of objects.
 
         Returns:
-            file_name: Name of the jpg file where the unexpected objects are highlighted. Its value is the date and time when the objects were detected.
+            photo: The image with highlighted unexpected objects encoded into JPEG. `None` if nothing unexpected is found.
             unexpected_objects: A list describing what types the unexpected objects have.
     """
-    # Find objects on the image
-    detected_objects = detect_animal(image_bytes)
+    unexpected = find_unexpected_objects(image_bytes, animal_type)
+    unexpected_objects = unexpected.obj_types  # Types of the unexpected objects
+    log_unexpected_objects(animal_type, unexpected_objects)
 
-    # Process detected objects
-    result = image_bytes
-    unexpected_objects = list()
+    # Nothing to draw or save if all objects are expected
+    if len(unexpected) == 0:
+        return None, []
 
-    for score, object_type, box in zip(detected_objects["scores"], detected_objects["obj_types"], detected_objects["boxes"]):
-        # Check if something unexpected was found
-        if object_type != animal_type:
-            result = highlight_object(result, box, is_unexpected=True)  # Highlight the object in the resulting image
-            unexpected_objects.append(object_type)                      # Save the type of the object
+    return render_unexpected_objects(image_bytes, unexpected, animal_type), unexpected_objects
 
-    print_unexpected_objects_info(animal_type, unexpected_objects)
 
-    # Save result into a jpg file if any unexpected objects were detected
-    file_name = None
-    if len(unexpected_objects) > 0:
-        date = datetime.now().strftime('%y-%m-%d:%H:%M:%S')
-        file_name = write_into_jpg_file('../img', result, f'unexpected_{date}')
+def find_unexpected_objects(image_bytes, animal_type, refresh=False):
+    """
+    Detects objects in the image and selects those which are unexpected for the animal type.
+
+    Args:
+        image_bytes: The image in bytes.
+        animal_type: The expected type of objects.
+        refresh: If set, a cached result of an almost identical frame is not reused, but the new result is stored.
+
+    Returns:
+        unexpected: An instance of `Detections` with the unexpected objects only.
+    """
+    # Find objects on the image. Frames of the same stream share detection results.
+    # If the cascade is enabled, DETR is run only on frames where the pre-detector sees something suspicious
+    detected_objects = detect_with_cascade(image_bytes, animal_type,
+                                           lambda image, crops=None: detect_animal_cached(image, animal_type, crops,
+                                                                                          refresh))
+
+    # Select objects of classes which are unexpected for the animal type expected on the stream
+    unexpected_mask = get_unexpected_mask(stream_registry.animal_type(animal_type))
+    return detected_objects.select(unexpected_mask[detected_objects.class_ids])
+
+
+def render_unexpected_objects(image_bytes, unexpected, animal_type):
+    """
+    Highlights the unexpected objects and encodes the image into JPEG in memory. If `archive_dir` is set,
+    the image is saved there as well.
+
+    Args:
+        image_bytes: The image in bytes.
+        unexpected: An instance of `Detections` with the unexpected objects.
+        animal_type: The expected type of objects.
+
+    Returns:
+        photo: The image with highlighted unexpected objects encoded into JPEG.
+    """
+    result = highlight_objects(image_bytes, unexpected.boxes, is_unexpected=True)
 
-    return file_name, unexpected_objects
+    # Encode the result
+    photo = encode_jpeg(result)
+    archive_jpeg(photo, 'unexpected', animal_type)
+    return photo
 
 
-def write_into_jpg_file(dir_name, image_bytes, image_name):
+def encode_jpeg(image_bytes, quality=jpeg_quality, max_width=jpeg_max_width):
     """
-    Creates a jpg file.
+    Encodes the image into JPEG in memory.
 
     Args:
-        dir_name: Name of the directory where the file should be saved.
         image_bytes: The image in bytes.
-        image_name: Name used when creating a pjg file.
+        quality: JPEG quality from 0 to 100.
+        max_width: If the image is wider, it is downscaled to this width before encoding. `None` disables downscaling.
+
+    Returns:
+        photo: The encoded image of type `bytes`. It can be sent to the bot directly.
+    """
+    with stage_seconds.time(stage='encode'):
+        height, width = image_bytes.shape[:2]
+        if max_width is not None and width > max_width:
+            image_bytes = cv2.resize(image_bytes, (max_width, round(height * max_width / width)), interpolation=cv2.INTER_AREA)
+
+        is_encoded, buffer = cv2.imencode('.jpg', image_bytes, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not is_encoded:
+        raise Exception("Failed to encode the image into JPEG.")
+    return buffer.tobytes()
+
+
+def archive_jpeg(photo, prefix, stream_key=None, dir_name=archive_dir):
+    """
+    Saves an encoded image into the archive directory. Does nothing if the archive is disabled.
+
+    Args:
+        photo: The image encoded into JPEG.
+        prefix: A prefix of the file name, e.g. 'output' or 'unexpected'.
+        stream_key: A key of the stream the image was taken from.
+        dir_name: The archive directory. If `None`, the image is not saved.
 
     Returns:
-        file_name: Name of the jpg file where the result is saved.
+        file_name: Name of the saved jpg file. `None` if the image is not saved.
     """
+    if dir_name is None:
+        return None
+
+    # A random suffix prevents collisions between streams processed at the same millisecond
+    date = datetime.now().strftime('%y-%m-%d_%H-%M-%S-%f')[:-3]
+    file_name = os.path.join(dir_name, f'{prefix}_{stream_key}_{date}_{uuid.uuid4().hex[:8]}.jpg')
+
     os.makedirs(dir_name, exist_ok=True)  # Make sure the directory exists
-    file_name = os.path.join(dir_name, f'{image_name}.jpg')
-    cv2.imwrite(file_name, image_bytes)
+    with open(file_name, 'wb') as file:
+        file.write(photo)
     return file_name
 
 
-def print_detected_objects_info(objects):
+def inference_queue_depth():
+    """
+    Returns the number of frames waiting for the model in the shared inference engine.
+    """
+    return engine.queue_depth()
+
+
+def cascade_stats(stream_key):
+    """
+    Returns the numbers of frames of a stream for which the cascade skipped DETR or ran it.
+    `None` if the cascade is disabled.
+    """
+    return cascade.stats(stream_key) if cascade is not None else None
+
+
+def warm_up_detection():
+    """
+    Loads the model in the background, so the first request does not wait for it.
+    """
+    return engine.warm_up()
+
+
+def log_detected_objects(objects):
     """
-    Prints information about objects detected in the image.
+    Logs information about objects detected in the image at the debug level.
 
     Args:
-        objects: A list of dictionaries, each dictionary containing the `scores`, `obj_types` and `boxes` keys for an image in the batch as predicted by the model.
+        objects: An instance of `Detections` with objects detected in the image.
     """
-    for score, object_type, box in zip(objects["scores"], objects["obj_types"], objects["boxes"]):
-        box = [round(i, 2) for i in box.tolist()]
-        print(f"Detected {object_type} with confidence {round(score.item(), 3)} at location {box}")
-    print()
+    if not logger.isEnabledFor(logging.DEBUG):
+        return  # Formatting is skipped when debug records are dropped anyway
+    scores = np.round(objects.scores, 3).tolist()
+    boxes = np.round(objects.boxes, 2).tolist()
+    for score, object_type, box in zip(scores, objects.obj_types, boxes):
+        logger.debug(f"Detected {object_type} with confidence {score} at location {box}")
 
 
-def print_unexpected_objects_info(animal_type, unexpected_objects):
-    print(f"'{animal_type}' [{datetime.now().strftime('%y-%m-%d:%H:%M:%S')}]:")
+def log_unexpected_objects(animal_type, unexpected_objects):
     if len(unexpected_objects) > 0:
-        print(f"Detected {', '.join(map(repr, unexpected_objects))}.")
+        logger.info(f"Detected {', '.join(map(repr, unexpected_objects))}.", extra={"stream": animal_type})
     else:
-        print(f"Nothing unexpected is detected.")
-    print()
+        logger.debug("Nothing unexpected is detected.", extra={"stream": animal_type})
@@ -0,0 +1,201 @@
+import atexit
+import multiprocessing
+import os
+import queue
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+
+from monitoring.logs import get_logger
+
+logger = get_logger(__name__)
+
+# Errors of the pipe when the worker process at its other end has died, e.g. killed for running out of memory
+worker_lost_errors = (EOFError, BrokenPipeError, ConnectionResetError)
+
+
+def run_worker(connection, shm_name, num_threads):
+    """
+    Main function of a worker process. The model is loaded once, then batches of frames are read from shared memory
+    and detection results are sent back through the connection.
+
+    Args:
+        connection: A `multiprocessing.connection.Connection` used for receiving tasks and sending results.
+        shm_name: Name of the shared memory block where the parent process writes frames.
+        num_threads: Number of threads torch may use in this process.
+    """
+    torch.set_num_threads(num_threads)
+    from model import detect_animals, load_model
+    load_model()
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        while True:
+            task = connection.recv()
+            if task is None:
+                break
+
+            command, argument = task
+            if command == "attach":
+                # The parent process has allocated a bigger block
+                shm.close()
+                shm = shared_memory.SharedMemory(name=argument)
+                continue
+
+            # Build arrays on top of the shared memory without copying the frames
+            frames = [np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset) for offset, shape in argument]
+            try:
+                results = detect_animals(frames)
+            except Exception as e:
+                connection.send(("error", repr(e)))
+                continue
+            finally:
+                del frames  # Release views of the shared memory
+
+            connection.send(("ok", results))  # `Detections` consist of small NumPy arrays
+    finally:
+        shm.close()
+
+
+class InferenceWorker:
+    """
+    Handle of one worker process owned by the parent process.
+
+    Attributes:
+        process: An instance of `multiprocessing.Process`.
+        connection: The parent end of the pipe connected to the process.
+        shm: A `SharedMemory` block where frames for the process are written.
+    """
+    def __init__(self, context, size, num_threads):
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=run_worker, args=(child_connection, self.shm.name, num_threads),
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def ensure_capacity(self, size):
+        if size <= self.shm.size:
+            return
+        new_shm = shared_memory.SharedMemory(create=True, size=size)
+        self.connection.send(("attach", new_shm.name))
+        self.release_memory()
+        self.shm = new_shm
+
+    def release_memory(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def close(self):
+        """
+        Stops the process if it is alive and frees its shared memory.
+        """
+        try:
+            self.connection.send(None)
+        except worker_lost_errors:
+            pass  # The process has already died
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+        self.release_memory()
+
+
+class ProcessPoolBackend:
+    """
+    Runs the model in separate worker processes, so detection is not serialized by the GIL of the bot process.
+    Each worker loads the model once. Frames are written into a shared memory block of the worker instead of being
+    pickled, only their offsets and shapes are sent through a pipe.
+
+    Attributes:
+        num_workers (int): Number of worker processes.
+        threads_per_worker (int): Number of torch threads in each worker. By default, CPU cores are split evenly.
+        initial_size (int): Initial size in bytes of the shared memory block of each worker.
+
+    Methods:
+        detect_batch: Detect objects in a batch of frames using a free worker. A worker which has died is replaced.
+        stop: Stop the worker processes and free shared memory.
+    """
+    def __init__(self, num_workers=2, threads_per_worker=None, initial_size=8 * 1920 * 1080 * 3):
+        if num_workers < 1:
+            raise Exception("Number of inference workers should be positive.")
+
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+        self.initial_size = initial_size
+
+        self.workers = []
+        self.free_workers = queue.Queue()
+        self.lock = threading.Lock()  # Used for starting and stopping the workers
+
+    def detect_batch(self, images_bytes):
+        self._start_workers()
+        worker = self.free_workers.get()
+        try:
+            return self._detect_with_worker(worker, images_bytes)
+        except worker_lost_errors:
+            # The batch fails, but later batches go to a new process instead of the dead one
+            worker = self._replace_worker(worker)
+            raise
+        finally:
+            if worker is not None:
+                self.free_workers.put(worker)
+
+    def stop(self):
+        with self.lock:
+            for worker in self.workers:
+                worker.close()
+            self.workers = []
+            self.free_workers = queue.Queue()
+
+    def _start_workers(self):
+        # Workers are started on the first batch, so importing the module does not create processes
+        with self.lock:
+            if self.workers:
+                return
+            context = multiprocessing.get_context("spawn")
+            for _ in range(self.num_workers):
+                worker = InferenceWorker(context, self.initial_size, self.threads_per_worker)
+                self.workers.append(worker)
+                self.free_workers.put(worker)
+            atexit.register(self.stop)
+
+    def _replace_worker(self, worker):
+        """
+        Returns:
+            A new worker started in place of the dead one. `None` if the pool has been stopped meanwhile.
+        """
+        with self.lock:
+            if worker not in self.workers:
+                return None
+            worker.close()
+            logger.error(f"Inference worker process {worker.process.pid} has died "
+                         f"(exit code {worker.process.exitcode}), starting a new one.")
+            new_worker = InferenceWorker(multiprocessing.get_context("spawn"), self.initial_size,
+                                         self.threads_per_worker)
+            self.workers[self.workers.index(worker)] = new_worker
+            return new_worker
+
+    def _detect_with_worker(self, worker, images_bytes):
+        images_bytes = [np.ascontiguousarray(image_bytes, dtype=np.uint8) for image_bytes in images_bytes]
+        worker.ensure_capacity(sum(image_bytes.nbytes for image_bytes in images_bytes))
+
+        # Copy frames one after another into the shared memory block
+        layout = []
+        offset = 0
+        for image_bytes in images_bytes:
+            destination = np.ndarray(image_bytes.shape, dtype=np.uint8, buffer=worker.shm.buf, offset=offset)
+            np.copyto(destination, image_bytes)
+            del destination  # Release the view, so the block can be closed later
+            layout.append((offset, image_bytes.shape))
+            offset += image_bytes.nbytes
+
+        worker.connection.send(("detect", layout))
+        status, response = worker.connection.recv()
+        if status != "ok":
+            raise Exception(f"Inference worker failed: {response}")
+
+        return response
@@ -1,48 +1,250 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
 from vidgear.gears import CamGear
 from process_image import highlight_all_objects, check_something_unexpected
+from static.settings import frame_buffer_size
+from monitoring.metrics import stage_seconds
+
+
+class VideoFileSource:
+    """
+    A local video file used as a stream source, e.g. for testing offline.
+
+    Attributes:
+        path: Path to the video file.
+        realtime (bool): If set, frames are returned not faster than the fps of the video, like in a live stream.
+        loop (bool): If set, the video starts from the beginning when it ends.
+
+    Methods:
+        read: Return the next frame or `None` if the video has ended.
+        read_into: Decode the next frame into the given array if it has a suitable shape.
+        stop: Close the file.
+    """
+    def __init__(self, path, realtime=True, loop=False):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise Exception(f"Cannot open video file '{path}'.")
+        fps = self.capture.get(cv2.CAP_PROP_FPS)
+        self.frame_interval = 1 / fps if fps > 0 else 0
+        self.next_frame_time = time.monotonic()
+
+    def read(self):
+        return self.read_into(None)
+
+    def read_into(self, frame):
+        if self.realtime:
+            time.sleep(max(0.0, self.next_frame_time - time.monotonic()))
+            self.next_frame_time = max(self.next_frame_time + self.frame_interval, time.monotonic())
+
+        is_read, frame = self.capture.read(frame)
+        if not is_read and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            is_read, frame = self.capture.read(frame)
+        return frame if is_read else None
+
+    def stop(self):
+        self.capture.release()
+
+
+class FrameGrabber:
+    """
+    Decodes frames of a source continuously in a background thread into a small ring buffer of preallocated arrays.
+    Consumers get the newest frame, or the frame nearest to a timestamp, without copying: a frame is pinned
+    while it is used, and the grabber never writes into pinned slots.
+
+    Attributes:
+        source: A stream source with a `read` method (`CamGear`, `VideoFileSource`).
+        buffer_size (int): Number of frames in the ring buffer.
+
+    Methods:
+        start: Start decoding.
+        stop: Stop decoding and close the source.
+        latest_frame: A context manager which pins the newest frame and returns it with its monotonic timestamp.
+        frame_near: A context manager which pins the frame nearest to a monotonic timestamp.
+        read: Return a copy of the newest frame. Compatible with `CamGear.read`.
+    """
+    def __init__(self, source, buffer_size=4):
+        if buffer_size < 2:
+            raise Exception("Frame buffer should contain at least two frames.")
+
+        self.source = source
+        self.buffer_size = buffer_size
+
+        self.frames = [None] * buffer_size
+        self.timestamps = np.full(buffer_size, np.nan)  # `nan` marks slots without a complete frame
+        self.pins = [0] * buffer_size                    # Number of consumers using each slot
+        self.latest_index = None
+        self.is_finished = False
+        self.is_stopped = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._decode_frames, daemon=True)
+        self.thread.start()
+        return self
 
+    def stop(self):
+        with self.condition:
+            self.is_stopped = True
+            self.condition.notify_all()
 
-def get_current_frame(video_stream):
+        # The source is closed after the decoding thread has left `read`, otherwise the decoder may crash the process.
+        # A source which blocks in `read` for longer is closed anyway, which also wakes up the thread
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+        self.source.stop()
+
+    @contextmanager
+    def latest_frame(self, timeout=None):
+        with self.condition:
+            # Wait for the first frame
+            self.condition.wait_for(lambda: self.latest_index is not None or self.is_finished or self.is_stopped,
+                                    timeout)
+            index = self.latest_index if not (self.is_finished or self.is_stopped) else None
+            if index is not None:
+                self.pins[index] += 1
+
+        try:
+            yield (self.frames[index], self.timestamps[index]) if index is not None else (None, None)
+        finally:
+            self._unpin(index)
+
+    @contextmanager
+    def frame_near(self, timestamp):
+        with self.condition:
+            index = None
+            if not np.isnan(self.timestamps).all():
+                index = int(np.nanargmin(np.abs(self.timestamps - timestamp)))
+                self.pins[index] += 1
+
+        try:
+            yield (self.frames[index], self.timestamps[index]) if index is not None else (None, None)
+        finally:
+            self._unpin(index)
+
+    def read(self):
+        with self.latest_frame() as (frame, _):
+            return frame.copy() if frame is not None else None
+
+    def _unpin(self, index):
+        if index is None:
+            return
+        with self.condition:
+            self.pins[index] -= 1
+
+    def _take_free_slot(self):
+        """
+        Returns the index of the oldest slot which is neither pinned nor the newest frame. The slot is marked
+        as incomplete until a new frame is written into it. `None` if all such slots are pinned.
+        """
+        with self.condition:
+            free_slots = [i for i in range(self.buffer_size) if self.pins[i] == 0 and i != self.latest_index]
+            if not free_slots:
+                return None
+            index = min(free_slots, key=lambda i: -np.inf if np.isnan(self.timestamps[i]) else self.timestamps[i])
+            self.timestamps[index] = np.nan
+            return index
+
+    def _decode_frames(self):
+        while not self.is_stopped:
+            index = self._take_free_slot()
+            if index is None:
+                self.source.read()  # All slots are in use, the frame is dropped
+                continue
+
+            read_start_time = time.perf_counter()
+            if hasattr(self.source, "read_into"):
+                frame = self.source.read_into(self.frames[index])  # The array is reused if it has a suitable shape
+            else:
+                frame = self.source.read()
+                if frame is not None:
+                    if self.frames[index] is None or self.frames[index].shape != frame.shape:
+                        self.frames[index] = np.empty_like(frame)
+                    np.copyto(self.frames[index], frame)
+            stage_seconds.observe(time.perf_counter() - read_start_time, stage='read')
+
+            with self.condition:
+                if frame is None:
+                    self.is_finished = True
+                    self.condition.notify_all()
+                    break
+                if hasattr(self.source, "read_into"):
+                    self.frames[index] = frame
+                self.timestamps[index] = time.monotonic()
+                self.latest_index = index
+                self.condition.notify_all()
+
+
+def get_current_frame(video_stream, stream_key=None):
     """
     Extracts one frame from the livestream to show what is happening now.
-    Objects detected in the frame are highlighted, and the result is saved in a `jpg` format in the `output` directory.
+    Objects detected in the frame are highlighted, and the result is encoded into JPEG.
 
     Args:
-        video_stream: An instance of `CamGear` -- an opened stream source.
+        video_stream: An instance of `FrameGrabber` -- an opened stream source.
+        stream_key: A key of the stream. Used to reuse detection results of the same frame.
 
     Returns:
-        file_name: Name of the jpg file with the resulting image.
+        photo: The resulting image encoded into JPEG.
     """
     if video_stream is None:
         raise Exception("No stream source provided.")
 
-    frame = video_stream.read()               # Get the current frame
-    file_name = highlight_all_objects(frame)  # Process the frame
+    with video_stream.latest_frame() as (frame, _):   # Get the current frame
+        if frame is None:
+            raise Exception("The stream has ended.")
+        photo = highlight_all_objects(frame, stream_key)  # Process the frame
 
-    return file_name
+    return photo
 
 
-def start_camgear_stream(source_path):
+def open_video_source(source_path):
     """
     Opens the video source provided with the source path.
 
     Args:
-        source_path: A string representing the path to a YouTube live stream.
+        source_path: A string representing the path to a YouTube live stream or to a local video file.
 
     Returns:
-        An instance of `CamGear` with an opened source.
+        An instance of `VideoFileSource` for local files, otherwise an instance of `CamGear` with an opened source.
     """
+    if os.path.isfile(source_path):
+        return VideoFileSource(source_path)
+
     video_stream = CamGear(source=source_path, stream_mode=True)
     video_stream.start()  # Open the source
     return video_stream
 
 
-def stop_camgear_stream(video_stream):
+def start_video_stream(source_path):
+    """
+    Opens the video source and starts decoding its frames in the background.
+
+    Args:
+        source_path: A string representing the path to a YouTube live stream or to a local video file.
+
+    Returns:
+        An instance of `FrameGrabber` with an opened source.
+    """
+    return FrameGrabber(open_video_source(source_path), buffer_size=frame_buffer_size).start()
+
+
+def stop_video_stream(video_stream):
     """
     Closes the provided video source.
 
     Args:
-        video_stream: An instance of `CamGear` -- an opened stream source.
+        video_stream: An instance of `FrameGrabber` -- an opened stream source.
     """
     if video_stream is None:
         raise Exception("No video source provided.")
@@ -0,0 +1,163 @@
+import cv2
+import numpy as np
+
+from model import Detections
+from inference_engine import engine
+from static.stream_regions import stream_regions
+from static.sources import stream_registry
+
+# Boxes of the same class from different tiles overlapping more than this are merged
+nms_iou_threshold = 0.5
+
+
+def box_iou(box, boxes):
+    """
+    Computes IoU of one box with each of the boxes.
+
+    Args:
+        box: An array of shape (4,) in the format (top_left_x, top_left_y, bottom_right_x, bottom_right_y).
+        boxes: An array of shape (N, 4) in the same format.
+
+    Returns:
+        An array of shape (N,).
+    """
+    top_left = np.maximum(box[:2], boxes[:, :2])
+    bottom_right = np.minimum(box[2:], boxes[:, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=1)
+    area = np.prod(box[2:] - box[:2])
+    areas = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    return intersection / np.maximum(area + areas - intersection, 1e-9)
+
+
+def non_maximum_suppression(detections, iou_threshold=nms_iou_threshold):
+    """
+    Removes detections which overlap a detection of the same class with a higher score.
+
+    Args:
+        detections: An instance of `Detections`.
+        iou_threshold: Minimum IoU for two boxes to be considered the same object.
+
+    Returns:
+        An instance of `Detections` with the remaining detections.
+    """
+    order = np.argsort(-detections.scores)
+    keep = []
+    while order.size > 0:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        is_duplicate = (detections.class_ids[rest] == detections.class_ids[best]) & \
+                       (box_iou(detections.boxes[best], detections.boxes[rest]) > iou_threshold)
+        order = rest[~is_duplicate]
+    return detections.select(np.array(keep, dtype=np.int64))
+
+
+def get_tiles(frame_shape, regions):
+    """
+    Splits the regions of interest of a frame into tiles.
+
+    Args:
+        frame_shape: Shape of the frame.
+        regions: A dictionary with 'roi', 'tiles' and 'tile_overlap' keys as in `stream_regions`.
+
+    Returns:
+        A list of tiles (x1, y1, x2, y2) in pixel coordinates.
+    """
+    height, width = frame_shape[:2]
+    polygons = regions.get('roi') or [[(0, 0), (1, 0), (1, 1), (0, 1)]]
+    columns, rows = regions.get('tiles', (1, 1))
+    overlap = regions.get('tile_overlap', 0.0)
+
+    tiles = []
+    for polygon in polygons:
+        points = np.array(polygon, dtype=np.float64) * (width, height)
+        left, top = np.clip(points.min(axis=0), 0, (width, height)).astype(int)
+        right, bottom = np.clip(np.ceil(points.max(axis=0)), 0, (width, height)).astype(int)
+
+        tile_width, tile_height = (right - left) / columns, (bottom - top) / rows
+        margin_x, margin_y = tile_width * overlap / 2, tile_height * overlap / 2
+        for row in range(rows):
+            for column in range(columns):
+                x1 = max(left, int(left + column * tile_width - margin_x))
+                y1 = max(top, int(top + row * tile_height - margin_y))
+                x2 = min(right, int(np.ceil(left + (column + 1) * tile_width + margin_x)))
+                y2 = min(bottom, int(np.ceil(top + (row + 1) * tile_height + margin_y)))
+                if x2 > x1 and y2 > y1:
+                    tiles.append((x1, y1, x2, y2))
+    return tiles
+
+
+def centers_inside_polygons(boxes, polygons, frame_shape):
+    """
+    Returns a boolean array which shows for each box whether its center is inside one of the polygons.
+    """
+    height, width = frame_shape[:2]
+    centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+    is_inside = np.zeros(len(boxes), dtype=bool)
+    for polygon in polygons:
+        contour = (np.array(polygon) * (width, height)).astype(np.float32).reshape(-1, 1, 2)  # cv2 needs float32
+        is_inside |= np.array([cv2.pointPolygonTest(contour, (float(x), float(y)), False) >= 0 for x, y in centers],
+                              dtype=bool)
+    return is_inside
+
+
+def empty_detections():
+    return Detections(np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64), np.zeros((0, 4), dtype=np.float32))
+
+
+def detect_in_regions(image_bytes, regions):
+    """
+    Detects objects only inside the regions of interest of the image. The regions are split into tiles which are
+    processed by the model in one batch. Boxes are mapped back to frame coordinates and merged across tiles.
+
+    Args:
+        image_bytes: The image in bytes.
+        regions: A dictionary with 'roi', 'tiles' and 'tile_overlap' keys as in `stream_regions`.
+
+    Returns:
+        An instance of `Detections` in frame coordinates.
+    """
+    tiles = get_tiles(image_bytes.shape, regions)
+    if not tiles:
+        return empty_detections()  # The regions are empty after clipping to the frame
+
+    # All tiles are submitted at once, so the inference engine puts them into one batch
+    futures = [engine.submit(image_bytes[y1:y2, x1:x2]) for x1, y1, x2, y2 in tiles]
+    results = [future.result() for future in futures]
+
+    scores = np.concatenate([result.scores for result in results])
+    class_ids = np.concatenate([result.class_ids for result in results])
+    boxes = np.concatenate([result.boxes + np.array([x1, y1, x1, y1], dtype=result.boxes.dtype)
+                            for result, (x1, y1, _, _) in zip(results, tiles)]).reshape(-1, 4)
+    detections = Detections(scores, class_ids, boxes)
+
+    if regions.get('roi'):
+        detections = detections.select(centers_inside_polygons(detections.boxes, regions['roi'], image_bytes.shape))
+    if len(tiles) > 1:
+        detections = non_maximum_suppression(detections)
+    return detections
+
+
+def detect_animal_in_stream(image_bytes, stream_key, crops=None):
+    """
+    Detects objects in a frame of a stream, using the regions of interest configured for the stream.
+    Frames of streams without regions are processed as a whole.
+
+    Args:
+        image_bytes: The image in bytes.
+        stream_key: A key of the stream. Its regions are taken from the stream registry or from `stream_regions`.
+        crops: Polygons in the format of 'roi' (e.g. crops of the detector cascade). If given, only the crops are
+            analyzed, each as one tile, and objects outside the regions of interest of the stream are still dropped.
+
+    Returns:
+        An instance of `Detections`.
+    """
+    regions = stream_registry.regions(stream_key, stream_regions.get(stream_key))
+    if crops is not None:
+        detections = detect_in_regions(image_bytes, {'roi': crops, 'tiles': (1, 1)})
+        if regions is not None and regions.get('roi'):
+            detections = detections.select(centers_inside_polygons(detections.boxes, regions['roi'],
+                                                                   image_bytes.shape))
+        return detections
+    if regions is None or (not regions.get('roi') and tuple(regions.get('tiles', (1, 1))) == (1, 1)):
+        return engine.detect(image_bytes)
+    return detect_in_regions(image_bytes, regions)
@@ -0,0 +1,222 @@
+import threading
+import time
+
+import numpy as np
+
+from static.settings import (tracker_iou_threshold, tracker_max_centroid_distance, tracker_max_age,
+                             tracker_realert_interval)
+
+
+class Track:
+    """
+    An unexpected object followed across frames of one stream.
+
+    Attributes:
+        track_id (int): Identifier of the track, unique within the tracker.
+        class_id (int): Class of the object predicted by the model.
+        obj_type (str): Name of the class.
+        box: An array of shape (4,) with the last box of the object in the format (top_left_x, top_left_y, bottom_right_x, bottom_right_y).
+        first_seen (float): Time when the object appeared.
+        last_seen (float): Time when the object was seen last.
+        last_alert_time (float): Time of the last alert about the object. `None` if there was no alert.
+        alert_count (int): Number of alerts about the object.
+    """
+    def __init__(self, track_id, class_id, obj_type, box, now):
+        self.track_id = track_id
+        self.class_id = class_id
+        self.obj_type = obj_type
+        self.box = box
+        self.first_seen = now
+        self.last_seen = now
+        self.last_alert_time = None
+        self.alert_count = 0
+
+
+class StreamTracks:
+    """
+    Tracking state of one stream.
+
+    Attributes:
+        tracks (list): Live tracks of type `Track`.
+        tracks_created (int): Number of tracks created since the stream was opened.
+        alerts (int): Number of alerts about the tracks.
+        suppressed_frames (int): Number of frames with unexpected objects for which no alert was needed.
+    """
+    def __init__(self):
+        self.tracks = []
+        self.tracks_created = 0
+        self.alerts = 0
+        self.suppressed_frames = 0
+
+
+def pairwise_iou(boxes_a, boxes_b):
+    """
+    Computes IoU of each box of `boxes_a` with each box of `boxes_b`.
+
+    Args:
+        boxes_a: An array of shape (N, 4) in the format (top_left_x, top_left_y, bottom_right_x, bottom_right_y).
+        boxes_b: An array of shape (M, 4) in the same format.
+
+    Returns:
+        An array of shape (N, M).
+    """
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    areas_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    areas_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    return intersection / np.maximum(areas_a[:, None] + areas_b[None, :] - intersection, 1e-9)
+
+
+class ObjectTracker:
+    """
+    Lightweight multi-object tracker of unexpected objects. Detections of a new frame are associated with the live
+    tracks of the stream by IoU, or by the distance between box centers if the object has moved too far
+    for the boxes to overlap. An alert is needed only when a new track appears or a track has been seen
+    for `realert_interval` seconds since its last alert, so an object staying in view does not cause an alert every frame.
+
+    Attributes:
+        iou_threshold (float): Minimum IoU for a detection to continue a track.
+        max_centroid_distance (float): Maximum distance between box centers, relative to the diagonal of the track box,
+            for a detection without enough overlap to continue a track.
+        max_age (float): Time in seconds after which a track which is not seen is forgotten.
+        realert_interval (float): Time in seconds after which a track which is still seen causes a new alert.
+
+    Methods:
+        update: Associate the unexpected objects of a new frame with the tracks and return the tracks needing an alert.
+        keep_alive: Mark all tracks of a stream as seen, e.g. when a frame is skipped because the scene is static.
+        has_tracks: Return whether a stream has live tracks which were already reported.
+        stats: Return the counters of a stream.
+        reset: Forget the state of a stream.
+    """
+    def __init__(self, iou_threshold=0.3, max_centroid_distance=0.5, max_age=60.0, realert_interval=300.0):
+        self.iou_threshold = iou_threshold
+        self.max_centroid_distance = max_centroid_distance
+        self.max_age = max_age
+        self.realert_interval = realert_interval
+
+        self.streams = {}  # Maps stream key to `StreamTracks`
+        self.next_track_id = 1
+        self.lock = threading.Lock()
+
+    def update(self, stream_key, detections):
+        """
+        Args:
+            stream_key: A key of the stream.
+            detections: An instance of `Detections` with the unexpected objects of the frame.
+
+        Returns:
+            A list of tracks of type `Track` which need an alert. Tracks with `alert_count` equal to 1 are new.
+        """
+        now = time.monotonic()
+        boxes = np.asarray(detections.boxes, dtype=np.float32).reshape(-1, 4)
+        class_ids = np.asarray(detections.class_ids)
+
+        with self.lock:
+            state = self.streams.setdefault(stream_key, StreamTracks())
+            state.tracks = [track for track in state.tracks if now - track.last_seen <= self.max_age]
+
+            matches = self._associate(state.tracks, boxes, class_ids)
+            matched_detections = set()
+            for track_index, detection_index in matches:
+                track = state.tracks[track_index]
+                track.box = boxes[detection_index]
+                track.last_seen = now
+                matched_detections.add(detection_index)
+
+            if len(matched_detections) < len(boxes):
+                obj_types = detections.obj_types
+                for detection_index in range(len(boxes)):
+                    if detection_index not in matched_detections:
+                        state.tracks.append(Track(self.next_track_id, int(class_ids[detection_index]),
+                                                  obj_types[detection_index], boxes[detection_index], now))
+                        self.next_track_id += 1
+                        state.tracks_created += 1
+
+            alerts = []
+            for track in state.tracks:
+                if track.last_seen != now:
+                    continue  # Not seen in this frame
+                if track.last_alert_time is None or now - track.last_alert_time >= self.realert_interval:
+                    track.last_alert_time = now
+                    track.alert_count += 1
+                    alerts.append(track)
+
+            state.alerts += len(alerts)
+            if len(boxes) > 0 and not alerts:
+                state.suppressed_frames += 1
+            return alerts
+
+    def keep_alive(self, stream_key):
+        now = time.monotonic()
+        with self.lock:
+            state = self.streams.get(stream_key)
+            if state is None:
+                return
+            for track in state.tracks:
+                track.last_seen = now
+
+    def has_tracks(self, stream_key):
+        now = time.monotonic()
+        with self.lock:
+            state = self.streams.get(stream_key)
+            if state is None:
+                return False
+            return any(now - track.last_seen <= self.max_age and track.alert_count > 0 for track in state.tracks)
+
+    def stats(self, stream_key):
+        with self.lock:
+            state = self.streams.get(stream_key)
+            if state is None:
+                return {"tracks_created": 0, "alerts": 0, "suppressed_frames": 0, "live_tracks": 0}
+            return {
+                "tracks_created": state.tracks_created,
+                "alerts": state.alerts,
+                "suppressed_frames": state.suppressed_frames,
+                "live_tracks": len(state.tracks),
+            }
+
+    def reset(self, stream_key):
+        with self.lock:
+            self.streams.pop(stream_key, None)
+
+    def _associate(self, tracks, boxes, class_ids):
+        """
+        Greedily matches tracks with detections of the same class, best matches first.
+        Matches by IoU always come before matches by distance between centers.
+
+        Returns:
+            A list of pairs (track index, detection index).
+        """
+        if not tracks or len(boxes) == 0:
+            return []
+
+        track_boxes = np.stack([track.box for track in tracks])
+        track_classes = np.array([track.class_id for track in tracks])
+
+        iou = pairwise_iou(track_boxes, boxes)
+
+        # Distance between centers relative to the diagonal of the track box
+        track_centers = (track_boxes[:, :2] + track_boxes[:, 2:]) / 2
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        diagonals = np.maximum(np.linalg.norm(track_boxes[:, 2:] - track_boxes[:, :2], axis=1), 1e-9)
+        distance = np.linalg.norm(track_centers[:, None, :] - centers[None, :, :], axis=2) / diagonals[:, None]
+
+        # Centroid matches get a similarity below `iou_threshold`, so they never win over IoU matches
+        similarity = np.where(iou >= self.iou_threshold, iou,
+                              np.where(distance <= self.max_centroid_distance,
+                                       self.iou_threshold * (1 - distance / self.max_centroid_distance) * 0.99, 0.0))
+        similarity[track_classes[:, None] != class_ids[None, :]] = 0.0
+
+        matches = []
+        while similarity.size > 0 and similarity.max() > 0:
+            track_index, detection_index = np.unravel_index(np.argmax(similarity), similarity.shape)
+            matches.append((int(track_index), int(detection_index)))
+            similarity[track_index, :] = 0.0
+            similarity[:, detection_index] = 0.0
+        return matches
+
+
+# The tracker shared by all daemon processes
+object_tracker = ObjectTracker(iou_threshold=tracker_iou_threshold, max_centroid_distance=tracker_max_centroid_distance,
+                               max_age=tracker_max_age, realert_interval=tracker_realert_interval)
@@ -0,0 +1,87 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from datetime import datetime
+
+from static.settings import log_level, log_format
+
+# Fields of `logging.LogRecord` which are not passed through `extra`
+standard_fields = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+# Writes the records in the background. Created on the first call of `get_logger`
+listener = None
+listener_lock = threading.Lock()
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats a record as one line: either a JSON object or `key=value` pairs. Values passed through `extra`
+    (e.g. `stream`) become separate fields.
+    """
+    def __init__(self, output_format='text'):
+        super().__init__()
+        self.output_format = output_format
+
+    def format(self, record):
+        fields = {
+            "time": datetime.fromtimestamp(record.created).strftime('%y-%m-%d:%H:%M:%S.%f')[:-3],
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        fields.update((key, value) for key, value in vars(record).items() if key not in standard_fields)
+        if record.exc_info:
+            fields["exception"] = self.formatException(record.exc_info)
+
+        if self.output_format == 'json':
+            return json.dumps(fields, ensure_ascii=False, default=str)
+        return " ".join(f"{key}={self._format_value(value)}" for key, value in fields.items())
+
+    @staticmethod
+    def _format_value(value):
+        value = str(value)
+        if not value or any(character in value for character in ' ="\n'):
+            return json.dumps(value, ensure_ascii=False)  # Quote values with spaces
+        return value
+
+
+def configure_logging(level=log_level, output_format=log_format):
+    """
+    Sets up logging of the whole application. Records are put into a queue by the calling thread and written to stderr
+    by a background thread, so logging never blocks the detection pipeline on I/O.
+
+    Args:
+        level: Minimum level of written records, e.g. 'INFO' or 'DEBUG'.
+        output_format: 'text' for `key=value` lines or 'json' for JSON lines.
+
+    Returns:
+        listener: An instance of `QueueListener` which writes the records.
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(StructuredFormatter(output_format))
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)  # Write the remaining records on exit
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(records)]
+    root_logger.setLevel(level)
+    return listener
+
+
+def get_logger(name):
+    """
+    Returns a logger of a module. Logging is configured on the first call.
+    """
+    global listener
+
+    with listener_lock:
+        if listener is None:
+            listener = configure_logging()
+    return logging.getLogger(name)
@@ -0,0 +1,252 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from static.settings import metrics_host, metrics_port
+
+# Upper bounds in seconds of the buckets of latency histograms
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """
+    Base class of metrics with labels. Values of each combination of label values are stored separately.
+
+    Attributes:
+        name (str): Name of the metric in the Prometheus text format.
+        description (str): A human-readable description.
+        label_names (tuple): Names of the labels.
+
+    Methods:
+        render: Return lines of the metric in the Prometheus text format.
+    """
+    type_name = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}  # Maps a tuple of label values to the value
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"]
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in sorted(values, key=lambda item: item[0]):
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise Exception(f"Metric '{self.name}' expects labels {self.label_names}, got {tuple(labels)}.")
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def _format_labels(self, label_values, extra=()):
+        pairs = list(zip(self.label_names, label_values)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def _render_value(self, label_values, value):
+        return [f"{self.name}{self._format_labels(label_values)} {value}"]
+
+
+class Counter(Metric):
+    """
+    A value which only increases, e.g. the number of analyzed frames.
+    """
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        key = self._key(labels)
+        with self.lock:
+            return self.values.get(key, 0)
+
+
+class Gauge(Metric):
+    """
+    A value which can go up and down, e.g. a queue depth. The value is either set directly or, if `function`
+    is given, computed when the metrics are collected.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name, description, label_names=(), function=None):
+        super().__init__(name, description, label_names)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        if self.function is not None:
+            with self.lock:
+                self.values[()] = self.function()
+        return super().render()
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, e.g. latencies, with cumulative buckets as in Prometheus.
+    Observers are functions called with each observed value and its labels, e.g. by the profiler while it is running.
+    """
+    type_name = "histogram"
+
+    def __init__(self, name, description, label_names=(), buckets=default_buckets):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.observers = []
+
+    def add_observer(self, observer):
+        with self.lock:
+            self.observers = self.observers + [observer]  # Observers are called without the lock
+
+    def remove_observer(self, observer):
+        with self.lock:
+            self.observers = [other for other in self.observers if other != observer]  # Bound methods are new objects
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Counts of each bucket and of the `+Inf` bucket, the sum and the number of values
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+        for observer in self.observers:
+            observer(value, labels)
+
+    def summary(self, **labels):
+        """
+        Returns a dictionary with the number, the sum and the mean of the observed values.
+        """
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            count, total = (state[2], state[1]) if state is not None else (0, 0.0)
+        return {"count": count, "sum": total, "mean": total / count if count else None}
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def _render_value(self, label_values, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{self._format_labels(label_values, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._format_labels(label_values)} {total}")
+        lines.append(f"{self.name}_count{self._format_labels(label_values)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    All metrics of the process.
+
+    Methods:
+        counter: Create or return a counter.
+        gauge: Create or return a gauge.
+        histogram: Create or return a histogram.
+        render: Return all metrics in the Prometheus text format.
+    """
+    def __init__(self):
+        self.metrics = {}  # Maps metric name to `Metric`
+        self.lock = threading.Lock()
+
+    def counter(self, name, description, label_names=()):
+        return self._get_or_create(Counter, name, description, label_names)
+
+    def gauge(self, name, description, label_names=(), function=None):
+        return self._get_or_create(Gauge, name, description, label_names, function=function)
+
+    def histogram(self, name, description, label_names=(), buckets=default_buckets):
+        return self._get_or_create(Histogram, name, description, label_names, buckets=buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _get_or_create(self, metric_class, name, description, label_names, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, description, label_names, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise Exception(f"Metric '{name}' is already registered as a {metric.type_name}.")
+            return metric
+
+
+# The registry shared by the bot and the image processing modules
+registry = Registry()
+
+# Metrics of the detection pipeline. Stages: 'read', 'predetect', 'preprocess', 'forward', 'postprocess', 'inference',
+# 'draw', 'encode', 'send'
+stage_seconds = registry.histogram("animal_detection_stage_seconds", "Time spent in each stage of the pipeline.",
+                                   ("stage",))
+batch_size = registry.histogram("animal_detection_batch_size", "Number of frames in one batch of the model.",
+                                buckets=(1, 2, 4, 8, 16, 32))
+frames_total = registry.counter("animal_detection_frames_total",
+                                "Frames taken by daemon processes, by result: 'analyzed' or 'skipped'.",
+                                ("stream", "result"))
+alerts_total = registry.counter("animal_detection_alerts_total", "Alerts about unexpected objects.", ("stream",))
+photos_sent_total = registry.counter("animal_detection_photos_sent_total", "Photos sent to chats, by result.",
+                                     ("stream", "result"))
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Requests are not logged, scrapes happen every few seconds
+
+
+def start_metrics_server(host=metrics_host, port=metrics_port):
+    """
+    Starts serving the metrics on `http://<host>:<port>/metrics` in a background thread.
+
+    Args:
+        host: Address the server listens on.
+        port: Port the server listens on. If `None`, the server is not started.
+
+    Returns:
+        server: An instance of `ThreadingHTTPServer`. `None` if the server is not started.
+    """
+    if port is None:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,305 @@
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+from static.settings import profile_dir, profile_duration, profile_sample_interval, profile_torch_batches
+from monitoring.logs import get_logger
+from monitoring.metrics import stage_seconds
+
+logger = get_logger(__name__)
+
+# Where CPU time of threads cannot be measured, stacks which end in these files are considered waiting
+# for something (a lock, a queue, a socket) and are skipped
+idle_files = {'threading.py', 'queue.py', 'selectors.py', 'socket.py', 'socketserver.py', 'connection.py'}
+
+# CPU time of threads is read from /proc on Linux. Unlike `time.pthread_getcpuclockid`, this is safe for threads
+# which exit while they are sampled. The time is counted in clock ticks, so a thread is busy if its time has grown
+# during the last two ticks
+task_stats_available = os.path.isdir('/proc/self/task')
+clock_tick = 1 / os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') and 'SC_CLK_TCK' in os.sysconf_names else 0.01
+
+
+def read_thread_cpu_time(native_id):
+    """
+    Returns:
+        CPU time in seconds used by the thread of this process. `None` if the thread has exited.
+    """
+    try:
+        with open(f"/proc/self/task/{native_id}/stat", 'rb') as file:
+            fields = file.read().rsplit(b')', 1)[1].split()  # The name of the thread may contain spaces
+        return (int(fields[11]) + int(fields[12])) * clock_tick  # utime and stime
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class Profiler:
+    """
+    Profiles the process for a fixed window on demand, without a restart. While it is running:
+      - stacks of all threads are sampled every `sample_interval` seconds and written as folded stacks
+        (`cpu.folded`, one `thread;file:function;... count` line per stack), which flamegraph tools
+        (`flamegraph.pl`, speedscope, inferno) read directly. Threads which have not used CPU in the last
+        sample interval are skipped, so waiting threads do not hide the busy ones;
+      - time of each pipeline stage measured by `stage_seconds` is attributed to the stream it was spent on
+        (`stages.json`). A batch of the model is split evenly between the streams of its frames;
+      - the first `torch_batches` batches of the model are traced with `torch.profiler` (`torch_trace_<n>.json`
+        for `chrome://tracing` or Perfetto, and the slowest operators in `torch_ops.txt`). Only batches run in this
+        process are traced, so with the 'process' inference backend there are no traces.
+    A summary is written into `summary.txt` and returned by `wait`. When the profiler is off, the pipeline only
+    checks `is_active` and looks up the stream of the thread when a frame is submitted to the model.
+
+    Attributes:
+        output_dir (str): Directory where a new directory is created for each profiling window.
+        sample_interval (float): Time in seconds between stack samples.
+        torch_batches (int): Number of batches of the model traced in each window.
+        is_active (bool): Whether profiling is running now.
+        directory (str): Directory with the results of the current or the last window.
+
+    Methods:
+        start: Start profiling for a number of seconds.
+        stop: Stop profiling before the end of the window.
+        wait: Wait for the end of the window and return the summary.
+        set_stream: Attribute all work of a thread to a stream.
+        attribute: A context manager which attributes work of the current thread to streams.
+        current_streams: Return the streams work of the current thread is attributed to.
+        torch_trace: A context manager which traces the model with `torch.profiler` if needed.
+    """
+    def __init__(self, output_dir=profile_dir, sample_interval=profile_sample_interval,
+                 torch_batches=profile_torch_batches):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.torch_batches = torch_batches
+        self.is_active = False
+        self.directory = None
+        self.summary = None
+
+        self.thread_streams = weakref.WeakKeyDictionary()  # Maps a thread to the streams its work is attributed to
+        self.local = threading.local()  # Streams set by `attribute` override those of the thread
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()  # Used for starting and stopping and for updating the results
+
+        # Results of the current window
+        self.stacks = Counter()
+        self.stages = {}  # Maps (stream key, stage) to a list with the number of measurements and the time
+        self.cpu_times = {}  # Maps native id of a thread to its CPU time and the time when it has last grown
+        self.torch_traces = 0
+
+    def start(self, duration=profile_duration):
+        """
+        Returns:
+            The directory where the results are written. `None` if profiling is already running.
+        """
+        with self.lock:
+            if self.is_active:
+                return None
+            self.is_active = True
+            self.directory = os.path.join(self.output_dir, datetime.now().strftime('%y-%m-%d_%H-%M-%S'))
+            self.summary = None
+            self.stacks = Counter()
+            self.stages = {}
+            self.cpu_times = {}
+            self.torch_traces = 0
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, args=(duration,), name="profiler", daemon=True)
+
+        stage_seconds.add_observer(self._record_stage)
+        self.thread.start()
+        logger.info(f"Profiling for {duration} s, results are written to '{self.directory}'.")
+        return self.directory
+
+    def stop(self):
+        self.stop_event.set()
+
+    def wait(self, timeout=None):
+        """
+        Returns:
+            The summary of the last window. `None` if it has not ended in `timeout` seconds.
+        """
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+        return self.summary
+
+    def set_stream(self, stream_key, thread=None):
+        """
+        Attributes all work of the thread (the current thread by default) to the stream, e.g. of a daemon process.
+        """
+        self.thread_streams[thread or threading.current_thread()] = (stream_key,)
+
+    @contextmanager
+    def attribute(self, stream_keys):
+        previous = getattr(self.local, 'streams', None)
+        self.local.streams = tuple(stream_keys)
+        try:
+            yield
+        finally:
+            self.local.streams = previous
+
+    def current_streams(self):
+        """
+        Returns:
+            A tuple of stream keys. `None` if the work of the thread is not attributed to any stream.
+        """
+        streams = getattr(self.local, 'streams', None)
+        if streams is None:
+            streams = self.thread_streams.get(threading.current_thread())
+        return streams
+
+    def torch_trace(self):
+        """
+        Returns a context manager which traces the code inside with `torch.profiler` if profiling is running
+        and fewer than `torch_batches` batches have been traced in this window. Otherwise it does nothing.
+        """
+        if not self.is_active:
+            return nullcontext()
+        with self.lock:
+            if self.torch_traces >= self.torch_batches:
+                return nullcontext()
+            self.torch_traces += 1
+            return self._trace_torch(self.directory, self.torch_traces)
+
+    def _run(self, duration):
+        start_time = time.monotonic()
+        samples = 0
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.sample_interval) and time.monotonic() - start_time < duration:
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            cpu_times = {}
+            for thread_id, frame in sys._current_frames().items():
+                thread = threads.get(thread_id)
+                if thread_id != own_id and not self._is_idle(thread, frame, cpu_times):
+                    self.stacks[self._fold(thread, frame)] += 1
+            self.cpu_times = cpu_times  # Threads which have exited are forgotten
+            samples += 1
+
+        stage_seconds.remove_observer(self._record_stage)
+        elapsed = time.monotonic() - start_time
+        try:
+            self.summary = self._write(elapsed, samples)
+            logger.info(f"Profiling is finished, results are written to '{self.directory}'.")
+        except OSError as e:
+            self.summary = f"Failed to write the results: {e}"
+            logger.error(self.summary)
+        with self.lock:
+            self.is_active = False
+
+    def _is_idle(self, thread, frame, cpu_times):
+        is_waiting = os.path.basename(frame.f_code.co_filename) in idle_files
+        if thread is None or not task_stats_available:
+            return is_waiting  # CPU time cannot be measured
+
+        cpu_time = read_thread_cpu_time(thread.native_id)
+        if cpu_time is None:
+            return True  # The thread has exited since its stack was taken
+
+        now = time.monotonic()
+        previous = self.cpu_times.get(thread.native_id)
+        if previous is None:
+            cpu_times[thread.native_id] = (cpu_time, None)
+            return is_waiting
+        last_growth = now if cpu_time > previous[0] else previous[1]
+        cpu_times[thread.native_id] = (cpu_time, last_growth)
+        if last_growth is None:
+            return True
+        return now - last_growth > max(self.sample_interval, 2 * clock_tick)
+
+    def _fold(self, thread, frame):
+        functions = []
+        while frame is not None:
+            functions.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+            frame = frame.f_back
+
+        root = thread.name if thread is not None else "unknown"
+        streams = self.thread_streams.get(thread) if thread is not None else None
+        if streams is not None:
+            root += f" [{', '.join(streams)}]"
+        return ";".join([root.replace(";", ",")] + functions[::-1])
+
+    def _record_stage(self, value, labels):
+        streams = self.current_streams() or ('other',)
+        share = value / len(streams)
+        with self.lock:
+            for stream_key in streams:
+                entry = self.stages.setdefault((stream_key, labels['stage']), [0, 0.0])
+                entry[0] += 1
+                entry[1] += share
+
+    @contextmanager
+    def _trace_torch(self, directory, index):
+        import torch
+        from torch.profiler import profile, ProfilerActivity
+
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+        with profile(activities=activities, record_shapes=True) as trace:
+            yield
+
+        # The first trace takes a while, so it may end after the window
+        os.makedirs(directory, exist_ok=True)
+        trace.export_chrome_trace(os.path.join(directory, f"torch_trace_{index}.json"))
+        table = trace.key_averages().table(sort_by="self_cpu_time_total", row_limit=25)
+        with self.lock, open(os.path.join(directory, 'torch_ops.txt'), 'a', encoding='utf-8') as file:
+            file.write(f"Batch {index}:\n{table}\n\n")
+
+    def _write(self, elapsed, samples):
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            stacks = self.stacks.most_common()
+            stages = sorted(self.stages.items())
+
+        with open(os.path.join(self.directory, 'cpu.folded'), 'w', encoding='utf-8') as file:
+            file.writelines(f"{stack} {count}\n" for stack, count in stacks)
+
+        stage_results = {}
+        for (stream_key, stage), (count, total) in stages:
+            stage_results.setdefault(stream_key, {})[stage] = {"count": count, "seconds": total}
+        with open(os.path.join(self.directory, 'stages.json'), 'w', encoding='utf-8') as file:
+            json.dump({"seconds": elapsed, "stages": stage_results}, file, indent=2)
+
+        lines = [f"Profiled {elapsed:.1f} s, {samples} samples every {self.sample_interval * 1000:g} ms.", "",
+                 "Time of stages by stream (share of the window):"]
+        for stream_key, results in stage_results.items():
+            lines.append(f"  {stream_key}:")
+            for stage, result in sorted(results.items(), key=lambda item: -item[1]["seconds"]):
+                lines.append(f"    {stage:<12} {result['seconds']:8.2f} s {result['seconds'] / elapsed:6.1%}"
+                             f"  {result['count']} times, {result['seconds'] / result['count'] * 1000:.1f} ms each")
+
+        functions = Counter()
+        threads = Counter()
+        for stack, count in stacks:
+            functions[stack.rsplit(";", 1)[-1]] += count
+            threads[stack.split(";", 1)[0]] += count
+        busy_samples = max(sum(threads.values()), 1)
+        lines += ["", "Busy threads (share of the window):"]
+        lines += [f"  {thread}: {count / max(samples, 1):.1%}" for thread, count in threads.most_common(10)]
+        lines += ["", "Functions on top of the stack (share of busy samples):"]
+        lines += [f"  {function}: {count / busy_samples:.1%}" for function, count in functions.most_common(15)]
+        summary = "\n".join(lines)
+
+        with open(os.path.join(self.directory, 'summary.txt'), 'w', encoding='utf-8') as file:
+            file.write(summary + "\n")
+        return summary
+
+
+# The profiler shared by the bot and the image processing modules
+profiler = Profiler()
+
+
+def install_signal_handler():
+    """
+    Starts profiling for `profile_duration` seconds when the process receives SIGUSR1, e.g. `kill -USR1 <pid>`.
+    Should be called from the main thread. Does nothing on systems without SIGUSR1.
+    """
+    if not hasattr(signal, 'SIGUSR1'):
+        return False
+
+    # The handler interrupts the main thread, so the profiler is started in another thread
+    # to avoid taking its lock there
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=profiler.start, daemon=True).start())
+    return True
@@ -0,0 +1,176 @@
+# Settings of the detection pipeline shared by the bot and the image processing modules.
+import os
+
+# Inference engine: frames from all streams and `/now` requests are collected into micro-batches.
+# A batch is sent to the model as soon as it has `max_batch_size` frames
+# or the oldest frame has waited for `max_batch_wait_time` seconds.
+max_batch_size = 8
+max_batch_wait_time = 0.05
+
+# Inference backend: 'thread' runs the model inside the bot process, 'process' runs it in `inference_processes`
+# worker processes which get frames through shared memory. CPU cores are split evenly between the workers.
+inference_backend = 'thread'
+inference_processes = 2
+
+# Backend running the model: 'eager' (fp32 PyTorch), 'quantized' (PyTorch with dynamic int8 quantization of linear
+# layers) or 'onnx' (onnxruntime on CPU, the model is exported on the first start).
+model_backend = 'eager'
+
+# The model is loaded on the first detection. If `model_warm_up` is set, the bot loads it in the background
+# right after the start instead.
+model_warm_up = True
+
+# Detection cache: results are reused for almost identical frames of the same stream.
+# At most `detection_cache_max_entries` results are stored, each for at most `detection_cache_ttl` seconds.
+detection_cache_max_entries = 256
+detection_cache_ttl = 15
+
+# Motion gate: a frame is analyzed only if the share of changed pixels is at least `motion_change_threshold`
+# or the stream has not been analyzed for `motion_max_staleness` seconds.
+# Frames are compared with a running background (updated with `motion_learning_rate`) after downscaling to
+# `motion_resize_width` pixels in width. A pixel is changed if its brightness differs by more than `motion_pixel_threshold`.
+motion_resize_width = 64
+motion_pixel_threshold = 25
+motion_change_threshold = 0.01
+motion_max_staleness = 60
+motion_learning_rate = 0.05
+
+# Frame scheduler: a stream is sampled every `scheduler_idle_interval` seconds when nothing happens and up to
+# every `scheduler_min_interval` seconds when there is motion or something unexpected was detected in the last
+# `scheduler_activity_window` seconds. Intervals grow when frames are waiting for the model or the process uses
+# more than `scheduler_cpu_budget` of all CPU cores, but never exceed `scheduler_max_interval` seconds.
+# At most `scheduler_max_concurrent` streams run the analysis at the same time. `None` means `max_batch_size`, so frames
+# of the streams can fill a batch of the model; a smaller number keeps batches partly empty but limits CPU spikes.
+scheduler_min_interval = 2
+scheduler_idle_interval = 10
+scheduler_max_interval = 60
+scheduler_activity_window = 60
+scheduler_motion_saturation = 0.05
+scheduler_cpu_budget = 0.8
+scheduler_max_concurrent = None
+
+# A stream where only already reported objects are seen is sampled at most every `scheduler_tracked_interval` seconds
+scheduler_tracked_interval = 6
+
+# Tracker of unexpected objects: a detection continues a track of the same class if their boxes overlap with IoU
+# of at least `tracker_iou_threshold` or the distance between box centers is at most `tracker_max_centroid_distance`
+# of the track box diagonal. A track not seen for `tracker_max_age` seconds is forgotten. An alert is sent when a new
+# track appears and again every `tracker_realert_interval` seconds while the track is still seen.
+tracker_iou_threshold = 0.3
+tracker_max_centroid_distance = 0.5
+tracker_max_age = 60
+tracker_realert_interval = 300
+
+# Detector cascade: if `cascade_enabled` is set, daemon processes screen each frame with MobileNet-SSD (`cv2.dnn`,
+# files in `img_processing/weights`) and run DETR only if the pre-detector sees an object of a class not listed
+# for the stream in `cascade_target_classes` with a score of at least `cascade_suspect_threshold`, or an object
+# of a listed class with a score below `cascade_confident_threshold`. Pre-detector objects with a score below
+# `cascade_min_confidence` are ignored. `cascade_mode` is 'frame' to run DETR on the whole frame or 'crops' to run it
+# around the suspicious objects only, with `cascade_crop_margin` of the box size added on each side.
+# Streams without target classes (PASCAL VOC has no bears) always use DETR.
+cascade_enabled = False
+cascade_mode = 'frame'
+cascade_min_confidence = 0.2
+cascade_confident_threshold = 0.6
+cascade_suspect_threshold = 0.3
+cascade_crop_margin = 0.2
+cascade_target_classes = {
+    'bird': ['bird'],
+}
+
+# Images sent to the bot are encoded into JPEG in memory with quality `jpeg_quality` (0-100)
+# and downscaled to `jpeg_max_width` pixels in width if they are wider (`None` disables downscaling).
+jpeg_quality = 85
+jpeg_max_width = 1280
+
+# If set, every sent image is also saved into this directory (e.g. '../img'). `None` disables saving.
+archive_dir = None
+
+# Unexpected objects of every analyzed frame are stored in the SQLite database `event_store_path` (`None` disables it).
+# Events are written in the background in batches of up to `event_store_batch_size` events at least every
+# `event_store_flush_interval` seconds.
+event_store_path = '../events.sqlite3'
+event_store_batch_size = 256
+event_store_flush_interval = 1.0
+
+# Asynchronous bot: blocking work (detection, opening streams) runs in `detection_executor_workers` threads.
+# Requests to Telegram go through one pooled HTTP session with at most `telegram_connection_limit` connections.
+# `telegram_api_url` redirects requests to another Bot API server, e.g. 'http://127.0.0.1:8081/bot{0}/{1}'
+# for a local fake server. `None` means the real Telegram API.
+detection_executor_workers = 4
+telegram_connection_limit = 50
+telegram_api_url = None
+
+# Outbound alerts: daemon processes put photos into a queue of at most `alert_queue_max_size` deliveries (one per chat),
+# and `alert_queue_workers` background threads send them. New deliveries are dropped when the queue is full.
+# A chat gets at most `alert_chat_rate` requests per second with bursts of `alert_chat_burst`, all chats together
+# at most `alert_global_rate` requests per second with bursts of `alert_global_burst` (Telegram allows about 1 message
+# per second in a chat and 30 in total). Photos waiting for the same chat are sent as one media group of up to
+# `alert_max_group_size` photos. A failed request is retried up to `alert_max_retries` times after `alert_retry_delay`
+# seconds, doubled after each attempt up to `alert_max_retry_delay`; on 429 the `retry_after` of Telegram is used,
+# and such retries are not counted. On shutdown, the bot waits up to `alert_flush_timeout` seconds for queued photos.
+alert_queue_max_size = 10000
+alert_queue_workers = 4
+alert_chat_rate = 1.0
+alert_chat_burst = 2
+alert_global_rate = 25.0
+alert_global_burst = 25
+alert_max_group_size = 10
+alert_max_retries = 5
+alert_retry_delay = 1.0
+alert_max_retry_delay = 60.0
+alert_flush_timeout = 10.0
+
+# Streams are listed in the JSON file `stream_registry_path` (see `static/streams.example.json`), the built-in
+# `video_sources` are used if it does not exist. The bot checks the file for changes every `stream_maintenance_interval`
+# seconds. A stream decoder is opened when a frame of the stream is needed for the first time and closed after
+# `stream_idle_ttl` seconds without use. At most `max_open_streams` decoders are open at once: opening one more closes
+# the least recently used decoder which is not being read.
+stream_registry_path = '../streams.json'
+stream_maintenance_interval = 30.0
+stream_idle_ttl = 300.0
+max_open_streams = 16
+
+# Cluster: if `cluster_enabled` is set, the bot only talks to Telegram and listens on `cluster_host`:`cluster_port`
+# for detection workers (`bot/worker.py`), which may run on other hosts. Streams with subscribers are assigned to
+# the connected workers by consistent hashing with `cluster_hash_replicas` points per worker, so a joining or leaving
+# worker moves only its share of the streams. Workers send a heartbeat every `cluster_heartbeat_interval` seconds;
+# a worker not heard from for `cluster_heartbeat_timeout` seconds is disconnected and its streams are moved to the others.
+# A disconnected worker connects again after `cluster_reconnect_delay` seconds. `/now` waits for the photo from
+# the worker of the stream for at most `cluster_request_timeout` seconds.
+# Workers are accepted only if they send the secret `cluster_token`, taken from the environment variable
+# ANIMAL_DETECTION_CLUSTER_TOKEN on the bot and on the workers. Without it, the bot accepts workers only on a loopback
+# `cluster_host`, since anyone who can connect could receive the stream addresses and send alerts to all chats.
+cluster_enabled = False
+cluster_host = '127.0.0.1'
+cluster_port = 9200
+cluster_hash_replicas = 64
+cluster_heartbeat_interval = 2.0
+cluster_heartbeat_timeout = 10.0
+cluster_reconnect_delay = 1.0
+cluster_request_timeout = 60.0
+cluster_token = os.environ.get('ANIMAL_DETECTION_CLUSTER_TOKEN')
+
+# Each opened stream is decoded continuously into a ring buffer of `frame_buffer_size` frames
+frame_buffer_size = 4
+
+# Metrics are served in the Prometheus text format on `http://<metrics_host>:<metrics_port>/metrics`.
+# `None` in place of the port disables the endpoint.
+metrics_host = '127.0.0.1'
+metrics_port = 9100
+
+# Profiling: the signal SIGUSR1 or the command `/profile [seconds]` from a chat listed in `profile_admin_chat_ids`
+# profiles the process for `profile_duration` seconds (or the given number). Stacks of all threads are sampled every
+# `profile_sample_interval` seconds, time of the pipeline stages is attributed to streams, and the first
+# `profile_torch_batches` batches of the model are traced with `torch.profiler`. Results are written into a new
+# directory in `profile_dir`. Nothing is recorded while profiling is off.
+profile_dir = '../profiles'
+profile_duration = 30
+profile_sample_interval = 0.01
+profile_torch_batches = 3
+profile_admin_chat_ids = []
+
+# Logs are written to stderr in the background. Records below `log_level` ('DEBUG', 'INFO', 'WARNING', ...) are dropped.
+# `log_format` is 'text' for `key=value` lines or 'json' for JSON lines.
+log_level = 'INFO'
+log_format = 'text'
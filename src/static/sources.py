@@ -1,6 +1,144 @@
+import json
+import os
+import threading
+
+from static.settings import stream_registry_path
+
 # A dictionary where the key is the type of animal available in the telegram bot
 # and the value is the path to a YouTube livestream.
+# Used if there is no file `stream_registry_path`.
 video_sources = {
     'bird': 'https://youtu.be/EBer-aLmzM8',
     'bear': 'https://www.youtube.com/watch?v=3szkFHfr6sA'
 }
+
+
+class StreamRegistry:
+    """
+    Streams available in the bot, loaded from a JSON file which can be changed while the bot is running.
+    The file maps a stream key to a dictionary with the keys:
+      - 'url': the path to a YouTube livestream or to a local video file. Required.
+      - 'animal_type': the class of the model which is expected on the stream. The stream key by default.
+      - 'emoji', 'names': an emoji and declensions of the russian word as in `word_declensions`.
+        Those of the animal type by default.
+      - 'regions': regions of interest and tiling as in `stream_regions`. Those of the stream key by default.
+    See `streams.example.json`. If the file does not exist, `video_sources` are used.
+
+    Attributes:
+        path (str): Path to the JSON file. `None` to use `video_sources` only.
+        streams (dict): Maps stream key to its description.
+
+    Methods:
+        keys: Return keys of all streams.
+        contains: Check that a stream is registered.
+        get: Return the description of a stream.
+        source: Return the path to the video of a stream.
+        animal_type: Return the animal type expected on a stream.
+        regions: Return regions of interest and tiling of a stream.
+        add: Add or replace a stream.
+        remove: Remove a stream.
+        reload: Load the file again if it has changed.
+        add_listener: Register a function called when streams are added, removed or changed.
+    """
+    def __init__(self, path=None, defaults=None):
+        self.path = path
+        self.defaults = defaults or {}
+        self.streams = {}
+        self.modified_time = None  # Modification time of the loaded file
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.reload()
+
+    def keys(self):
+        with self.lock:
+            return list(self.streams.keys())
+
+    def contains(self, stream_key):
+        with self.lock:
+            return stream_key in self.streams
+
+    def get(self, stream_key):
+        with self.lock:
+            return self.streams.get(stream_key)
+
+    def source(self, stream_key):
+        stream = self.get(stream_key)
+        return stream['url'] if stream is not None else None
+
+    def animal_type(self, stream_key):
+        stream = self.get(stream_key)
+        return stream.get('animal_type', stream_key) if stream is not None else stream_key
+
+    def regions(self, stream_key, default=None):
+        stream = self.get(stream_key)
+        return stream.get('regions', default) if stream is not None else default
+
+    def add(self, stream_key, url, **description):
+        stream = {'url': url, **description}
+        with self.lock:
+            previous = self.streams.get(stream_key)
+            self.streams[stream_key] = stream
+        if previous != stream:
+            self._notify([stream_key] if previous is None else [], [], [stream_key] if previous is not None else [])
+
+    def remove(self, stream_key):
+        with self.lock:
+            previous = self.streams.pop(stream_key, None)
+        if previous is not None:
+            self._notify([], [stream_key], [])
+
+    def reload(self):
+        """
+        Loads the file if it has changed since the last load. An invalid file raises an exception,
+        and the loaded streams stay unchanged.
+
+        Returns:
+            Lists of keys of added, removed and changed streams.
+        """
+        if self.path is not None and os.path.isfile(self.path):
+            modified_time = os.path.getmtime(self.path)
+            if modified_time == self.modified_time:
+                return [], [], []
+            streams = self._read(self.path)
+        else:
+            modified_time = None
+            if self.streams and self.modified_time is None:
+                return [], [], []  # The defaults are loaded already
+            streams = {stream_key: {'url': url} for stream_key, url in self.defaults.items()}
+
+        with self.lock:
+            previous = self.streams
+            self.streams = streams
+            self.modified_time = modified_time
+        added = [stream_key for stream_key in streams if stream_key not in previous]
+        removed = [stream_key for stream_key in previous if stream_key not in streams]
+        changed = [stream_key for stream_key in streams if stream_key in previous and previous[stream_key] != streams[stream_key]]
+        self._notify(added, removed, changed)
+        return added, removed, changed
+
+    def add_listener(self, listener):
+        """
+        Args:
+            listener: A function called with lists of keys of added, removed and changed streams.
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, added, removed, changed):
+        if added or removed or changed:
+            for listener in self.listeners:
+                listener(added, removed, changed)
+
+    @staticmethod
+    def _read(path):
+        with open(path, encoding='utf-8') as file:
+            streams = json.load(file)
+        if not isinstance(streams, dict):
+            raise Exception(f"'{path}' should contain a dictionary of streams.")
+        for stream_key, stream in streams.items():
+            if not isinstance(stream, dict) or not isinstance(stream.get('url'), str):
+                raise Exception(f"Stream '{stream_key}' in '{path}' has no 'url'.")
+        return streams
+
+
+# Streams of the bot shared by the bot and the image processing modules
+stream_registry = StreamRegistry(stream_registry_path, video_sources)
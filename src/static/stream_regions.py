@@ -0,0 +1,20 @@
+# A dictionary where the key is the type of animal available in the telegram bot (the same as in `video_sources`)
+# and the value describes which parts of the stream frames are analyzed:
+#   - 'roi': a list of polygons, each polygon is a list of (x, y) points in coordinates relative to the frame size
+#     (from 0 to 1). Only objects with the center inside one of the polygons are detected. An empty list means the whole frame.
+#   - 'tiles': a pair (columns, rows). The bounding rectangle of each polygon is split into a grid of tiles
+#     which are analyzed separately at full model resolution, so small objects are not lost.
+#   - 'tile_overlap': a share of the tile size by which neighbouring tiles overlap.
+# Streams without an entry are analyzed as whole frames.
+stream_regions = {
+    'bird': {
+        'roi': [],
+        'tiles': (1, 1),
+        'tile_overlap': 0.1,
+    },
+    'bear': {
+        'roi': [],
+        'tiles': (1, 1),
+        'tile_overlap': 0.1,
+    },
+}
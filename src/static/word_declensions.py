@@ -1,3 +1,5 @@
+from static.sources import stream_registry
+
 # Emojis of animals available in the bot. Used in messages from the bot.
 emojis = {
     'bird': '🐧',
@@ -18,10 +20,7 @@ def get_nominative(animal_type):
     :param animal_type: Animal type which word is Russian should be in a specified form.
     :return A string with a correct form of the Russian word.
     """
-    if animal_type not in word_declensions.keys():
-        raise Exception(f"Unknown animal type {animal_type}.")
-
-    return f"{emojis[animal_type]} {word_declensions[animal_type][0]}"
+    return f"{get_emoji(animal_type)} {get_declensions(animal_type)[0]}"
 
 
 def get_genitive(animal_type):
@@ -31,10 +30,7 @@ def get_genitive(animal_type):
     :param animal_type: Animal type which word is Russian should be in a specified form.
     :return A string with a correct form of the Russian word.
     """
-    if animal_type not in word_declensions.keys():
-        raise Exception(f"Unknown animal type {animal_type}.")
-
-    return word_declensions[animal_type][1]
+    return get_declensions(animal_type)[1]
 
 
 def get_instrumental(animal_type):
@@ -44,17 +40,33 @@ def get_instrumental(animal_type):
     :param animal_type: Animal type which word is Russian should be in a specified form.
     :return A string with a correct form of the Russian word.
     """
-    if animal_type not in word_declensions.keys():
-        raise Exception(f"Unknown animal type {animal_type}.")
-
-    return word_declensions[animal_type][2]
+    return get_declensions(animal_type)[2]
 
 
 def get_emoji(animal_type):
     """
     Returns an emoji for the specified animal type.
     """
-    if animal_type not in word_declensions.keys():
+    stream = stream_registry.get(animal_type) or {}
+    if 'emoji' in stream:
+        return stream['emoji']
+
+    expected_animal_type = stream_registry.animal_type(animal_type)
+    if expected_animal_type not in emojis.keys():
         raise Exception(f"Unknown animal type {animal_type}.")
+    return emojis[expected_animal_type]
+
+
+def get_declensions(animal_type):
+    """
+    Returns the russian words of the stream in the nominative, genitive and instrumental cases. They are taken
+    from the stream registry if given there, otherwise from `word_declensions` by the animal type of the stream.
+    """
+    stream = stream_registry.get(animal_type) or {}
+    if 'names' in stream:
+        return stream['names']
 
-    return emojis[animal_type]
+    expected_animal_type = stream_registry.animal_type(animal_type)
+    if expected_animal_type not in word_declensions.keys():
+        raise Exception(f"Unknown animal type {animal_type}.")
+    return word_declensions[expected_animal_type]